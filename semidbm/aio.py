@@ -0,0 +1,211 @@
+"""An asyncio interface to semidbm.
+
+Reading a value that isn't in the page cache blocks for a disk read, which
+would stall an event loop.  ``AsyncSemiDBM`` wraps a db and runs all of its
+I/O on a bounded thread pool instead.  Gets that are waiting at the same
+time are coalesced: the first ``get()`` schedules a read for the next
+iteration of the event loop, and every key requested before then is read
+with a single ``get_many()`` call, which reads the values in file order and
+merges reads of nearby values.  The event loop itself only does the
+bookkeeping for each key, so its latency doesn't depend on how long the
+reads take.
+
+This module requires python 3.7 or later.
+
+"""
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import semidbm.db
+from semidbm import compat
+
+
+DEFAULT_MAX_WORKERS = 4
+# The maximum number of keys read by one coalesced read, and the
+# number of values read at a time by items().
+MAX_BATCH_SIZE = 1024
+
+_MISSING = object()
+
+
+class AsyncSemiDBM(object):
+    """Wraps a db with awaitable methods.
+
+    Methods of the wrapped db are called from the threads of
+    ``executor``, so unless the executor only has one thread, the db
+    must be safe to use from multiple threads (see ``open()``).
+
+    """
+    def __init__(self, db, executor):
+        self._db = db
+        self._executor = executor
+        # Keys of the gets that haven't been read yet, mapped to the
+        # future shared by all the gets of that key.
+        self._pending = {}
+        self._flush_scheduled = False
+        # The coalesced reads that have been started but aren't done.
+        self._reads = set()
+
+    @property
+    def db(self):
+        """The wrapped (synchronous) db."""
+        return self._db
+
+    def _run(self, func, *args):
+        return asyncio.get_running_loop().run_in_executor(
+            self._executor, func, *args)
+
+    async def get(self, key, default=None):
+        """Return the value of a key, or ``default`` if it doesn't exist."""
+        if isinstance(key, compat.str_type):
+            key = key.encode('utf-8')
+        future = self._pending.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self._pending[key] = future
+            if not self._flush_scheduled:
+                self._flush_scheduled = True
+                loop.call_soon(self._flush)
+        # The future is shared with other gets of the key, cancelling
+        # this get must not cancel theirs.
+        value = await asyncio.shield(future)
+        if value is _MISSING:
+            return default
+        return value
+
+    def _flush(self):
+        self._flush_scheduled = False
+        pending = list(self._pending.items())
+        self._pending = {}
+        for i in range(0, len(pending), MAX_BATCH_SIZE):
+            batch = pending[i:i + MAX_BATCH_SIZE]
+            read = self._run(self._db.get_many,
+                             [key for key, future in batch], 'skip')
+            self._reads.add(read)
+            read.add_done_callback(self._reads.discard)
+            read.add_done_callback(functools.partial(_resolve_gets, batch))
+
+    async def get_many(self, keys, missing='raise', default=None):
+        """Return a dict of the values for multiple keys.
+
+        The arguments are the same as for the db's ``get_many()``.
+
+        """
+        return await self._run(self._db.get_many, list(keys), missing,
+                               default)
+
+    async def set(self, key, value):
+        await self._run(self._db.__setitem__, key, value)
+
+    async def delete(self, key):
+        await self._run(self._db.__delitem__, key)
+
+    async def set_many(self, items):
+        if hasattr(items, 'items'):
+            items = items.items()
+        await self._run(self._db.set_many, list(items))
+
+    async def delete_many(self, keys, missing='raise'):
+        await self._run(self._db.delete_many, list(keys), missing)
+
+    async def keys(self):
+        """Return a list of all the keys in the db."""
+        return await self._run(lambda: list(self._db.keys()))
+
+    async def items(self, batch_size=MAX_BATCH_SIZE):
+        """Iterate over the ``(key, value)`` pairs of the db.
+
+        This is an async iterator.  The keys are taken from a snapshot
+        of the db when the iteration starts, and the values are read
+        ``batch_size`` keys at a time.  Keys that are deleted during the
+        iteration are skipped.
+
+        """
+        keys = await self.keys()
+        for i in range(0, len(keys), batch_size):
+            batch = keys[i:i + batch_size]
+            values = await self._run(self._db.get_many, batch, 'skip')
+            for key in batch:
+                if key in values:
+                    yield key, values[key]
+
+    async def wait_loaded(self):
+        """Wait for the index of a db opened with ``lazy=True``."""
+        return await self._run(self._db.wait_loaded)
+
+    async def sync(self):
+        await self._run(self._db.sync)
+
+    async def wait_durable(self, timeout=None):
+        """Wait for the writes made so far to be on disk."""
+        return await self._run(self._db.wait_durable, timeout)
+
+    async def refresh(self):
+        """Load new entries into a read only db (see ``refresh()``)."""
+        await self._run(self._db.refresh)
+
+    async def compact(self):
+        await self._run(self._db.compact)
+
+    async def close(self, compact=False):
+        """Close the db and shut down the executor.
+
+        Gets that are waiting to be read are read first.
+
+        """
+        if self._pending:
+            self._flush()
+        try:
+            # The db can't be closed while it's being read from.  Errors
+            # are raised by the gets of the keys that were read.
+            await asyncio.gather(*self._reads, return_exceptions=True)
+            await self._run(self._db.close, compact)
+        finally:
+            self._executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+
+def _resolve_gets(batch, read):
+    # Runs on the event loop once the get_many() for batch is done.
+    if read.cancelled():
+        for key, future in batch:
+            future.cancel()
+        return
+    error = read.exception()
+    if error is not None:
+        for key, future in batch:
+            future.set_exception(error)
+        return
+    values = read.result()
+    for key, future in batch:
+        future.set_result(values.get(key, _MISSING))
+
+
+def open(filename, flag='r', mode=0o666, max_workers=DEFAULT_MAX_WORKERS,
+         **kwargs):
+    """Open a semidbm database for use with asyncio.
+
+    The arguments are the same as for ``semidbm.open()``.  The db is
+    opened (and its index is loaded) before this function returns, use
+    ``lazy=True`` and ``await db.wait_loaded()`` to load the index
+    without blocking the event loop.
+
+    :param max_workers: The number of threads used to run the db's I/O.
+        If this is more than 1, the db is opened with ``thread_safe=True``
+        unless ``thread_safe`` is given.  Options that can't be combined
+        with ``thread_safe`` (such as ``cache_size`` or ``segment_size``)
+        require ``max_workers=1``.
+
+    :returns: An ``AsyncSemiDBM``.
+
+    """
+    kwargs.setdefault('thread_safe', max_workers > 1)
+    db = semidbm.db.open(filename, flag, mode, **kwargs)
+    return AsyncSemiDBM(db, ThreadPoolExecutor(max_workers))
@@ -0,0 +1,91 @@
+"""Atomic write batches.
+
+A batch collects sets and deletes in memory and writes them to the data
+file as a single region with one ``write()`` call.  The region starts
+with a begin record holding the size of the entries, followed by the
+entries (in the same format as any other entries), and ends with a
+commit record holding the number of entries and a checksum of all of
+them.  The loaders only replay a batch whose commit record is intact,
+so if the process or the machine crashes while a batch is being
+written, none of its writes are applied when the db is loaded again.
+
+"""
+from semidbm import compat
+
+
+_MISSING = object()
+
+
+class WriteBatch(object):
+    """A group of writes that are applied to a db atomically.
+
+    Returned by ``batch()``.  Sets and deletes are made on the batch
+    like on a db, and multiple writes to the same key collapse so only
+    the last one is written.  Nothing is written to the db until
+    ``commit()`` is called, which happens when the batch is used as a
+    context manager and the ``with`` block exits without an exception.
+    Reads aren't served from the batch.
+
+    """
+    def __init__(self, db):
+        self._db = db
+        # Maps keys to values, or to None for deletes.
+        self._writes = {}
+        self._closed = False
+
+    def __setitem__(self, key, value, str_type=compat.str_type,
+                    isinstance=isinstance):
+        self._check_open()
+        if isinstance(key, str_type):
+            key = key.encode('utf-8')
+        if isinstance(value, str_type):
+            value = value.encode('utf-8')
+        self._writes[key] = value
+
+    def __delitem__(self, key):
+        self._check_open()
+        if isinstance(key, compat.str_type):
+            key = key.encode('utf-8')
+        pending = self._writes.get(key, _MISSING)
+        if pending is None:
+            raise KeyError(key)
+        if key in self._db:
+            self._writes[key] = None
+        elif pending is _MISSING:
+            raise KeyError(key)
+        else:
+            # The key was only set in this batch, so there's nothing
+            # to delete.
+            del self._writes[key]
+
+    def __len__(self):
+        return len(self._writes)
+
+    def _check_open(self):
+        if self._closed:
+            raise ValueError("The batch was already committed or "
+                             "discarded.")
+
+    def commit(self):
+        """Write the batch to the db."""
+        self._check_open()
+        self._closed = True
+        writes = self._writes
+        self._writes = None
+        self._db._write_batch(writes)
+
+    def discard(self):
+        """Discard the writes of the batch without writing them."""
+        self._closed = True
+        self._writes = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._closed:
+            return
+        if exc_type is None:
+            self.commit()
+        else:
+            self.discard()
@@ -0,0 +1,139 @@
+"""An in memory cache of values, bounded by size in bytes."""
+try:
+    from collections import OrderedDict
+except ImportError:
+    # python 2.6.
+    OrderedDict = None
+
+
+_MISSING = object()
+
+
+class _OrderedEntries(object):
+    """The part of OrderedDict used by LRUCache, for python 2.6.
+
+    The entries are kept in a circular doubly linked list of
+    ``[prev, next, key, value]`` links, in insertion order.
+
+    """
+    def __init__(self):
+        self._links = {}
+        self._root = root = []
+        root[:] = [root, root, None, None]
+
+    def __len__(self):
+        return len(self._links)
+
+    def __contains__(self, key):
+        return key in self._links
+
+    def __setitem__(self, key, value):
+        link = self._links.get(key)
+        if link is not None:
+            link[3] = value
+            return
+        root = self._root
+        last = root[0]
+        link = [last, root, key, value]
+        last[1] = link
+        root[0] = link
+        self._links[key] = link
+
+    def pop(self, key, default=_MISSING):
+        link = self._links.pop(key, None)
+        if link is None:
+            if default is _MISSING:
+                raise KeyError(key)
+            return default
+        prev, next_link = link[0], link[1]
+        prev[1] = next_link
+        next_link[0] = prev
+        return link[3]
+
+    def popitem(self, last=True):
+        if not self._links:
+            raise KeyError('dictionary is empty')
+        root = self._root
+        key = root[0][2] if last else root[1][2]
+        return key, self.pop(key)
+
+    def clear(self):
+        self._links.clear()
+        root = self._root
+        root[:] = [root, root, None, None]
+
+
+if OrderedDict is None:
+    OrderedDict = _OrderedEntries
+
+
+class LRUCache(object):
+    """A least recently used cache of key to value bytes.
+
+    The size of an entry is the length of its key plus the length of
+    its value.  Once the total size of the entries exceeds ``max_bytes``,
+    the least recently used entries are evicted.  Values larger than
+    ``max_bytes`` are never cached.
+
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """Return the value for key, or None if key isn't cached."""
+        entries = self._entries
+        try:
+            value = entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        # Reinserting the entry moves it to the most recently used end.
+        entries[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        size = len(key) + len(value)
+        if size > self.max_bytes:
+            self.discard(key)
+            return
+        entries = self._entries
+        old = entries.pop(key, None)
+        if old is not None:
+            self.current_bytes -= len(key) + len(old)
+        entries[key] = value
+        self.current_bytes += size
+        while self.current_bytes > self.max_bytes:
+            evicted_key, evicted = entries.popitem(last=False)
+            self.current_bytes -= len(evicted_key) + len(evicted)
+            self.evictions += 1
+
+    def discard(self, key):
+        value = self._entries.pop(key, None)
+        if value is not None:
+            self.current_bytes -= len(key) + len(value)
+
+    def clear(self):
+        self._entries.clear()
+        self.current_bytes = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self._entries),
+            'bytes': self.current_bytes,
+            'max_bytes': self.max_bytes,
+        }
@@ -0,0 +1,231 @@
+"""Background compaction.
+
+A background compaction copies the live entries of a db to a new data
+file on a separate thread while the db continues to be read from and
+written to.  The entries to copy are taken from a snapshot of the index
+at the time the compaction is started.  Everything written to the data
+file after that point (sets as well as deletes) is a contiguous region
+at the end of the data file, which is appended to the new data file
+as is before the new data file is renamed over the original one.
+
+"""
+import os
+import struct
+import threading
+
+from semidbm import compat
+from semidbm.loaders import _DELETED, FILE_FORMAT_VERSION, FILE_IDENTIFIER
+from semidbm.loaders import stored_size
+
+
+# The number of times the worker thread copies the entries written since
+# the compaction started before handing off to the final catch up (which
+# blocks writes).  The worker stops early once there's less than
+# _CATCH_UP_THRESHOLD bytes to copy.
+_CATCH_UP_ROUNDS = 5
+_CATCH_UP_THRESHOLD = 64 * 1024
+_CATCH_UP_CHUNK_SIZE = 1024 * 1024
+# How often (in number of keys copied) the progress callback is called.
+_PROGRESS_INTERVAL = 1000
+
+
+class CompactionHandle(object):
+    """A handle to a compaction running in a background thread.
+
+    Returned by ``compact_async()``.
+
+    """
+    def __init__(self, db, items, start_offset, progress_callback=None):
+        self._db = db
+        # (key, (offset, size)) of the live entries when the compaction
+        # was started, and the offset of the end of the data file at that
+        # point in time.
+        self._items = items
+        self._copied_offset = start_offset
+        self._progress_callback = progress_callback
+        self.total_keys = len(items)
+        self.copied_keys = 0
+        self._cancel_requested = threading.Event()
+        self._error = None
+        self._completed = False
+        self._discarded = False
+        self._discard_lock = threading.Lock()
+        self._dbdir = os.path.join(db._dbdir, 'compact')
+        self._new_filename = os.path.join(self._dbdir, 'data')
+        self._index = db._index_factory()
+        self._source = None
+        self._new_file = None
+        # The offset of the end of the new data file.
+        self._new_offset = 0
+        self._start_time = compat.monotonic()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    @property
+    def progress(self):
+        """The fraction (0.0 to 1.0) of the live keys copied so far."""
+        if not self.total_keys:
+            return 1.0
+        return self.copied_keys / float(self.total_keys)
+
+    def done(self):
+        """Return True if the compaction has completed, failed, or
+        been cancelled."""
+        return self._completed or self._discarded
+
+    def cancelled(self):
+        return self._discarded and self._cancel_requested.is_set()
+
+    def cancel(self):
+        """Cancel the compaction.
+
+        Returns False if the compaction has already completed, True
+        otherwise.  The db is left untouched by a cancelled compaction.
+
+        """
+        if self._completed:
+            return False
+        self._cancel_requested.set()
+        if not self._thread.is_alive():
+            self._discard()
+        return True
+
+    def wait(self, timeout=None):
+        """Wait for the compaction to finish.
+
+        Returns True if the compaction is done, or False if ``timeout``
+        seconds have passed and the compaction is still running.  If the
+        compaction failed, the exception raised in the background thread
+        is raised.
+
+        If the db was not opened in thread safe mode, the new data file
+        is swapped in by this method, so it must be called from the
+        thread that uses the db (``close()`` also calls this method).
+
+        """
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            return False
+        if self._error is not None:
+            raise self._error
+        if self._cancel_requested.is_set():
+            self._discard()
+        elif not self._completed:
+            self._db._complete_compaction(self)
+        return True
+
+    def _run(self):
+        try:
+            self._copy_live_entries()
+            for i in range(_CATCH_UP_ROUNDS):
+                if self._cancel_requested.is_set():
+                    break
+                if self._catch_up() < _CATCH_UP_THRESHOLD:
+                    break
+            if self._cancel_requested.is_set():
+                self._discard()
+            else:
+                self._db._finish_background_compaction(self)
+        except Exception as e:
+            self._error = e
+            self._discard()
+
+    def _copy_live_entries(self):
+        if not os.path.isdir(self._dbdir):
+            os.makedirs(self._dbdir)
+        self._source = compat.file_open(self._db._data_filename, 'rb')
+        self._new_file = compat.file_open(self._new_filename, 'wb')
+        # Entries of older file format versions are valid entries in
+        # the current version, so the new data file is always written
+        # in the current version.
+        self._new_file.write(FILE_IDENTIFIER)
+        self._new_file.write(struct.pack('!HH', *FILE_FORMAT_VERSION))
+        new_offset = 8
+        index = self._index
+        source = self._source
+        new_file = self._new_file
+        # Copying in data file order turns the reads into
+        # (mostly) sequential reads.
+        self._items.sort(key=lambda item: item[1][0])
+        for key, location in self._items:
+            if self._cancel_requested.is_set():
+                return
+            offset, size = location
+            # Entries are copied verbatim, including their checksum.
+            # <keysize><valsize><key><val><keyvalcksum>
+            source.seek(offset - 8 - len(key))
+            entry = source.read(8 + len(key) + stored_size(size) + 4)
+            new_file.write(entry)
+            index[key] = (new_offset + 8 + len(key), size)
+            new_offset += len(entry)
+            self.copied_keys += 1
+            if self._progress_callback is not None and \
+                    self.copied_keys % _PROGRESS_INTERVAL == 0:
+                self._progress_callback(self.copied_keys, self.total_keys)
+        self._items = None
+        self._new_offset = new_offset
+        if self._progress_callback is not None:
+            self._progress_callback(self.copied_keys, self.total_keys)
+
+    def _catch_up(self):
+        # Append everything written to the db since the last catch up
+        # to the new data file, and replay it into the new index.
+        end = self._db._current_offset
+        start = self._copied_offset
+        if end <= start:
+            return 0
+        self._source.seek(start)
+        remaining = end - start
+        while remaining:
+            chunk = self._source.read(min(remaining, _CATCH_UP_CHUNK_SIZE))
+            if not chunk:
+                raise IOError("Unexpected end of data file %s" %
+                              self._db._data_filename)
+            self._new_file.write(chunk)
+            remaining -= len(chunk)
+        self._new_file.flush()
+        index = self._index
+        for key, offset, size in self._db._data_loader.iter_keys(
+                self._new_filename, self._new_offset):
+            if size == _DELETED:
+                if key in index:
+                    del index[key]
+            else:
+                index[key] = (offset, size)
+        self._new_offset += end - start
+        self._copied_offset = end
+        return end - start
+
+    def _finalize(self):
+        # Called with writes to the db blocked.
+        self._catch_up()
+        self._new_file.flush()
+        os.fsync(self._new_file.fileno())
+        self._close_files()
+        return self._new_filename, self._index
+
+    def _mark_completed(self):
+        os.rmdir(self._dbdir)
+        self._completed = True
+
+    def _close_files(self):
+        for f in (self._source, self._new_file):
+            if f is not None:
+                f.close()
+        self._source = None
+        self._new_file = None
+
+    def _discard(self):
+        with self._discard_lock:
+            if self._discarded or self._completed:
+                return
+            self._discarded = True
+        self._close_files()
+        if os.path.exists(self._new_filename):
+            os.remove(self._new_filename)
+        if os.path.isdir(self._dbdir):
+            os.rmdir(self._dbdir)
+        self._db._compaction_discarded(self)
@@ -1,5 +1,7 @@
 import os
 import sys
+import time
+import array
 try:
     import __builtin__
 except ImportError:
@@ -21,3 +23,41 @@ if sys.platform.startswith('win'):
     # reading the file as a binary file so it doesn't
     # change any line ending characters.
     DATA_OPEN_FLAGS = DATA_OPEN_FLAGS | os.O_BINARY
+
+
+# The 'q' (signed 64 bit) array typecode was added in python 3.3.
+# On older versions fall back to 'l', which is 64 bits on most
+# 64 bit platforms.
+try:
+    array.array('q')
+    INT64_TYPECODE = 'q'
+except ValueError:
+    INT64_TYPECODE = 'l'
+
+
+# os.pread() reads from an offset without using (or changing) the
+# file position, so it only needs a single syscall and can be used
+# by multiple threads at once.  It's available on posix platforms
+# starting with python 3.3.
+pread = getattr(os, 'pread', None)
+
+
+# time.monotonic() was added in python 3.3.
+monotonic = getattr(time, 'monotonic', time.time)
+
+
+# os.posix_fadvise() was added in python 3.3 (on posix platforms).  The
+# advice is only a hint, so it's silently skipped where it's missing.
+if hasattr(os, 'posix_fadvise'):
+    def advise_sequential(fd, sequential=True):
+        if sequential:
+            advice = os.POSIX_FADV_SEQUENTIAL
+        else:
+            advice = os.POSIX_FADV_NORMAL
+        try:
+            os.posix_fadvise(fd, 0, 0, advice)
+        except OSError:
+            pass
+else:
+    def advise_sequential(fd, sequential=True):
+        pass
@@ -0,0 +1,71 @@
+"""Per value compression.
+
+A compressed value is stored as a single codec byte followed by the
+compressed contents.  In the data file, the value size of a compressed
+entry is ``-1 - <stored size>`` (see ``semidbm.loaders.stored_size``),
+which is also the size kept in the index, so a negative index size tells
+readers that the value has to be decompressed.
+
+"""
+import struct
+import zlib
+
+from semidbm.exceptions import DBMError
+
+
+# Codec names mapped to (codec byte, compress function), and codec bytes
+# mapped to decompress functions.  The codec bytes are part of the file
+# format and must never be reused.
+_COMPRESSORS = {}
+_DECOMPRESSORS = {}
+_CODEC_BYTE = struct.Struct('!B')
+DEFAULT_THRESHOLD = 128
+
+
+def _register(name, codec_id, compress, decompress):
+    _COMPRESSORS[name] = (_CODEC_BYTE.pack(codec_id), compress)
+    _DECOMPRESSORS[codec_id] = decompress
+
+
+_register('zlib', 1, zlib.compress, zlib.decompress)
+try:
+    import bz2
+    _register('bz2', 2, bz2.compress, bz2.decompress)
+except ImportError:
+    pass
+try:
+    import lzma
+    _register('lzma', 3, lzma.compress, lzma.decompress)
+except ImportError:
+    pass
+
+
+def available_codecs():
+    return sorted(_COMPRESSORS)
+
+
+def compress_value(value, codec, threshold, len=len):
+    """Return the bytes to store for ``value`` and its value size.
+
+    Values smaller than ``threshold`` bytes, and values that don't get
+    any smaller when compressed, are stored as is.
+
+    """
+    size = len(value)
+    if size < threshold:
+        return value, size
+    codec_byte, compress = _COMPRESSORS[codec]
+    stored = codec_byte + compress(value)
+    if len(stored) >= size:
+        return value, size
+    return stored, -1 - len(stored)
+
+
+def decompress_value(stored):
+    codec_id = _CODEC_BYTE.unpack_from(stored)[0]
+    try:
+        decompress = _DECOMPRESSORS[codec_id]
+    except KeyError:
+        raise DBMError("Can't decompress value: unknown or unavailable "
+                       "compression codec %s" % codec_id)
+    return decompress(stored[1:])
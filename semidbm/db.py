@@ -10,15 +10,81 @@ import os
 import sys
 from binascii import crc32
 import struct
+import threading
+try:
+    import mmap
+except ImportError:
+    mmap = None
 
 from semidbm.exceptions import DBMLoadError, DBMChecksumError, DBMError
 from semidbm.loaders import _DELETED, FILE_FORMAT_VERSION, FILE_IDENTIFIER
+from semidbm.loaders import stored_size
+from semidbm.loaders import _BATCH_BEGIN, _BATCH_COMMIT, _BATCH_COMMIT_RECORD
 from semidbm import compat
+from semidbm import compression
+from semidbm import hint
+from semidbm import parallel
+from semidbm import scrub
+from semidbm.batch import WriteBatch
+from semidbm.cache import LRUCache
+from semidbm.compaction import CompactionHandle
+from semidbm.metrics import Metrics
+from semidbm.index import CompactIndex, SortedIndex
+if mmap is not None:
+    from semidbm import diskindex
 
 
 _open = compat.file_open
 
 
+def _pack_entry(key, value, size=None, len=len, crc32=crc32,
+                pack=struct.pack):
+    # <keysize><valsize><key><val><keyvalcksum>
+    # size is only given for compressed values.
+    if size is None:
+        size = len(value)
+    keyval = key + value
+    return (pack('!ii', len(key), size) + keyval +
+            pack('!I', crc32(keyval) & 0xffffffff))
+
+
+def _pack_delete(key, len=len, crc32=crc32, pack=struct.pack):
+    # <keysize><-1><key><keycksum>
+    return (pack('!ii', len(key), _DELETED) + key +
+            pack('!I', crc32(key) & 0xffffffff))
+
+
+def _pack_batch(body, count, pack=struct.pack):
+    # <-2><entriessize><entries><-3><count><entriescksum>
+    return (pack('!ii', _BATCH_BEGIN, len(body)) + body +
+            _BATCH_COMMIT_RECORD.pack(_BATCH_COMMIT, count,
+                                      crc32(body) & 0xffffffff))
+
+
+def _write_all(fd, data):
+    # os.write() can write less than requested for very large writes.
+    written = os.write(fd, data)
+    if written < len(data):
+        view = memoryview(data)
+        while written < len(data):
+            written += os.write(fd, view[written:])
+
+
+# Reads of values for get_many() that are at most this many bytes
+# apart are merged into a single read, as long as the merged read
+# is no larger than _MAX_COALESCED_READ bytes.
+_COALESCE_GAP = 4096
+_MAX_COALESCED_READ = 1024 * 1024
+# items() and itervalues() read the data file in chunks of up to
+# _STREAM_READ_SIZE bytes, reading through up to _STREAM_GAP bytes of
+# superseded entries rather than seeking over them.
+_STREAM_GAP = 64 * 1024
+_STREAM_READ_SIZE = 4 * 1024 * 1024
+_MISSING_POLICIES = ('raise', 'skip', 'default')
+# The size of the entries of a batch is stored as a signed 32 bit int.
+_MAX_BATCH_SIZE = 2 ** 31 - 1
+
+
 class _SemiDBM(object):
     """
 
@@ -26,35 +92,99 @@ class _SemiDBM(object):
         does not exist it will be created.
 
     """
+    # The mixins the class was composed with (see _db_class()).
+    _mixins = ()
+
     def __init__(self, dbdir, renamer, data_loader=None,
-                 verify_checksums=False):
+                 verify_checksums=False, hint_file=False, index_factory=dict,
+                 compression=None,
+                 compression_threshold=compression.DEFAULT_THRESHOLD,
+                 load_workers=0, fdatasync=False):
         self._renamer = renamer
         self._data_loader = data_loader
         self._dbdir = dbdir
         self._data_filename = os.path.join(dbdir, 'data')
+        self._hint_filename = os.path.join(dbdir, 'hint')
+        self._boundaries_filename = os.path.join(dbdir, 'boundaries')
         # The in memory index, mapping of key to (offset, size).
         self._index = None
+        self._index_factory = index_factory
         self._data_fd = None
         self._verify_checksums = verify_checksums
+        self._hint_file = hint_file
+        self._load_workers = load_workers
+        self._compression = compression
+        self._compression_threshold = compression_threshold
+        # fdatasync() skips flushing metadata that isn't needed to read
+        # the data back (such as the modification time).
+        self._fdatasync = fdatasync
+        if fdatasync and hasattr(os, 'fdatasync'):
+            self._fsync = os.fdatasync
+        else:
+            self._fsync = os.fsync
+        # Whether values written to the current data file are compressed.
+        self._compress_values = False
+        # Whether the current data file supports atomic batches.
+        self._atomic_batches = False
         self._current_offset = 0
+        # The data offset covered by the hint file on disk, if any.
+        self._hint_offset = None
+        # The offset just past the last entry replayed into the index
+        # when it was loaded, or None if it isn't known.
+        self._loaded_offset = None
+        # The number of bytes of superseded entries and deletes in the
+        # data file.  They're counted the first time they're needed (see
+        # space_stats()), until then this is None and writes don't
+        # update it.
+        self._dead_bytes = None
+        # The CompactionHandle of a running background compaction.
+        self._compaction = None
         self._load_db()
 
     def _create_db_dir(self):
         if not os.path.exists(self._dbdir):
             os.makedirs(self._dbdir)
 
+    def _verify_db_exists(self):
+        if not os.path.isfile(self._data_filename):
+            raise DBMError("Not a file: %s" % self._data_filename)
+
+    def _remove_files_in_dbdir(self):
+        # We want to create a new DB so we need to remove
+        # any of the existing files in the dbdir.
+        if os.path.exists(self._data_filename):
+            os.remove(self._data_filename)
+        hint.remove_hint(self._hint_filename)
+        parallel.remove_boundaries(self._boundaries_filename)
+
     def _load_db(self):
         self._create_db_dir()
         self._index = self._load_index(self._data_filename)
         self._data_fd = os.open(self._data_filename, compat.DATA_OPEN_FLAGS)
         self._current_offset = os.lseek(self._data_fd, 0, os.SEEK_END)
+        self._compress_values = self._can_compress(self._data_filename)
+        self._atomic_batches = self._can_write_batches(self._data_filename)
+        self._truncate_torn_tail()
+
+    def _truncate_torn_tail(self):
+        # An interrupted write (such as a batch without its commit
+        # record) at the end of the data file isn't loaded.  It's
+        # truncated so that new entries aren't appended after it, where
+        # the loaders would try to parse them as part of it.
+        loaded = self._loaded_offset
+        if loaded is not None and loaded < self._current_offset:
+            os.ftruncate(self._data_fd, loaded)
+            self._current_offset = loaded
 
     def _load_index(self, filename):
         # This method is only used upon instantiation to populate
         # the in memory index.
+        self._hint_offset = None
+        self._loaded_offset = None
         if not os.path.exists(filename):
             self._write_headers(filename)
-            return {}
+            self._loaded_offset = 8
+            return self._index_factory()
         try:
             return self._load_index_from_fileobj(filename)
         except ValueError as e:
@@ -67,37 +197,402 @@ class _SemiDBM(object):
             # File version format.
             f.write(struct.pack('!HH', *FILE_FORMAT_VERSION))
 
+    def _can_compress(self, filename):
+        # Compressed values can only be written to a data file in a
+        # format version that supports them.  Older data files are
+        # upgraded to the current version when they're compacted.
+        if self._compression is None:
+            return False
+        return self._file_format_major_version(filename) >= 2
+
+    def _can_write_batches(self, filename):
+        # Likewise, batches are only written with begin and commit
+        # records to a data file in a version that supports them.
+        return self._file_format_major_version(filename) >= 3
+
+    def _file_format_major_version(self, filename):
+        with _open(filename, 'rb') as f:
+            header = f.read(8)
+        return struct.unpack('!HH', header[4:8])[0]
+
     def _load_index_from_fileobj(self, filename):
-        index = {}
-        for key_name, offset, size in self._data_loader.iter_keys(filename):
-            size = int(size)
-            offset = int(offset)
-            if size == _DELETED:
-                # This is a deleted item so we need to make sure that this
-                # value is not in the index.  We know that the key is already
-                # in the index, because a delete is only written to the index
-                # if the key already exists in the db.
-                del index[key_name]
-            else:
-                if key_name in index:
-                    index[key_name] = (offset, size)
-                else:
-                    index[key_name] = (offset, size)
+        index = self._index_factory()
+        # If there's a usable hint file we only need to replay
+        # the entries written after the hint file was written.
+        start_offset = hint.load_hint(self._hint_filename, filename, index)
+        self._hint_offset = start_offset
+        if self._should_load_in_parallel(filename, start_offset):
+            return self._load_index_in_parallel(filename, index,
+                                                start_offset or 8)
+        self._loaded_offset = self._data_loader.load_index(
+            filename, index, start_offset)
         return index
 
-    def __getitem__(self, key, read=os.read, lseek=os.lseek,
-                    seek_set=os.SEEK_SET, str_type=compat.str_type,
-                    isinstance=isinstance):
-        if isinstance(key, str_type):
-            key = key.encode('utf-8')
+    def _should_load_in_parallel(self, filename, start_offset):
+        if self._load_workers < 2 or not parallel.can_load_in_parallel():
+            return False
+        remaining = os.path.getsize(filename) - (start_offset or 8)
+        return remaining >= parallel.MIN_PARALLEL_SIZE
+
+    def _load_index_in_parallel(self, filename, index, start_offset):
+        self._loaded_offset, new_boundaries = parallel.load_index(
+            filename, index, start_offset, self._load_workers,
+            self._boundaries_filename)
+        if new_boundaries is not None:
+            self._write_boundaries_file(*new_boundaries)
+        return index
+
+    def _index_loaded(self):
+        # Called once an index that was loaded in the background
+        # has been assigned to self._index.
+        pass
+
+    @property
+    def loaded(self):
+        """Whether the index of the db has been loaded."""
+        return True
+
+    def wait_loaded(self, timeout=None):
+        """Wait for the index of the db to be loaded.
+
+        This only blocks if the db was opened with ``lazy=True``.  If
+        loading the index failed, the error is raised.
+
+        :param timeout: The maximum number of seconds to wait, or None
+            to wait until the index is loaded.
+
+        :returns: True if the index is loaded, False if the timeout
+            expired first.
+
+        """
+        return True
+
+    def _write_boundaries_file(self, boundaries, covered_offset):
+        parallel.write_boundaries(self._boundaries_filename, boundaries,
+                                  self._data_filename, covered_offset,
+                                  self._renamer)
+
+    if compat.pread is not None:
+        def __getitem__(self, key, pread=compat.pread,
+                        str_type=compat.str_type, isinstance=isinstance):
+            if isinstance(key, str_type):
+                key = key.encode('utf-8')
+            offset, size = self._index[key]
+            if size < 0:
+                return self._read_compressed(key, offset, size, self._read_at)
+            if not self._verify_checksums:
+                return pread(self._data_fd, size, offset)
+            else:
+                # Checksum is at the end of the value.
+                data = pread(self._data_fd, size + 4, offset)
+                return self._verify_checksum_data(key, data)
+    else:
+        def __getitem__(self, key, read=os.read, lseek=os.lseek,
+                        seek_set=os.SEEK_SET, str_type=compat.str_type,
+                        isinstance=isinstance):
+            if isinstance(key, str_type):
+                key = key.encode('utf-8')
+            offset, size = self._index[key]
+            if size < 0:
+                return self._read_compressed(key, offset, size, self._read_at)
+            lseek(self._data_fd, offset, seek_set)
+            if not self._verify_checksums:
+                return read(self._data_fd, size)
+            else:
+                # Checksum is at the end of the value.
+                data = read(self._data_fd, size + 4)
+                return self._verify_checksum_data(key, data)
+
+    if compat.pread is not None:
+        def _read_at(self, offset, size):
+            return compat.pread(self._data_fd, size, offset)
+    else:
+        def _read_at(self, offset, size):
+            os.lseek(self._data_fd, offset, os.SEEK_SET)
+            return os.read(self._data_fd, size)
+
+    def _read_value(self, key):
+        # Reads the value of key straight from the data file, bypassing
+        # the mixins (and the locks they may already be holding).
         offset, size = self._index[key]
-        lseek(self._data_fd, offset, seek_set)
+        if size < 0:
+            return self._read_compressed(key, offset, size, self._read_at)
+        if not self._verify_checksums:
+            return self._read_at(offset, size)
+        return self._verify_checksum_data(key, self._read_at(offset,
+                                                             size + 4))
+
+    def _read_compressed(self, key, offset, size, read_at):
+        size = stored_size(size)
         if not self._verify_checksums:
-            return read(self._data_fd, size)
+            return compression.decompress_value(read_at(offset, size))
         else:
-            # Checksum is at the end of the value.
-            data = read(self._data_fd, size + 4)
-            return self._verify_checksum_data(key, data)
+            return compression.decompress_value(
+                self._verify_checksum_data(key, read_at(offset, size + 4)))
+
+    def get_many(self, keys, missing='raise', default=None):
+        """Return a dict of the values for multiple keys.
+
+        The values are read in the order they appear in the data file,
+        and values that are close to each other in the data file are
+        read with a single read.
+
+        :param keys: An iterable of keys.
+
+        :param missing: What to do when a key does not exist.  ``'raise'``
+            (the default) raises a ``KeyError``, ``'skip'`` leaves the key
+            out of the returned dict, and ``'default'`` maps the key to
+            ``default``.
+
+        """
+        return self._get_many(keys, missing, default, self._index,
+                              self._read_at)
+
+    def _get_many(self, keys, missing, default, index, read_at,
+                  str_type=compat.str_type, isinstance=isinstance):
+        if missing not in _MISSING_POLICIES:
+            raise ValueError("missing argument must be one of: %s" %
+                             ', '.join(_MISSING_POLICIES))
+        values = {}
+        locations = []
+        for key in keys:
+            if isinstance(key, str_type):
+                key = key.encode('utf-8')
+            location = index.get(key)
+            if location is None:
+                if missing == 'raise':
+                    raise KeyError(key)
+                elif missing == 'default':
+                    values[key] = default
+            else:
+                locations.append((location[0], stored_size(location[1]),
+                                  key, location[1] < 0))
+        locations.sort()
+        for key, value in self._read_locations(
+                locations, read_at, _COALESCE_GAP, _MAX_COALESCED_READ):
+            values[key] = value
+        return values
+
+    def _read_locations(self, locations, read_at, max_gap, max_read):
+        # Yields the (key, value) pairs of a list of
+        # (offset, stored size, key, compressed) sorted by offset.
+        # Values that are at most max_gap bytes apart are read with a
+        # single read of at most max_read bytes.
+        verify_checksums = self._verify_checksums
+        # The checksum is stored right after the value.
+        extra = 4 if verify_checksums else 0
+        i = 0
+        while i < len(locations):
+            start = locations[i][0]
+            end = start + locations[i][1] + extra
+            j = i + 1
+            while j < len(locations):
+                offset, size = locations[j][:2]
+                if (offset - end > max_gap or
+                        offset + size + extra - start > max_read):
+                    break
+                end = max(end, offset + size + extra)
+                j += 1
+            data = read_at(start, end - start)
+            for offset, size, key, compressed in locations[i:j]:
+                value = data[offset - start:offset - start + size + extra]
+                if verify_checksums:
+                    value = self._verify_checksum_data(key, value)
+                if compressed:
+                    value = compression.decompress_value(value)
+                yield key, value
+            i = j
+
+    def set_many(self, items, str_type=compat.str_type,
+                 isinstance=isinstance, len=len):
+        """Set multiple keys with a single write.
+
+        :param items: A mapping or an iterable of ``(key, value)`` pairs.
+
+        """
+        if hasattr(items, 'items'):
+            items = items.items()
+        blobs = []
+        locations = []
+        offset = self._current_offset
+        for key, value in items:
+            if isinstance(key, str_type):
+                key = key.encode('utf-8')
+            if isinstance(value, str_type):
+                value = value.encode('utf-8')
+            value, size = self._encode_value(value)
+            blob = _pack_entry(key, value, size)
+            blobs.append(blob)
+            locations.append((key, (offset + 8 + len(key), size)))
+            offset += len(blob)
+        if not blobs:
+            return
+        _write_all(self._data_fd, b''.join(blobs))
+        index = self._index
+        for key, location in locations:
+            if self._dead_bytes is not None:
+                self._supersede(key)
+            index[key] = location
+        self._current_offset = offset
+
+    def delete_many(self, keys, missing='raise', str_type=compat.str_type,
+                    isinstance=isinstance):
+        """Delete multiple keys with a single write.
+
+        :param missing: What to do when a key does not exist.  ``'raise'``
+            (the default) raises a ``KeyError`` before anything is
+            deleted, ``'skip'`` ignores the key.
+
+        """
+        if missing not in ('raise', 'skip'):
+            raise ValueError("missing argument must be 'raise' or 'skip'")
+        index = self._index
+        to_delete = []
+        seen = set()
+        for key in keys:
+            if isinstance(key, str_type):
+                key = key.encode('utf-8')
+            if key in seen:
+                continue
+            if key not in index:
+                if missing == 'raise':
+                    raise KeyError(key)
+                continue
+            seen.add(key)
+            to_delete.append(key)
+        if not to_delete:
+            return
+        blob = b''.join([_pack_delete(key) for key in to_delete])
+        _write_all(self._data_fd, blob)
+        if self._dead_bytes is not None:
+            self._dead_bytes += len(blob)
+        for key in to_delete:
+            if self._dead_bytes is not None:
+                self._supersede(key)
+            del index[key]
+        self._current_offset += len(blob)
+
+    def batch(self):
+        """Return a ``WriteBatch`` for writing multiple keys atomically.
+
+        The batch is meant to be used as a context manager::
+
+            with db.batch() as batch:
+                batch['foo'] = 'bar'
+                del batch['baz']
+
+        The writes of the batch are appended to the data file with a
+        single write, followed by a commit record.  If the write is
+        interrupted, none of the writes of the batch are loaded the next
+        time the db is opened.  Data files written by older versions of
+        semidbm don't support commit records (until they're compacted),
+        batches are written to them without one, so they're only written
+        with a single write.
+
+        """
+        return WriteBatch(self)
+
+    def _write_batch(self, writes, len=len):
+        # writes maps keys to values, or to None for deletes.
+        index = self._index
+        atomic = self._atomic_batches
+        blobs = []
+        locations = []
+        start = self._current_offset
+        offset = start
+        if atomic:
+            # The begin record.
+            offset += 8
+        for key, value in writes.items():
+            if value is None:
+                if key not in index:
+                    # The key was deleted after it was deleted in the
+                    # batch.
+                    continue
+                blob = _pack_delete(key)
+                location = None
+            else:
+                value, size = self._encode_value(value)
+                blob = _pack_entry(key, value, size)
+                location = (offset + 8 + len(key), size)
+            blobs.append(blob)
+            locations.append((key, location))
+            offset += len(blob)
+        if not blobs:
+            return
+        data = b''.join(blobs)
+        if atomic:
+            if len(data) > _MAX_BATCH_SIZE:
+                raise ValueError("Batch is too large (%s bytes)" % len(data))
+            entries_size = len(data)
+            data = _pack_batch(data, len(blobs))
+        _write_all(self._data_fd, data)
+        counting = self._dead_bytes is not None
+        if counting and atomic:
+            self._dead_bytes += len(data) - entries_size
+        for key, location in locations:
+            if counting:
+                self._supersede(key)
+            if location is None:
+                del index[key]
+                if counting:
+                    # <keysize><-1><key><keycksum>
+                    self._dead_bytes += 12 + len(key)
+            else:
+                index[key] = location
+        self._current_offset = start + len(data)
+
+    def _encode_value(self, value):
+        # Returns the bytes to write for value, and its value size.
+        if self._compress_values:
+            return compression.compress_value(
+                value, self._compression, self._compression_threshold)
+        return value, len(value)
+
+    def _supersede(self, key, len=len):
+        # Counts the current entry of key (if there is one) as dead,
+        # called before the entry is replaced or deleted.
+        location = self._index.get(key)
+        if location is not None:
+            # <keysize><valsize><key><val><keyvalcksum>
+            self._dead_bytes += 12 + len(key) + stored_size(location[1])
+
+    def _data_end(self):
+        # A read only db may have loaded entries past the offset it was
+        # opened at.
+        return max(self._current_offset, self._loaded_offset or 0)
+
+    def _count_dead_bytes(self):
+        live_bytes = 0
+        for key, location in self._index.items():
+            live_bytes += 12 + len(key) + stored_size(location[1])
+        # The 8 byte file header isn't counted.
+        return self._data_end() - 8 - live_bytes
+
+    def space_stats(self):
+        """Return a dict describing how much of the data file is in use.
+
+        The dict contains the ``size`` of the data file in bytes, the
+        number of ``live_bytes`` (the entries of the current value of each
+        key), the number of ``dead_bytes`` (entries that were overwritten
+        or deleted, and the deletes themselves), and the ``dead_ratio``
+        of dead bytes to the total size of the entries.  Compacting the
+        db reclaims the dead bytes.
+
+        The first call counts the live bytes in the index, after that
+        the counts are kept up to date by every write.
+
+        """
+        if self._dead_bytes is None:
+            self._dead_bytes = self._count_dead_bytes()
+        size = self._data_end()
+        total = size - 8
+        return {
+            'size': size,
+            'live_bytes': total - self._dead_bytes,
+            'dead_bytes': self._dead_bytes,
+            'dead_ratio': self._dead_bytes / float(total) if total else 0.0,
+        }
 
     def _verify_checksum_data(self, key, data):
         # key is the bytes of the key,
@@ -124,13 +619,19 @@ class _SemiDBM(object):
         # <keysize><valsize><key><val><keyvalcksum>
         # Everything except for the actual checksum + value
         key_size = len(key)
-        val_size = len(value)
+        if self._compress_values:
+            value, val_size = compression.compress_value(
+                value, self._compression, self._compression_threshold)
+        else:
+            val_size = len(value)
         keyval_size = pack('!ii', key_size, val_size)
         keyval = key + value
         checksum = pack('!I', crc32(keyval) & 0xffffffff)
         blob = keyval_size + keyval + checksum
 
         write(self._data_fd, blob)
+        if self._dead_bytes is not None:
+            self._supersede(key)
         # Update the in memory index.
         self._index[key] = (self._current_offset + 8 + key_size,
                             val_size)
@@ -149,6 +650,9 @@ class _SemiDBM(object):
         blob = key_size + key + crc
 
         write(self._data_fd, blob)
+        if self._dead_bytes is not None:
+            self._supersede(key)
+            self._dead_bytes += len(blob)
         del self._index[key]
         self._current_offset += len(blob)
 
@@ -165,8 +669,173 @@ class _SemiDBM(object):
         return self._index.keys()
 
     def values(self):
+        """Return all the values in the db, in the order of ``keys()``.
+
+        Use ``itervalues()`` to read the values in data file order.
+
+        """
         return [self[key] for key in self._index]
 
+    def items(self):
+        """Iterate over the ``(key, value)`` pairs of the db.
+
+        The pairs are visited in the order their values appear in the
+        data file, and the data file is read sequentially in large
+        chunks, so iterating over a whole db doesn't do a random read
+        per key.  Only one chunk of values is held in memory at a time.
+
+        The keys are taken from a snapshot of the index when
+        ``items()`` is called, writes made during the iteration aren't
+        seen.  Unless the db was opened with ``thread_safe=True``, the
+        db must not be compacted or refreshed during the iteration.
+
+        """
+        locations, read_at, advise = self._stream_snapshot()
+        return self._iter_stream(locations, read_at, advise)
+
+    def itervalues(self):
+        """Iterate over the values of the db (see ``items()``)."""
+        return (value for key, value in self.items())
+
+    def _stream_snapshot(self):
+        # Returns the locations of the live values sorted by offset (see
+        # _read_locations()), a read_at(offset, size) function that
+        # reads from the current data file, and a function that tells
+        # the OS whether the data file is being read sequentially.
+        locations = [(location[0], stored_size(location[1]), key,
+                      location[1] < 0)
+                     for key, location in self._index.items()]
+        locations.sort()
+        data_fd = self._data_fd
+        if compat.pread is not None:
+            def read_at(offset, size, pread=compat.pread):
+                return pread(data_fd, size, offset)
+        else:
+            def read_at(offset, size):
+                os.lseek(data_fd, offset, os.SEEK_SET)
+                return os.read(data_fd, size)
+
+        def advise(sequential):
+            compat.advise_sequential(data_fd, sequential)
+        return locations, read_at, advise
+
+    def _iter_stream(self, locations, read_at, advise):
+        if advise is not None:
+            advise(True)
+        try:
+            for item in self._read_locations(locations, read_at,
+                                             _STREAM_GAP, _STREAM_READ_SIZE):
+                yield item
+        finally:
+            if advise is not None:
+                advise(False)
+
+    def iter_range(self, start=None, stop=None, reverse=False, items=False):
+        """Iterate over the keys from ``start`` up to ``stop`` in order.
+
+        This requires a db opened with ``index='sorted'``.
+
+        :param start: The first key (inclusive), or None to start at
+            the smallest key.
+
+        :param stop: The end key (exclusive), or None to continue to
+            the largest key.
+
+        :param reverse: Iterate from the largest key to the smallest.
+
+        :param items: Iterate over ``(key, value)`` pairs instead of keys.
+
+        """
+        keys = self._ordered_index().iter_range(
+            self._encode_key(start), self._encode_key(stop), reverse)
+        return self._iter_ordered(keys, items)
+
+    def iter_prefix(self, prefix, reverse=False, items=False):
+        """Iterate over the keys that start with ``prefix`` in order.
+
+        This requires a db opened with ``index='sorted'``, the
+        arguments are the same as for ``iter_range()``.
+
+        """
+        keys = self._ordered_index().iter_prefix(
+            self._encode_key(prefix), reverse)
+        return self._iter_ordered(keys, items)
+
+    def _encode_key(self, key):
+        if isinstance(key, compat.str_type):
+            return key.encode('utf-8')
+        return key
+
+    def _ordered_index(self):
+        index = self._index
+        if not hasattr(index, 'iter_range'):
+            raise DBMError("Ordered iteration requires index='sorted'.")
+        return index
+
+    def _iter_ordered(self, keys, items):
+        if not items:
+            return keys
+        return self._iter_ordered_items(keys)
+
+    def export_frozen(self, filename):
+        """Write a frozen snapshot of the db to ``filename``.
+
+        The snapshot is a single file with the live keys and values of
+        the db and a precomputed hash table of the keys.  It can be
+        opened with ``semidbm.frozen.open()``, which doesn't need to
+        load an index.
+
+        """
+        from semidbm import frozen
+        frozen.write_frozen(filename, list(self._index.items()),
+                            self.get_many, self._renamer)
+
+    def verify(self, include_superseded=False, workers=0,
+               progress_callback=None):
+        """Verify the checksum of every entry in the data file.
+
+        The data file is read sequentially with large reads rather than
+        reading each value separately, see ``semidbm.scrub`` for the
+        details.  Entries written while the db is verified aren't
+        verified.
+
+        :param include_superseded: Also verify the entries that were
+            overwritten or deleted (defaults to False, which only
+            verifies the current value of each key).
+
+        :param workers: Verify large data files with this many processes
+            (defaults to 0, which verifies the data file in the current
+            process).
+
+        :param progress_callback: An optional callable that is called
+            with the number of bytes verified so far and the total
+            number of bytes to verify.
+
+        :returns: A list of ``(offset, key)`` for each corrupt entry,
+            where ``offset`` is the offset of the entry in the data file.
+            The key is None if the entry's header is corrupt.
+
+        """
+        end_offset, locations = self._verify_snapshot()
+        return scrub.verify_file(
+            self._data_filename, end_offset, locations,
+            include_superseded=include_superseded, workers=workers,
+            progress_callback=progress_callback)
+
+    def _verify_snapshot(self):
+        # The end of the entries to verify and the locations of the
+        # live keys.
+        return self._data_end(), list(self._index.items())
+
+    def _iter_ordered_items(self, keys):
+        for key in keys:
+            try:
+                value = self[key]
+            except KeyError:
+                # Deleted while iterating.
+                continue
+            yield key, value
+
     def close(self, compact=False):
         """Close the db.
 
@@ -177,10 +846,18 @@ class _SemiDBM(object):
         :param compact: Indicate whether or not to compact the db
             before closing the db.
 
+        If a background compaction is running, this method waits for
+        it to finish.
+
         """
+        if self._compaction is not None:
+            self._compaction.wait()
         if compact:
             self.compact()
         self.sync()
+        self._close_data_fd()
+
+    def _close_data_fd(self):
         os.close(self._data_fd)
 
     def sync(self):
@@ -196,7 +873,40 @@ class _SemiDBM(object):
         """
         # The files are opened unbuffered so we don't technically
         # need to flush the file objects.
-        os.fsync(self._data_fd)
+        self._fsync(self._data_fd)
+        if self._hint_file:
+            self._write_hint_file()
+
+    def wait_durable(self, timeout=None):
+        """Wait for everything written so far to be on disk.
+
+        With the default ``durability='os'`` this syncs the db.  With
+        ``durability='group'`` this waits for the background thread to
+        sync the writes made before the call (see ``open()``).
+
+        :param timeout: The maximum number of seconds to wait, or None
+            to wait until the writes are synced.
+
+        :returns: True if the writes are on disk, False if the timeout
+            expired first.
+
+        """
+        self.sync()
+        return True
+
+    def _written_offset(self):
+        # The offset of the end of everything written to the db, once
+        # it's in the data file.
+        return self._current_offset
+
+    def _write_hint_file(self):
+        if self._hint_offset == self._current_offset:
+            # Nothing has been written since the last hint file.
+            return
+        hint.write_hint(self._hint_filename, self._index,
+                        self._data_filename, self._current_offset,
+                        self._renamer)
+        self._hint_offset = self._current_offset
 
     def compact(self):
         """Compact the db to reduce space.
@@ -216,47 +926,304 @@ class _SemiDBM(object):
         # reopening the files associated with this db.  This
         # implementation can certainly be more efficient, but compaction
         # is really slow anyways.
-        new_db = self.__class__(os.path.join(self._dbdir, 'compact'),
-                                data_loader=self._data_loader,
-                                renamer=self._renamer)
+        if self._compaction is not None:
+            raise DBMError("Can't compact: a background compaction "
+                           "is in progress.")
+        new_db = self._compaction_db_class()(
+            os.path.join(self._dbdir, 'compact'),
+            data_loader=self._data_loader, renamer=self._renamer,
+            compression=self._compression,
+            compression_threshold=self._compression_threshold,
+            fdatasync=self._fdatasync)
         for key in self._index:
-            new_db[key] = self[key]
+            new_db[key] = self._read_value(key)
         new_db.sync()
         new_db.close()
-        os.close(self._data_fd)
+        self._close_data_fd()
+        # The hint and boundaries files describe the old data file, so
+        # they have to be removed before the new data file is renamed
+        # into place.
+        hint.remove_hint(self._hint_filename)
+        parallel.remove_boundaries(self._boundaries_filename)
         self._renamer(new_db._data_filename, self._data_filename)
-        os.rmdir(new_db._dbdir)
+        self._remove_compact_dir(new_db._dbdir)
         # The index is already compacted so we don't need to compact it.
         self._load_db()
+        if self._dead_bytes is not None:
+            # The compacted data file only has live entries.
+            self._dead_bytes = 0
+
+    def _compaction_db_class(self):
+        # The class of the db that the live entries are copied to.
+        return self.__class__
+
+    def _remove_compact_dir(self, compact_dir):
+        os.rmdir(compact_dir)
+
+    def compact_async(self, progress_callback=None):
+        """Compact the db in a background thread.
+
+        The db can be read from and written to while the compaction is
+        running.  Anything written to the db after the compaction started
+        is carried over to the compacted data file before it replaces the
+        original data file.
+
+        :param progress_callback: An optional callable that is called
+            (from the background thread) with the number of keys copied
+            so far and the total number of keys to copy.
+
+        :returns: A ``CompactionHandle`` that can be used to wait for,
+            monitor, or cancel the compaction.  If the db was not opened
+            in thread safe mode, the compacted data file is only swapped
+            in when ``wait()`` is called on the handle (or the db is
+            closed).
+
+        """
+        if self._compaction is not None:
+            raise DBMError("Can't compact: a background compaction "
+                           "is already in progress.")
+        compaction = CompactionHandle(self, list(self._index.items()),
+                                      self._current_offset,
+                                      progress_callback)
+        self._compaction = compaction
+        compaction.start()
+        return compaction
+
+    def _finish_background_compaction(self, compaction):
+        # Called from the compaction thread once the live entries have
+        # been copied.  Without a lock to block writers and readers, the
+        # new data file can only be swapped in from the thread using the
+        # db, which happens in CompactionHandle.wait().
+        pass
+
+    def _complete_compaction(self, compaction):
+        new_filename, index = compaction._finalize()
+        self._swap_data_file(new_filename, index)
+        compaction._mark_completed()
+        self._compaction = None
+
+    def _compaction_discarded(self, compaction):
+        if self._compaction is compaction:
+            self._compaction = None
+
+    def _swap_data_file(self, new_filename, index):
+        # Replace the data file with new_filename, whose entries
+        # are described by index.
+        self._close_data_fd()
+        hint.remove_hint(self._hint_filename)
+        parallel.remove_boundaries(self._boundaries_filename)
+        self._renamer(new_filename, self._data_filename)
+        self._data_fd = os.open(self._data_filename, compat.DATA_OPEN_FLAGS)
+        self._current_offset = os.lseek(self._data_fd, 0, os.SEEK_END)
+        self._compress_values = self._can_compress(self._data_filename)
+        self._atomic_batches = self._can_write_batches(self._data_filename)
+        self._index = index
+        self._hint_offset = None
+        # Entries written during a background compaction were copied
+        # as is, so they have to be counted again.
+        self._dead_bytes = None
 
 
 class _SemiDBMReadOnly(_SemiDBM):
+    def __init__(self, *args, **kwargs):
+        # Serializes refreshes, which replay into the index in place.
+        self._refresh_lock = threading.Lock()
+        super(_SemiDBMReadOnly, self).__init__(*args, **kwargs)
+
     def __delitem__(self, key):
         self._method_not_allowed('delitem')
 
     def __setitem__(self, key, value):
         self._method_not_allowed('setitem')
 
+    def set_many(self, items):
+        self._method_not_allowed('set_many')
+
+    def delete_many(self, keys, missing='raise'):
+        self._method_not_allowed('delete_many')
+
+    def batch(self):
+        self._method_not_allowed('batch')
+
     def sync(self):
         self._method_not_allowed('sync')
 
     def compact(self):
         self._method_not_allowed('compact')
 
+    def compact_async(self, progress_callback=None):
+        self._method_not_allowed('compact_async')
+
+    def _write_boundaries_file(self, boundaries, covered_offset):
+        # Nothing is written to the db directory in read only mode.
+        pass
+
+    def _truncate_torn_tail(self):
+        # A writer may still be appending to the data file.
+        pass
+
     def _method_not_allowed(self, method_name):
         raise DBMError("Can't %s: db opened in read only mode." % method_name)
 
+    def refresh(self):
+        """Load the entries written to the db since it was loaded.
+
+        Only the part of the data file appended since the last load or
+        refresh is read, and the index is updated in place.  An entry
+        that's still being written is loaded by the next refresh.  If
+        the data file was replaced since it was loaded (for example
+        because the db was compacted), the db is reloaded from the new
+        data file instead.
+
+        """
+        self.wait_loaded()
+        with self._refresh_lock:
+            current = os.fstat(self._data_fd)
+            try:
+                latest = os.stat(self._data_filename)
+            except OSError:
+                # The data file is being replaced, the next refresh
+                # picks up the new one.
+                return
+            if (self._loaded_offset is None or
+                    latest.st_ino != current.st_ino or
+                    latest.st_dev != current.st_dev or
+                    latest.st_size < self._loaded_offset):
+                self._reload()
+            elif latest.st_size > self._loaded_offset:
+                self._load_tail(latest.st_size)
+
+    def _load_tail(self, end_offset):
+        self._loaded_offset = self._data_loader.load_tail(
+            self._data_filename, self._index, self._loaded_offset,
+            end_offset)
+        self._dead_bytes = None
+
+    def _reload(self):
+        self._close_data_fd()
+        self._load_db()
+        self._dead_bytes = None
+
     def close(self, compact=False):
-        os.close(self._data_fd)
+        self._close_data_fd()
 
 
-class _SemiDBMReadWrite(_SemiDBM):
+class _SemiDBMReadOnlyMMap(_SemiDBMReadOnly):
+    """A read only db that reads values from a memory map of the data file.
+
+    The data file is mapped once when the db is loaded and stays mapped
+    until the db is closed, so reading a value doesn't require any
+    syscalls.  Reads can be done from multiple threads at once.  The
+    index only changes when the db is refreshed, refreshes are
+    serialized but update the index in place while it's being read.
+
+    """
+    def __init__(self, *args, **kwargs):
+        self._data_map = None
+        self._data_view = None
+        super(_SemiDBMReadOnlyMMap, self).__init__(*args, **kwargs)
+
     def _load_db(self):
-        if not os.path.isfile(self._data_filename):
-            raise DBMError("Not a file: %s" % self._data_filename)
+        super(_SemiDBMReadOnlyMMap, self)._load_db()
+        self._map_data_file()
+
+    def _map_data_file(self):
+        # Any previous map isn't closed, views returned from get_view()
+        # may still reference it.  It's closed once it's unreferenced.
+        self._data_map = mmap.mmap(self._data_fd, 0, access=mmap.ACCESS_READ)
+        try:
+            self._data_view = memoryview(self._data_map)
+        except TypeError:
+            # Python 2's mmap doesn't support the new buffer protocol,
+            # in which case slices of the mmap (copies) are returned.
+            self._data_view = self._data_map
+
+    def _load_tail(self, end_offset):
+        # The new entries have to be mapped before they're in the index.
+        self._map_data_file()
+        super(_SemiDBMReadOnlyMMap, self)._load_tail(len(self._data_map))
+
+    def __getitem__(self, key, str_type=compat.str_type,
+                    isinstance=isinstance):
+        if isinstance(key, str_type):
+            key = key.encode('utf-8')
+        offset, size = self._index[key]
+        if size < 0:
+            return self._read_compressed(key, offset, size, self._read_at)
+        if not self._verify_checksums:
+            return self._data_map[offset:offset + size]
+        else:
+            return self._verify_checksum_data(
+                key, self._data_map[offset:offset + size + 4])
+
+    def _read_at(self, offset, size):
+        return self._data_map[offset:offset + size]
+
+    def _stream_snapshot(self):
+        locations, read_at, advise = super(
+            _SemiDBMReadOnlyMMap, self)._stream_snapshot()
+        data_map = self._data_map
+
+        def read_at(offset, size):
+            return data_map[offset:offset + size]
+        # mmap.madvise() was added in python 3.8.
+        if hasattr(data_map, 'madvise'):
+            def advise(sequential):
+                if data_map.closed:
+                    return
+                if sequential:
+                    data_map.madvise(mmap.MADV_SEQUENTIAL)
+                else:
+                    data_map.madvise(mmap.MADV_NORMAL)
+        else:
+            advise = None
+        return locations, read_at, advise
+
+    def get_view(self, key):
+        """Return a memoryview of the value associated with a key.
+
+        The memoryview references the memory map of the data file
+        directly, so no data is copied.  The returned view must not
+        be used after the db is closed.  Compressed values can't be
+        referenced in place, so they're returned as (decompressed) bytes.
+
+        """
+        if isinstance(key, compat.str_type):
+            key = key.encode('utf-8')
+        offset, size = self._index[key]
+        if size < 0:
+            return self._read_compressed(key, offset, size, self._read_at)
+        if not self._verify_checksums:
+            return self._data_view[offset:offset + size]
+        else:
+            return self._verify_checksum_data(
+                key, self._data_view[offset:offset + size + 4])
+
+    def close(self, compact=False):
+        if self._data_view is not self._data_map:
+            self._data_view.release()
+        try:
+            self._data_map.close()
+        except BufferError:
+            # There are still views returned from get_view() that
+            # reference the mmap.  The mmap will be closed when the
+            # last of these views is released.
+            pass
+        self._data_view = None
+        self._data_map = None
+        super(_SemiDBMReadOnlyMMap, self).close(compact=compact)
 
+
+class _SemiDBMReadWrite(_SemiDBM):
+    def _load_db(self):
+        self._verify_db_exists()
         super(_SemiDBMReadWrite, self)._load_db()
 
+    def _compaction_db_class(self):
+        # The compacted db is written to a directory that doesn't exist
+        # yet, so it can't be opened like this one.
+        return _db_class(_SemiDBMNew, self._mixins)
+
 
 class _SemiDBMNew(_SemiDBM):
     def _load_db(self):
@@ -264,11 +1231,1394 @@ class _SemiDBMNew(_SemiDBM):
         self._remove_files_in_dbdir()
         super(_SemiDBMNew, self)._load_db()
 
+
+class _ThreadSafeMixin(object):
+    """Allows a db to be shared between threads.
+
+    Writes, syncs, and compactions are serialized with a lock.  Reads use
+    positional reads (``os.pread``) where available, so they never block
+    each other or writers.  Readers always look up the index and the data
+    file descriptor from a single ``_ReaderState`` which is swapped in
+    one step after a compaction.  The data file descriptor from before
+    the compaction is closed once the last reader still using it is
+    done, so a reader never reads from a closed (or reused) descriptor.
+
+    On platforms without ``os.pread``, reads are serialized with a
+    separate lock because they depend on the shared file position.
+
+    """
+    def __init__(self, *args, **kwargs):
+        self._write_lock = threading.RLock()
+        self._read_lock = None
+        if compat.pread is None:
+            self._read_lock = threading.Lock()
+        self._reader_state = None
+        # Replaced reader states whose data file descriptor may still be
+        # in use by a reader.
+        self._retired_states = []
+        super(_ThreadSafeMixin, self).__init__(*args, **kwargs)
+
+    def _load_db(self):
+        super(_ThreadSafeMixin, self)._load_db()
+        self._install_reader_state()
+
+    def _index_loaded(self):
+        self._reader_state.index = self._index
+
+    def _install_reader_state(self):
+        self._reader_state = _ReaderState(self._index, self._data_fd)
+        for state in self._retired_states:
+            state.retire()
+        self._retired_states = [state for state in self._retired_states
+                                if not state.closed]
+
+    def _close_data_fd(self):
+        # The descriptor is closed once the reader state that replaces
+        # this one is installed and no reader is using it anymore.
+        self._retired_states.append(self._reader_state)
+
+    def _acquire_reader_state(self):
+        while True:
+            state = self._reader_state
+            if state.acquire():
+                return state
+            # The state was closed after it was looked up, so a new
+            # one has been installed.
+
+    if compat.pread is not None:
+        def __getitem__(self, key, pread=compat.pread,
+                        str_type=compat.str_type, isinstance=isinstance):
+            if isinstance(key, str_type):
+                key = key.encode('utf-8')
+            state = self._acquire_reader_state()
+            try:
+                data_fd = state.fd
+                offset, size = state.index[key]
+                if size < 0:
+                    return self._read_compressed(
+                        key, offset, size,
+                        lambda offset, size: pread(data_fd, size, offset))
+                if not self._verify_checksums:
+                    return pread(data_fd, size, offset)
+                else:
+                    data = pread(data_fd, size + 4, offset)
+                    return self._verify_checksum_data(key, data)
+            finally:
+                state.release()
+
+        def get_many(self, keys, missing='raise', default=None,
+                     pread=compat.pread):
+            state = self._acquire_reader_state()
+            try:
+                data_fd = state.fd
+                return self._get_many(
+                    keys, missing, default, state.index,
+                    lambda offset, size: pread(data_fd, size, offset))
+            finally:
+                state.release()
+    else:
+        def __getitem__(self, key):
+            with self._read_lock:
+                return super(_ThreadSafeMixin, self).__getitem__(key)
+
+        def get_many(self, keys, missing='raise', default=None):
+            with self._read_lock:
+                return super(_ThreadSafeMixin, self).get_many(
+                    keys, missing, default)
+
+    def __setitem__(self, key, value):
+        with self._write_lock:
+            super(_ThreadSafeMixin, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        with self._write_lock:
+            super(_ThreadSafeMixin, self).__delitem__(key)
+
+    def set_many(self, items):
+        with self._write_lock:
+            super(_ThreadSafeMixin, self).set_many(items)
+
+    def delete_many(self, keys, missing='raise'):
+        with self._write_lock:
+            super(_ThreadSafeMixin, self).delete_many(keys, missing)
+
+    def _write_batch(self, writes):
+        with self._write_lock:
+            super(_ThreadSafeMixin, self)._write_batch(writes)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        # Return a copy so that callers can iterate over the keys while
+        # other threads are writing to the db.
+        with self._write_lock:
+            return list(self._index)
+
+    def values(self):
+        values = []
+        for key in self.keys():
+            try:
+                values.append(self[key])
+            except KeyError:
+                # Deleted by another thread.
+                pass
+        return values
+
+    def export_frozen(self, filename):
+        with self._write_lock:
+            super(_ThreadSafeMixin, self).export_frozen(filename)
+
+    def _verify_snapshot(self):
+        # Only the snapshot is taken with the lock held, writes can
+        # continue while the data file is verified.
+        with self._write_lock:
+            return super(_ThreadSafeMixin, self)._verify_snapshot()
+
+    def space_stats(self):
+        with self._write_lock:
+            return super(_ThreadSafeMixin, self).space_stats()
+
+    def _stream_snapshot(self):
+        # The data file of the snapshot is kept open until the stream
+        # is done, so it can still be read after a compaction.
+        with self._write_lock:
+            locations, read_at, advise = super(
+                _ThreadSafeMixin, self)._stream_snapshot()
+            state = self._acquire_reader_state()
+        unreleased_advise = advise
+
+        def advise(sequential):
+            # _iter_stream() calls advise(False) once it's done.
+            if sequential:
+                unreleased_advise(True)
+                return
+            try:
+                unreleased_advise(False)
+            finally:
+                state.release()
+        if compat.pread is None:
+            unlocked_read_at = read_at
+
+            def read_at(offset, size):
+                with self._read_lock:
+                    return unlocked_read_at(offset, size)
+        return locations, read_at, advise
+
+    def sync(self):
+        with self._write_lock:
+            super(_ThreadSafeMixin, self).sync()
+
+    def compact(self):
+        with self._write_lock:
+            if self._read_lock is None:
+                super(_ThreadSafeMixin, self).compact()
+            else:
+                with self._read_lock:
+                    super(_ThreadSafeMixin, self).compact()
+
+    def compact_async(self, progress_callback=None):
+        with self._write_lock:
+            return super(_ThreadSafeMixin, self).compact_async(
+                progress_callback)
+
+    def _finish_background_compaction(self, compaction):
+        # Writers are blocked while the last of the new entries are
+        # copied and the data file is swapped.  Readers keep using the
+        # old (index, fd) pair until the swap is done.
+        with self._write_lock:
+            if not compaction._cancel_requested.is_set():
+                self._complete_compaction(compaction)
+
+    def _load_tail(self, end_offset):
+        with self._write_lock:
+            super(_ThreadSafeMixin, self)._load_tail(end_offset)
+
+    def _reload(self):
+        with self._write_lock:
+            super(_ThreadSafeMixin, self)._reload()
+
+    def _swap_data_file(self, new_filename, index):
+        if self._read_lock is None:
+            super(_ThreadSafeMixin, self)._swap_data_file(new_filename, index)
+        else:
+            with self._read_lock:
+                super(_ThreadSafeMixin, self)._swap_data_file(
+                    new_filename, index)
+        self._install_reader_state()
+
+    def close(self, compact=False):
+        # Wait for a background compaction without holding the write
+        # lock, the compaction thread needs it to finish.
+        compaction = self._compaction
+        if compaction is not None:
+            compaction.wait()
+        with self._write_lock:
+            super(_ThreadSafeMixin, self).close(compact=compact)
+            for state in self._retired_states:
+                state.close()
+            self._retired_states = []
+
+
+class _ReaderState(object):
+    # An index and the data file descriptor it points into, along with
+    # the number of readers using them.  Once the state is retired, the
+    # descriptor is closed by the last reader to release it.
+    def __init__(self, index, fd):
+        self.index = index
+        self.fd = fd
+        self.closed = False
+        self._readers = 0
+        self._retired = False
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self.closed:
+                return False
+            self._readers += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self._readers -= 1
+            if self._retired and not self._readers:
+                self._close()
+
+    def retire(self):
+        with self._lock:
+            self._retired = True
+            if not self._readers:
+                self._close()
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _close(self):
+        if not self.closed:
+            self.closed = True
+            os.close(self.fd)
+
+
+_MISSING = object()
+
+
+class _BufferedWritesMixin(object):
+    """Buffers writes in memory and appends them with a single write.
+
+    Sets and deletes are kept in a dict of key to value (``None`` for a
+    delete) until either the number of buffered keys or the number of
+    encoded bytes reaches its limit, at which point the whole buffer is
+    encoded and written to the data file with one ``write()`` call.
+    Writes to the same key within one buffer collapse so only the last
+    value is written.  Reads of buffered keys are served from the buffer.
+
+    """
+    def __init__(self, *args, **kwargs):
+        self._write_buffer_size = kwargs.pop('write_buffer_size',
+                                             _DEFAULT_WRITE_BUFFER_SIZE)
+        self._write_buffer_count = kwargs.pop('write_buffer_count',
+                                              _DEFAULT_WRITE_BUFFER_COUNT)
+        self._pending = {}
+        self._pending_bytes = 0
+        super(_BufferedWritesMixin, self).__init__(*args, **kwargs)
+
+    def __getitem__(self, key, str_type=compat.str_type,
+                    isinstance=isinstance):
+        if isinstance(key, str_type):
+            key = key.encode('utf-8')
+        value = self._pending.get(key, _MISSING)
+        if value is _MISSING:
+            return super(_BufferedWritesMixin, self).__getitem__(key)
+        elif value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value, str_type=compat.str_type,
+                    isinstance=isinstance, len=len):
+        if isinstance(key, str_type):
+            key = key.encode('utf-8')
+        if isinstance(value, str_type):
+            value = value.encode('utf-8')
+        self._buffer(key, value, 12 + len(key) + len(value))
+
+    def __delitem__(self, key, str_type=compat.str_type,
+                    isinstance=isinstance):
+        if isinstance(key, str_type):
+            key = key.encode('utf-8')
+        pending = self._pending.get(key, _MISSING)
+        if pending is None or (pending is _MISSING and
+                               key not in self._index):
+            raise KeyError(key)
+        if key not in self._index:
+            # The key only exists in the buffer so there's
+            # nothing to write out.
+            self._unbuffer(key)
+        else:
+            self._buffer(key, None, 12 + len(key))
+
+    def get_many(self, keys, missing='raise', default=None):
+        values = {}
+        unbuffered = []
+        for key in keys:
+            if isinstance(key, compat.str_type):
+                key = key.encode('utf-8')
+            value = self._pending.get(key, _MISSING)
+            if value is _MISSING:
+                unbuffered.append(key)
+            elif value is not None:
+                values[key] = value
+            elif missing == 'raise':
+                raise KeyError(key)
+            elif missing == 'default':
+                values[key] = default
+        values.update(super(_BufferedWritesMixin, self).get_many(
+            unbuffered, missing, default))
+        return values
+
+    def set_many(self, items):
+        if hasattr(items, 'items'):
+            items = items.items()
+        for key, value in items:
+            self[key] = value
+
+    def delete_many(self, keys, missing='raise'):
+        if missing not in ('raise', 'skip'):
+            raise ValueError("missing argument must be 'raise' or 'skip'")
+        keys = [key.encode('utf-8') if isinstance(key, compat.str_type)
+                else key for key in keys]
+        if missing == 'raise':
+            for key in keys:
+                if key not in self:
+                    raise KeyError(key)
+        for key in keys:
+            if key in self:
+                del self[key]
+
+    def _write_batch(self, writes):
+        # Buffered writes come before the batch in the data file.
+        self.flush()
+        super(_BufferedWritesMixin, self)._write_batch(writes)
+
+    def _buffer(self, key, value, size):
+        if key in self._pending:
+            self._unbuffer(key)
+        self._pending[key] = value
+        self._pending_bytes += size
+        if (self._pending_bytes >= self._write_buffer_size or
+                len(self._pending) >= self._write_buffer_count):
+            self.flush()
+
+    def _unbuffer(self, key):
+        value = self._pending.pop(key)
+        self._pending_bytes -= 12 + len(key)
+        if value is not None:
+            self._pending_bytes -= len(value)
+
+    def __contains__(self, key):
+        if isinstance(key, compat.str_type):
+            key = key.encode('utf-8')
+        value = self._pending.get(key, _MISSING)
+        if value is _MISSING:
+            return key in self._index
+        return value is not None
+
+    def flush(self):
+        """Write all the buffered writes to the data file.
+
+        This doesn't fsync the data file, use ``sync()`` for that.
+
+        """
+        if not self._pending:
+            return
+        blobs = []
+        locations = []
+        offset = self._current_offset
+        for key, value in self._pending.items():
+            if value is None:
+                blob = _pack_delete(key)
+                # Deletes are recorded with the size of their blob.
+                locations.append((key, None, len(blob)))
+            else:
+                value, size = self._encode_value(value)
+                blob = _pack_entry(key, value, size)
+                locations.append((key, (offset + 8 + len(key), size), 0))
+            blobs.append(blob)
+            offset += len(blob)
+        _write_all(self._data_fd, b''.join(blobs))
+        index = self._index
+        for key, location, delete_size in locations:
+            if self._dead_bytes is not None:
+                self._supersede(key)
+                self._dead_bytes += delete_size
+            if location is None:
+                del index[key]
+            else:
+                index[key] = location
+        self._current_offset = offset
+        self._pending = {}
+        self._pending_bytes = 0
+
+    def __iter__(self):
+        self.flush()
+        return super(_BufferedWritesMixin, self).__iter__()
+
+    def _ordered_index(self):
+        self.flush()
+        return super(_BufferedWritesMixin, self)._ordered_index()
+
+    def export_frozen(self, filename):
+        self.flush()
+        super(_BufferedWritesMixin, self).export_frozen(filename)
+
+    def _verify_snapshot(self):
+        self.flush()
+        return super(_BufferedWritesMixin, self)._verify_snapshot()
+
+    def space_stats(self):
+        self.flush()
+        return super(_BufferedWritesMixin, self).space_stats()
+
+    def keys(self):
+        self.flush()
+        return super(_BufferedWritesMixin, self).keys()
+
+    def values(self):
+        self.flush()
+        return super(_BufferedWritesMixin, self).values()
+
+    def _stream_snapshot(self):
+        self.flush()
+        return super(_BufferedWritesMixin, self)._stream_snapshot()
+
+    def _written_offset(self):
+        self.flush()
+        return super(_BufferedWritesMixin, self)._written_offset()
+
+    def sync(self):
+        self.flush()
+        super(_BufferedWritesMixin, self).sync()
+
+    def compact(self):
+        self.flush()
+        super(_BufferedWritesMixin, self).compact()
+
+    def _complete_compaction(self, compaction):
+        # Buffered writes need to be in the data file before
+        # the final catch up of the compaction.
+        self.flush()
+        super(_BufferedWritesMixin, self)._complete_compaction(compaction)
+
+
+class _CachedReadsMixin(object):
+    """Caches recently read values in memory.
+
+    Values are cached by ``__getitem__`` and ``get_many`` in an
+    ``LRUCache`` bounded by ``cache_size`` bytes.  Cached values are
+    returned without reading the data file (or verifying the checksum
+    again).  Every write to a key removes it from the cache, and the
+    whole cache is cleared when the data file is replaced by a
+    compaction.
+
+    """
+    def __init__(self, *args, **kwargs):
+        self._cache = LRUCache(kwargs.pop('cache_size', 0))
+        super(_CachedReadsMixin, self).__init__(*args, **kwargs)
+
+    def __getitem__(self, key, str_type=compat.str_type,
+                    isinstance=isinstance):
+        if isinstance(key, str_type):
+            key = key.encode('utf-8')
+        value = self._cache.get(key)
+        if value is None:
+            value = super(_CachedReadsMixin, self).__getitem__(key)
+            self._cache.put(key, value)
+        return value
+
+    def get_many(self, keys, missing='raise', default=None):
+        if missing not in _MISSING_POLICIES:
+            raise ValueError("missing argument must be one of: %s" %
+                             ', '.join(_MISSING_POLICIES))
+        cache = self._cache
+        values = {}
+        uncached = []
+        for key in keys:
+            if isinstance(key, compat.str_type):
+                key = key.encode('utf-8')
+            value = cache.get(key)
+            if value is None:
+                uncached.append(key)
+            else:
+                values[key] = value
+        # Missing keys are handled here so that default values
+        # never end up in the cache.
+        read = super(_CachedReadsMixin, self).get_many(
+            uncached, 'raise' if missing == 'raise' else 'skip')
+        for key, value in read.items():
+            cache.put(key, value)
+        values.update(read)
+        if missing == 'default':
+            for key in uncached:
+                if key not in read:
+                    values[key] = default
+        return values
+
+    def __setitem__(self, key, value):
+        if isinstance(key, compat.str_type):
+            key = key.encode('utf-8')
+        super(_CachedReadsMixin, self).__setitem__(key, value)
+        self._cache.discard(key)
+
+    def __delitem__(self, key):
+        if isinstance(key, compat.str_type):
+            key = key.encode('utf-8')
+        super(_CachedReadsMixin, self).__delitem__(key)
+        self._cache.discard(key)
+
+    def set_many(self, items):
+        if hasattr(items, 'items'):
+            items = items.items()
+        items = [(key.encode('utf-8') if isinstance(key, compat.str_type)
+                  else key, value) for key, value in items]
+        super(_CachedReadsMixin, self).set_many(items)
+        for key, value in items:
+            self._cache.discard(key)
+
+    def delete_many(self, keys, missing='raise'):
+        keys = [key.encode('utf-8') if isinstance(key, compat.str_type)
+                else key for key in keys]
+        super(_CachedReadsMixin, self).delete_many(keys, missing)
+        for key in keys:
+            self._cache.discard(key)
+
+    def _write_batch(self, writes):
+        super(_CachedReadsMixin, self)._write_batch(writes)
+        for key in writes:
+            self._cache.discard(key)
+
+    def compact(self):
+        super(_CachedReadsMixin, self).compact()
+        self._cache.clear()
+
+    def _swap_data_file(self, new_filename, index):
+        super(_CachedReadsMixin, self)._swap_data_file(new_filename, index)
+        self._cache.clear()
+
+    def _load_tail(self, end_offset):
+        # Any of the cached keys may have been written since they were
+        # cached.
+        super(_CachedReadsMixin, self)._load_tail(end_offset)
+        self._cache.clear()
+
+    def _reload(self):
+        super(_CachedReadsMixin, self)._reload()
+        self._cache.clear()
+
+    def close(self, compact=False):
+        super(_CachedReadsMixin, self).close(compact=compact)
+        self._cache.clear()
+
+    def cache_stats(self):
+        """Return a dict of the value cache's counters.
+
+        The dict contains the number of cache ``hits``, ``misses``,
+        and ``evictions`` so far, as well as the current number of
+        cached ``entries``, their size in ``bytes``, and the
+        ``max_bytes`` the cache is allowed to use.
+
+        """
+        return self._cache.stats()
+
+
+class _LazyLoadMixin(object):
+    """Loads the index in a background thread.
+
+    The data file is opened (and a db opened with ``'w'`` is verified to
+    exist) before the db is returned, only replaying the data file into
+    the index is done in the background.  Every method that uses the
+    index waits for the load to finish.  This includes writes, so a
+    write is always applied to the index after the entries replayed from
+    the data file.  Lookups wait instead of scanning the data file for
+    the key, the background load is that same scan and it has a head
+    start.  Reloads of the index after a compaction are not done in the
+    background.
+
+    """
+    def __init__(self, *args, **kwargs):
+        self._loaded = threading.Event()
+        self._load_error = None
+        # The data file to replay once the rest of the db is loaded.
+        self._deferred_filename = None
+        super(_LazyLoadMixin, self).__init__(*args, **kwargs)
+
+    def _load_db(self):
+        super(_LazyLoadMixin, self)._load_db()
+        filename = self._deferred_filename
+        if filename is None:
+            self._loaded.set()
+            return
+        self._deferred_filename = None
+        # The thread is started after self._index is assigned by
+        # _load_db() so that it can't overwrite the loaded index.
+        thread = threading.Thread(target=self._load_in_background,
+                                  args=(filename,))
+        thread.daemon = True
+        thread.start()
+
+    def _load_index(self, filename):
+        if self._loaded.is_set() or not os.path.exists(filename):
+            return super(_LazyLoadMixin, self)._load_index(filename)
+        self._deferred_filename = filename
+        return None
+
+    def _load_in_background(self, filename):
+        try:
+            self._index = super(_LazyLoadMixin, self)._load_index(filename)
+            self._truncate_torn_tail()
+            self._index_loaded()
+        except Exception as e:
+            self._load_error = e
+        finally:
+            self._loaded.set()
+
+    @property
+    def loaded(self):
+        return self._loaded.is_set() and self._load_error is None
+
+    def wait_loaded(self, timeout=None):
+        if not self._loaded.wait(timeout):
+            return False
+        if self._load_error is not None:
+            raise self._load_error
+        return True
+
+    def __getitem__(self, key):
+        self.wait_loaded()
+        return super(_LazyLoadMixin, self).__getitem__(key)
+
+    def __setitem__(self, key, value):
+        self.wait_loaded()
+        super(_LazyLoadMixin, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self.wait_loaded()
+        super(_LazyLoadMixin, self).__delitem__(key)
+
+    def __contains__(self, key):
+        self.wait_loaded()
+        return super(_LazyLoadMixin, self).__contains__(key)
+
+    def __iter__(self):
+        self.wait_loaded()
+        return super(_LazyLoadMixin, self).__iter__()
+
+    def keys(self):
+        self.wait_loaded()
+        return super(_LazyLoadMixin, self).keys()
+
+    def values(self):
+        self.wait_loaded()
+        return super(_LazyLoadMixin, self).values()
+
+    def _stream_snapshot(self):
+        self.wait_loaded()
+        return super(_LazyLoadMixin, self)._stream_snapshot()
+
+    def _written_offset(self):
+        self.wait_loaded()
+        return super(_LazyLoadMixin, self)._written_offset()
+
+    def _ordered_index(self):
+        self.wait_loaded()
+        return super(_LazyLoadMixin, self)._ordered_index()
+
+    def export_frozen(self, filename):
+        self.wait_loaded()
+        super(_LazyLoadMixin, self).export_frozen(filename)
+
+    def _verify_snapshot(self):
+        self.wait_loaded()
+        return super(_LazyLoadMixin, self)._verify_snapshot()
+
+    def space_stats(self):
+        self.wait_loaded()
+        return super(_LazyLoadMixin, self).space_stats()
+
+    def get_many(self, keys, missing='raise', default=None):
+        self.wait_loaded()
+        return super(_LazyLoadMixin, self).get_many(keys, missing, default)
+
+    def set_many(self, items):
+        self.wait_loaded()
+        super(_LazyLoadMixin, self).set_many(items)
+
+    def delete_many(self, keys, missing='raise'):
+        self.wait_loaded()
+        super(_LazyLoadMixin, self).delete_many(keys, missing)
+
+    def _write_batch(self, writes):
+        self.wait_loaded()
+        super(_LazyLoadMixin, self)._write_batch(writes)
+
+    def sync(self):
+        self.wait_loaded()
+        super(_LazyLoadMixin, self).sync()
+
+    def compact(self):
+        self.wait_loaded()
+        super(_LazyLoadMixin, self).compact()
+
+    def compact_async(self, progress_callback=None):
+        self.wait_loaded()
+        return super(_LazyLoadMixin, self).compact_async(progress_callback)
+
+    def close(self, compact=False):
+        self._loaded.wait()
+        if self._load_error is not None:
+            # There's no index to sync or compact.
+            os.close(self._data_fd)
+            return
+        super(_LazyLoadMixin, self).close(compact=compact)
+
+
+class _LazyLoadMMapMixin(_LazyLoadMixin):
+    def _index_loaded(self):
+        # The data file was mapped when the db was opened, entries
+        # appended since then have to be mapped before they're read.
+        self._map_data_file()
+        super(_LazyLoadMMapMixin, self)._index_loaded()
+
+    def get_view(self, key):
+        self.wait_loaded()
+        return super(_LazyLoadMMapMixin, self).get_view(key)
+
+
+class _AutoRefreshMixin(object):
+    """Refreshes a read only db when it's read.
+
+    A read calls ``refresh()`` first if it's been at least
+    ``refresh_interval`` seconds since the last refresh.  Refreshing is
+    done by the reads rather than by a background thread, so the index
+    never changes while the db isn't being used.
+
+    """
+    def __init__(self, *args, **kwargs):
+        self._refresh_interval = kwargs.pop('refresh_interval')
+        self._next_refresh = compat.monotonic() + self._refresh_interval
+        super(_AutoRefreshMixin, self).__init__(*args, **kwargs)
+
+    def _maybe_refresh(self, monotonic=compat.monotonic):
+        now = monotonic()
+        if now >= self._next_refresh:
+            self._next_refresh = now + self._refresh_interval
+            self.refresh()
+
+    def __getitem__(self, key):
+        self._maybe_refresh()
+        return super(_AutoRefreshMixin, self).__getitem__(key)
+
+    def __contains__(self, key):
+        self._maybe_refresh()
+        return super(_AutoRefreshMixin, self).__contains__(key)
+
+    def __iter__(self):
+        self._maybe_refresh()
+        return super(_AutoRefreshMixin, self).__iter__()
+
+    def keys(self):
+        self._maybe_refresh()
+        return super(_AutoRefreshMixin, self).keys()
+
+    def values(self):
+        self._maybe_refresh()
+        return super(_AutoRefreshMixin, self).values()
+
+    def _stream_snapshot(self):
+        self._maybe_refresh()
+        return super(_AutoRefreshMixin, self)._stream_snapshot()
+
+    def _ordered_index(self):
+        self._maybe_refresh()
+        return super(_AutoRefreshMixin, self)._ordered_index()
+
+    def get_many(self, keys, missing='raise', default=None):
+        self._maybe_refresh()
+        return super(_AutoRefreshMixin, self).get_many(keys, missing,
+                                                        default)
+
+
+class _AutoRefreshMMapMixin(_AutoRefreshMixin):
+    def get_view(self, key):
+        self._maybe_refresh()
+        return super(_AutoRefreshMMapMixin, self).get_view(key)
+
+
+class _SyncEachWriteMixin(object):
+    """Syncs the data file after every write.
+
+    ``__setitem__``, ``__delitem__``, ``set_many`` and ``delete_many``
+    only return once their entries are on disk.  Batch writes are synced
+    once for the whole batch.
+
+    """
+    def __init__(self, *args, **kwargs):
+        # The temporary db written by compact() doesn't pass durability,
+        # its data file is synced once it's complete.
+        self._sync_each_write = kwargs.pop('durability', 'os') == 'write'
+        self._synced_offset = 0
+        super(_SyncEachWriteMixin, self).__init__(*args, **kwargs)
+
+    def _sync_written(self):
+        offset = self._current_offset
+        if offset != self._synced_offset and self._sync_each_write:
+            self._fsync(self._data_fd)
+            self._synced_offset = offset
+
+    def __setitem__(self, key, value):
+        super(_SyncEachWriteMixin, self).__setitem__(key, value)
+        self._sync_written()
+
+    def __delitem__(self, key):
+        super(_SyncEachWriteMixin, self).__delitem__(key)
+        self._sync_written()
+
+    def set_many(self, items):
+        super(_SyncEachWriteMixin, self).set_many(items)
+        self._sync_written()
+
+    def delete_many(self, keys, missing='raise'):
+        super(_SyncEachWriteMixin, self).delete_many(keys, missing)
+        self._sync_written()
+
+    def _write_batch(self, writes):
+        super(_SyncEachWriteMixin, self)._write_batch(writes)
+        self._sync_written()
+
+    def wait_durable(self, timeout=None):
+        # Every write was synced before it returned.
+        return True
+
+
+class _GroupCommitMixin(object):
+    """Syncs the data file from a background thread.
+
+    Writes return without waiting for the disk.  A background thread
+    syncs the data file every ``sync_interval`` seconds, or as soon as
+    ``sync_bytes`` bytes have been written since the last sync, so a
+    single fsync covers every write made in between.  A crash loses
+    at most the writes of the last interval.  ``wait_durable()`` blocks
+    until the writes made before it was called have been synced.
+
+    The thread holds ``_sync_lock`` while it syncs, the data file is
+    only closed or replaced with the lock held.
+
+    """
+    def __init__(self, *args, **kwargs):
+        # As with _SyncEachWriteMixin, the temporary db written by
+        # compact() doesn't start a thread.
+        group_commit = kwargs.pop('durability', 'os') == 'group'
+        self._sync_interval = kwargs.pop('sync_interval',
+                                         _DEFAULT_SYNC_INTERVAL)
+        self._sync_bytes = kwargs.pop('sync_bytes', _DEFAULT_SYNC_BYTES)
+        self._sync_lock = threading.RLock()
+        self._sync_cond = threading.Condition()
+        self._synced_offset = 0
+        # Incremented when the data file is replaced, which makes every
+        # earlier write durable.
+        self._sync_generation = 0
+        self._sync_error = None
+        self._stopping = False
+        self._sync_thread = None
+        super(_GroupCommitMixin, self).__init__(*args, **kwargs)
+        if group_commit:
+            self._sync_thread = threading.Thread(
+                target=self._run_group_commits)
+            self._sync_thread.daemon = True
+            self._sync_thread.start()
+
+    def _run_group_commits(self):
+        cond = self._sync_cond
+        while True:
+            with cond:
+                if (not self._stopping and self._current_offset -
+                        self._synced_offset < self._sync_bytes):
+                    cond.wait(self._sync_interval)
+                if self._stopping:
+                    return
+            try:
+                self._group_commit()
+            except EnvironmentError as e:
+                with cond:
+                    self._sync_error = e
+                    cond.notify_all()
+                return
+
+    def _group_commit(self):
+        with self._sync_lock:
+            offset = self._current_offset
+            if offset == self._synced_offset:
+                return
+            self._fsync(self._data_fd)
+        self._mark_synced(offset)
+
+    def _mark_synced(self, offset, new_file=False):
+        with self._sync_cond:
+            self._synced_offset = offset
+            if new_file:
+                self._sync_generation += 1
+            self._sync_cond.notify_all()
+
+    def _check_sync_error(self):
+        if self._sync_error is not None:
+            raise DBMError("Background sync failed: %s" % self._sync_error)
+
+    def _written(self):
+        if self._current_offset - self._synced_offset >= self._sync_bytes:
+            with self._sync_cond:
+                self._sync_cond.notify_all()
+
+    def __setitem__(self, key, value):
+        super(_GroupCommitMixin, self).__setitem__(key, value)
+        self._written()
+
+    def __delitem__(self, key):
+        super(_GroupCommitMixin, self).__delitem__(key)
+        self._written()
+
+    def set_many(self, items):
+        super(_GroupCommitMixin, self).set_many(items)
+        self._written()
+
+    def delete_many(self, keys, missing='raise'):
+        super(_GroupCommitMixin, self).delete_many(keys, missing)
+        self._written()
+
+    def _write_batch(self, writes):
+        super(_GroupCommitMixin, self)._write_batch(writes)
+        self._written()
+
+    def wait_durable(self, timeout=None, monotonic=compat.monotonic):
+        target = self._written_offset()
+        if timeout is not None:
+            deadline = monotonic() + timeout
+        cond = self._sync_cond
+        with cond:
+            generation = self._sync_generation
+            while (self._synced_offset < target and
+                   self._sync_generation == generation):
+                self._check_sync_error()
+                if timeout is None:
+                    cond.wait()
+                else:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        return False
+                    cond.wait(remaining)
+        return True
+
+    def sync(self):
+        self._check_sync_error()
+        with self._sync_lock:
+            offset = self._current_offset
+            super(_GroupCommitMixin, self).sync()
+        self._mark_synced(offset)
+
+    def compact(self):
+        with self._sync_lock:
+            super(_GroupCommitMixin, self).compact()
+            # The compacted data file was synced before it was renamed
+            # into place.
+            self._mark_synced(self._current_offset, new_file=True)
+
+    def _swap_data_file(self, new_filename, index):
+        with self._sync_lock:
+            super(_GroupCommitMixin, self)._swap_data_file(new_filename,
+                                                           index)
+            self._mark_synced(self._current_offset, new_file=True)
+
+    def close(self, compact=False):
+        # close() syncs the db, so the thread can stop first.
+        with self._sync_cond:
+            self._stopping = True
+            self._sync_cond.notify_all()
+        if self._sync_thread is not None:
+            self._sync_thread.join()
+        super(_GroupCommitMixin, self).close(compact=compact)
+
+
+class _AutoCompactMixin(object):
+    """Compacts the db when enough of the data file is dead.
+
+    After each ``sync()`` and when the db is closed, the db is compacted
+    if the data file is at least ``auto_compact_min_size`` bytes and the
+    ``dead_ratio`` reported by ``space_stats()`` is at least
+    ``auto_compact_ratio``.  Compactions are at least
+    ``auto_compact_interval`` seconds apart, and with
+    ``auto_compact_background`` (only for thread safe dbs) they're
+    started with ``compact_async()`` instead of blocking the ``sync()``.
+
+    """
+    def __init__(self, *args, **kwargs):
+        self._auto_compact_ratio = kwargs.pop('auto_compact_ratio', None)
+        self._auto_compact_min_size = kwargs.pop('auto_compact_min_size', 0)
+        self._auto_compact_interval = kwargs.pop('auto_compact_interval', 0)
+        self._auto_compact_background = kwargs.pop(
+            'auto_compact_background', False)
+        self._next_auto_compact = 0
+        self._closing = False
+        super(_AutoCompactMixin, self).__init__(*args, **kwargs)
+
+    def _should_compact(self, monotonic=compat.monotonic):
+        if self._auto_compact_ratio is None or self._closing:
+            return False
+        if self._current_offset < self._auto_compact_min_size:
+            return False
+        if monotonic() < self._next_auto_compact:
+            return False
+        return self.space_stats()['dead_ratio'] >= self._auto_compact_ratio
+
+    def _maybe_compact(self):
+        if not self._should_compact():
+            return
+        if self._auto_compact_background:
+            if self._compaction is not None:
+                # A compaction is already running.
+                return
+            self._next_auto_compact = (compat.monotonic() +
+                                       self._auto_compact_interval)
+            self.compact_async()
+        else:
+            self._next_auto_compact = (compat.monotonic() +
+                                       self._auto_compact_interval)
+            self.compact()
+
+    def sync(self):
+        super(_AutoCompactMixin, self).sync()
+        self._maybe_compact()
+
+    def close(self, compact=False):
+        if not compact and self._compaction is None:
+            # The compaction on close is always done in the foreground.
+            compact = self._should_compact()
+        self._closing = True
+        super(_AutoCompactMixin, self).close(compact=compact)
+
+
+class _MetricsMixin(object):
+    """Counts operations and records their latencies.
+
+    The latencies of ``__getitem__``, ``__setitem__``, ``__delitem__``,
+    ``get_many()``, ``set_many()``, ``delete_many()``, committed
+    batches, ``sync()``, compactions (including background ones), and
+    loading the index are recorded in fixed bucket histograms, as is
+    every fsync of the data file (including the ones made by the
+    durability modes).  The bytes of the values read and of the keys and
+    values written, lookups of missing keys, and checksum failures are
+    counted.  The db provides a ``stats()`` method that returns all of
+    them as a dict.
+
+    """
+    def __init__(self, *args, **kwargs):
+        # Created before the index is loaded so the load is timed.
+        self._metrics = Metrics()
+        super(_MetricsMixin, self).__init__(*args, **kwargs)
+        self._fsync = self._timed_fsync(self._fsync)
+
+    def _timed_fsync(self, fsync, clock=compat.monotonic):
+        record = self._metrics.record
+
+        def timed_fsync(fd):
+            start = clock()
+            try:
+                fsync(fd)
+            finally:
+                record('fsync', clock() - start)
+        return timed_fsync
+
+    def _load_db(self, clock=compat.monotonic):
+        start = clock()
+        try:
+            super(_MetricsMixin, self)._load_db()
+        finally:
+            self._metrics.record('load', clock() - start)
+
+    def __getitem__(self, key, clock=compat.monotonic, len=len):
+        metrics = self._metrics
+        start = clock()
+        try:
+            value = super(_MetricsMixin, self).__getitem__(key)
+        except KeyError:
+            metrics.add('get_misses')
+            raise
+        except DBMChecksumError:
+            metrics.add('checksum_failures')
+            raise
+        finally:
+            metrics.record('get', clock() - start)
+        metrics.add('bytes_read', len(value))
+        return value
+
+    def __setitem__(self, key, value, clock=compat.monotonic,
+                    str_type=compat.str_type, isinstance=isinstance):
+        if isinstance(key, str_type):
+            key = key.encode('utf-8')
+        if isinstance(value, str_type):
+            value = value.encode('utf-8')
+        start = clock()
+        try:
+            super(_MetricsMixin, self).__setitem__(key, value)
+        finally:
+            self._metrics.record('set', clock() - start)
+        self._metrics.add('bytes_written', len(key) + len(value))
+
+    def __delitem__(self, key, clock=compat.monotonic):
+        start = clock()
+        try:
+            super(_MetricsMixin, self).__delitem__(key)
+        finally:
+            self._metrics.record('delete', clock() - start)
+
+    def get_many(self, keys, missing='raise', default=None,
+                 clock=compat.monotonic, str_type=compat.str_type,
+                 isinstance=isinstance, len=len):
+        keys = [key.encode('utf-8') if isinstance(key, str_type) else key
+                for key in keys]
+        metrics = self._metrics
+        start = clock()
+        try:
+            values = super(_MetricsMixin, self).get_many(keys, missing,
+                                                         default)
+        except KeyError:
+            metrics.add('get_misses')
+            raise
+        except DBMChecksumError:
+            metrics.add('checksum_failures')
+            raise
+        finally:
+            metrics.record('get_many', clock() - start)
+        misses = 0
+        bytes_read = 0
+        for key in set(keys):
+            value = values.get(key, _MISSING)
+            if value is _MISSING or (missing == 'default' and
+                                     value is default):
+                misses += 1
+            else:
+                bytes_read += len(value)
+        metrics.add('get_misses', misses)
+        metrics.add('bytes_read', bytes_read)
+        return values
+
+    def set_many(self, items, clock=compat.monotonic,
+                 str_type=compat.str_type, isinstance=isinstance, len=len):
+        if hasattr(items, 'items'):
+            items = items.items()
+        encoded = []
+        bytes_written = 0
+        for key, value in items:
+            if isinstance(key, str_type):
+                key = key.encode('utf-8')
+            if isinstance(value, str_type):
+                value = value.encode('utf-8')
+            encoded.append((key, value))
+            bytes_written += len(key) + len(value)
+        start = clock()
+        try:
+            super(_MetricsMixin, self).set_many(encoded)
+        finally:
+            self._metrics.record('set_many', clock() - start)
+        self._metrics.add('bytes_written', bytes_written)
+
+    def delete_many(self, keys, missing='raise', clock=compat.monotonic):
+        start = clock()
+        try:
+            super(_MetricsMixin, self).delete_many(keys, missing)
+        finally:
+            self._metrics.record('delete_many', clock() - start)
+
+    def _write_batch(self, writes, clock=compat.monotonic, len=len):
+        start = clock()
+        try:
+            super(_MetricsMixin, self)._write_batch(writes)
+        finally:
+            self._metrics.record('batch', clock() - start)
+        self._metrics.add('bytes_written', sum(
+            len(key) + len(value) for key, value in writes.items()
+            if value is not None))
+
+    def sync(self, clock=compat.monotonic):
+        start = clock()
+        try:
+            super(_MetricsMixin, self).sync()
+        finally:
+            self._metrics.record('sync', clock() - start)
+
+    def compact(self, clock=compat.monotonic):
+        start = clock()
+        try:
+            super(_MetricsMixin, self).compact()
+        finally:
+            self._metrics.record('compact', clock() - start)
+
+    def _complete_compaction(self, compaction, clock=compat.monotonic):
+        # A background compaction is timed from compact_async() until
+        # the compacted data file is swapped in.
+        super(_MetricsMixin, self)._complete_compaction(compaction)
+        self._metrics.record('compact', clock() - compaction._start_time)
+
+    def verify(self, *args, **kwargs):
+        bad = super(_MetricsMixin, self).verify(*args, **kwargs)
+        self._metrics.add('checksum_failures', len(bad))
+        return bad
+
+    def stats(self):
+        """Return a dict of the db's operation counters and latencies.
+
+        The dict contains the counters ``bytes_read`` (the bytes of the
+        values returned by lookups), ``bytes_written`` (the bytes of the
+        keys and values set), ``get_misses``, and ``checksum_failures``
+        (found by lookups or by ``verify()``).  For each of ``'get'``,
+        ``'set'``, ``'delete'``, ``'get_many'``, ``'set_many'``,
+        ``'delete_many'``, ``'batch'``, ``'sync'``, ``'fsync'``,
+        ``'compact'``, and ``'load'`` it contains a dict with the
+        ``count`` of the operations, their ``total`` and ``max`` latency
+        in seconds, and a histogram of the latencies: ``counts[i]`` is
+        the number of latencies of at most ``bounds[i]`` seconds (and
+        more than the previous bound), and the last count is of the
+        latencies above every bound.
+
+        """
+        return self._metrics.stats()
+
+    def reset_stats(self):
+        """Reset the counters and latencies returned by ``stats()``."""
+        self._metrics.reset()
+
+
+class _DiskIndexMixin(object):
+    """Keeps the index in a memory mapped hash table file.
+
+    See ``semidbm.diskindex`` for the details.  The table is loaded from
+    the ``index`` file in the db directory, and only the part of the data
+    file written after the table was last synced is replayed.  The table
+    is synced along with the data file.
+
+    """
+    def _load_index(self, filename):
+        self._hint_offset = None
+        if not os.path.exists(filename):
+            self._write_headers(filename)
+        index = self._open_disk_index(filename)
+        try:
+            self._loaded_offset = self._data_loader.load_index(
+                filename, index, index.covered_offset)
+        except ValueError as e:
+            index.close()
+            raise DBMLoadError("Bad index file %s: %s" % (filename, e))
+        except BaseException:
+            index.close()
+            raise
+        return index
+
+    def _open_disk_index(self, filename):
+        return diskindex.DiskIndex(
+            self._disk_index_filename(), filename, self._renamer,
+            read_only=isinstance(self, _SemiDBMReadOnly))
+
+    def _disk_index_filename(self):
+        return os.path.join(self._dbdir, 'index')
+
     def _remove_files_in_dbdir(self):
-        # We want to create a new DB so we need to remove
-        # any of the existing files in the dbdir.
-        if os.path.exists(self._data_filename):
-            os.remove(self._data_filename)
+        super(_DiskIndexMixin, self)._remove_files_in_dbdir()
+        diskindex.remove_index(self._disk_index_filename())
+
+    def sync(self):
+        super(_DiskIndexMixin, self).sync()
+        self._index.flush(self._current_offset)
+
+    def close(self, compact=False):
+        try:
+            super(_DiskIndexMixin, self).close(compact=compact)
+        finally:
+            self._index.close()
+
+    def _remove_compact_dir(self, compact_dir):
+        # The compacted db wrote (and synced) a table for the new data
+        # file, which replaces the table of the old data file.
+        self._index.close()
+        new_filename = os.path.join(compact_dir, 'index')
+        if os.path.exists(self._disk_index_filename()):
+            self._renamer(new_filename, self._disk_index_filename())
+        else:
+            os.rename(new_filename, self._disk_index_filename())
+        super(_DiskIndexMixin, self)._remove_compact_dir(compact_dir)
+
+    def compact_async(self, progress_callback=None):
+        raise DBMError("Can't compact_async: not supported with "
+                       "index='disk', use compact().")
+
+    def _reload(self):
+        index = self._index
+        try:
+            super(_DiskIndexMixin, self)._reload()
+        finally:
+            index.close()
+
+
+class _SharedIndexMixin(_DiskIndexMixin):
+    """Shares the disk index of a read only db between processes.
+
+    The first process to open the db updates the ``index`` file if it
+    doesn't cover the whole data file, and every other process maps
+    the same file instead of building its own index (see
+    ``semidbm.diskindex.open_shared()``).
+
+    """
+    def _open_disk_index(self, filename):
+        def replay(index, start_offset):
+            return self._data_loader.load_index(filename, index,
+                                                start_offset)
+        try:
+            return diskindex.open_shared(
+                self._disk_index_filename(), filename, self._renamer,
+                replay)
+        except ValueError as e:
+            raise DBMLoadError("Bad index file %s: %s" % (filename, e))
+
+
+_DEFAULT_WRITE_BUFFER_SIZE = 1024 * 1024
+_DEFAULT_WRITE_BUFFER_COUNT = 1024
+_DEFAULT_SYNC_INTERVAL = 0.01
+_DEFAULT_SYNC_BYTES = 1024 * 1024
+_DURABILITY_MODES = ('os', 'write', 'group')
+
+
+_DB_CLASSES = {
+    'r': _SemiDBMReadOnly,
+    'c': _SemiDBM,
+    'w': _SemiDBMReadWrite,
+    'n': _SemiDBMNew,
+}
+_composed_classes = {}
+
+
+def _db_class(base, mixins):
+    # Creates (and caches) a subclass of base with the optional
+    # behavior provided by the given mixins.  Mixins are applied
+    # in order, so the first mixin is the outermost one.
+    if not mixins:
+        return base
+    key = (base,) + tuple(mixins)
+    cls = _composed_classes.get(key)
+    if cls is None:
+        name = base.__name__ + ''.join(
+            mixin.__name__.strip('_').replace('Mixin', '')
+            for mixin in mixins)
+        cls = type(name, tuple(mixins) + (base,),
+                   {'_mixins': tuple(mixins)})
+        _composed_classes[key] = cls
+    return cls
 
 
 # These renamer classes are needed because windows
@@ -291,6 +2641,18 @@ class _WindowsRenamer(object):
         semidbm.win32.rename(from_file, to_file)
 
 
+_INDEX_TYPES = {
+    'dict': dict,
+    'compact': CompactIndex,
+    'sorted': SortedIndex,
+    # The disk indexes are created by _DiskIndexMixin and
+    # _SharedIndexMixin.
+    'disk': None,
+    'shared': None,
+}
+_COMPRESSION_CODECS = compression.available_codecs()
+
+
 def _create_default_params(**starting_kwargs):
     kwargs = starting_kwargs.copy()
     # Internal method that creates the parameters based
@@ -317,7 +2679,16 @@ def _create_default_params(**starting_kwargs):
 #
 # All the other args after this should have default values
 # so that this function remains compatible with the dbm interface.
-def open(filename, flag='r', mode=0o666, verify_checksums=False):
+def open(filename, flag='r', mode=0o666, verify_checksums=False,
+         hint_file=False, index='dict', thread_safe=False, use_mmap=False,
+         write_buffer_size=0, write_buffer_count=_DEFAULT_WRITE_BUFFER_COUNT,
+         segment_size=None, merge_threshold=0.5, compression=None,
+         compression_threshold=compression.DEFAULT_THRESHOLD, cache_size=0,
+         load_workers=0, lazy=False, refresh_interval=None,
+         auto_compact_ratio=None, auto_compact_min_size=0,
+         auto_compact_interval=0, auto_compact_background=False,
+         durability='os', sync_interval=_DEFAULT_SYNC_INTERVAL,
+         sync_bytes=_DEFAULT_SYNC_BYTES, fdatasync=False, metrics=False):
     """Open a semidbm database.
 
     :param filename: The name of the db.  Note that for semidbm,
@@ -349,15 +2720,293 @@ def open(filename, flag='r', mode=0o666, verify_checksums=False):
     :param verify_checksums: Verify the checksums for each value
         are correct on every __getitem__ call (defaults to False).
 
+    :param hint_file: Write a snapshot of the index (a "hint file") to
+        the db directory whenever the db is synced or closed.  The next
+        time the db is opened, the index is loaded from the hint file and
+        only the entries written after the snapshot are replayed from the
+        data file (defaults to False).  An existing hint file is always
+        used when loading the db, regardless of this value, as long as
+        it matches the data file.
+
+    :param index: The type of in memory index to use.  ``'dict'`` (the
+        default) is the fastest, ``'compact'`` stores the value offsets
+        and sizes in packed arrays and uses significantly less memory
+        per key at the cost of slightly slower lookups.  ``'sorted'``
+        also keeps the keys in sorted order, which is needed for
+        ``iter_range()`` and ``iter_prefix()``.  ``'disk'`` keeps the
+        index in a memory mapped hash table file in the db directory, so
+        the memory used doesn't grow with the number of keys.  The disk
+        index can't be combined with ``hint_file``, ``load_workers``, or
+        ``segment_size``, and doesn't support ``compact_async()``.
+        ``'shared'`` is a disk index for read only dbs (``'r'``) that's
+        shared by all the processes that open the db: the first one
+        updates the index file if it's out of date, and the others use
+        it as is instead of building their own index.
+
+    :param thread_safe: Allow the db to be shared between threads
+        (defaults to False).  Writes are serialized with a lock, reads
+        never block each other.  This can only be combined with
+        ``index='dict'``.
+
+    :param use_mmap: Keep the data file memory mapped and read values
+        directly from the memory map (defaults to False).  This is only
+        supported when the db is opened read only (``'r'``).  A db opened
+        this way also provides a ``get_view(key)`` method that returns a
+        memoryview of a value without copying it.  Reads from the memory
+        map don't depend on a file position, so the db can be shared
+        between threads.  Refreshes (see ``refresh_interval``) are
+        serialized, but they update the index in place, so a db that's
+        refreshed should only be shared between threads with
+        ``index='dict'`` and must not be iterated over during a refresh.
+
+    :param write_buffer_size: Buffer writes in memory and write them to
+        the data file in a single write once this many bytes are buffered
+        (defaults to 0, which disables write buffering).  Buffered writes
+        to the same key are collapsed so only the last value is written.
+        The buffer is written out on ``flush()``, ``sync()``, ``close()``
+        and ``compact()``, as well as before iterating over the keys.
+        Write buffering can't be combined with ``thread_safe``.
+
+    :param write_buffer_count: The maximum number of keys buffered
+        before the buffer is written to the data file.  Only used
+        when ``write_buffer_size`` is enabled.
+
+    :param segment_size: Store the db in a sequence of segment files
+        instead of a single data file, starting a new segment once the
+        current one is at least this many bytes (defaults to None, which
+        uses a single data file).  ``compact()`` then only merges the
+        segments with enough superseded or deleted data.  Segmented dbs
+        can't be combined with ``hint_file``, ``thread_safe``,
+        ``use_mmap``, ``write_buffer_size``, or ``load_workers``, and
+        don't support ``compact_async()``.
+
+    :param merge_threshold: For segmented dbs, the minimum ratio of dead
+        bytes (superseded or deleted entries) to total bytes for a
+        segment to be merged by ``compact()``.
+
+    :param compression: Compress values with the given codec, one of
+        ``'zlib'``, ``'bz2'``, or ``'lzma'`` (defaults to None, which
+        doesn't compress values).  Values are decompressed transparently
+        when they're read, and compressed values can always be read,
+        regardless of this value.  Values are only compressed in data
+        files of the current file format version, older data files are
+        upgraded when they're compacted.
+
+    :param compression_threshold: Values smaller than this many bytes
+        are never compressed.
+
+    :param cache_size: Cache recently read values in memory, using at
+        most this many bytes for keys and values (defaults to 0, which
+        disables the cache).  Cached values are returned without reading
+        the data file or verifying their checksum again.  The db provides
+        a ``cache_stats()`` method that returns the number of cache hits,
+        misses, and evictions.  The cache can't be combined with
+        ``thread_safe``.
+
+    :param load_workers: Load the index of a large data file with this
+        many processes (defaults to 0, which loads the index in the
+        current process).  Only data files with at least 64MB to load
+        are loaded in parallel.  The offsets that the data file is split
+        at are kept in a "boundaries" file in the db directory, which is
+        written the first time a db is loaded this way, so loading is
+        only parallel from the second time on.
+
+    :param lazy: Return the db without waiting for its index to be
+        loaded, the index is loaded in a background thread instead
+        (defaults to False).  Any method that uses the index, including
+        reads and writes, waits for the index to be loaded.  The db's
+        ``loaded`` property tells whether the index is loaded, and
+        ``wait_loaded()`` waits for it.  Lazy loading can't be combined
+        with ``segment_size``.
+
+    :param refresh_interval: For dbs opened read only (``'r'``), load the
+        entries written by other processes when the db is read, at most
+        once every this many seconds (defaults to None, which only loads
+        new entries when ``refresh()`` is called).  Read only dbs always
+        provide a ``refresh()`` method, which reads only the part of the
+        data file written since the last refresh, or reloads the db if
+        the data file was replaced (for example by compacting the db).
+        Refreshing isn't supported for segmented dbs.
+
+    :param auto_compact_ratio: Compact the db after a ``sync()`` or when
+        it's closed if at least this ratio of the data file is dead
+        (superseded or deleted entries, see ``space_stats()``), for
+        example ``0.5`` (defaults to None, which never compacts
+        automatically).  Automatic compaction isn't supported for dbs
+        opened read only (``'r'``) or for segmented dbs.
+
+    :param auto_compact_min_size: Only compact automatically once the
+        data file is at least this many bytes.
+
+    :param auto_compact_interval: The minimum number of seconds between
+        automatic compactions.
+
+    :param auto_compact_background: Compact automatically with
+        ``compact_async()`` instead of ``compact()``, so ``sync()``
+        doesn't wait for the compaction (the compaction when the db is
+        closed is always done in the foreground).  This requires
+        ``thread_safe=True``, so the compacted data file is swapped in by
+        the compaction thread.
+
+    :param durability: When writes are synced to disk.  ``'os'`` (the
+        default) leaves it to the OS, writes are only synced by
+        ``sync()`` and ``close()``.  ``'write'`` syncs the data file
+        before each write returns (a batch write is synced once).
+        ``'group'`` syncs the data file from a background thread every
+        ``sync_interval`` seconds, or once ``sync_bytes`` bytes have been
+        written, so a crash loses at most the last interval of writes.
+        ``wait_durable()`` waits until the writes made so far are synced.
+        ``'write'`` and ``'group'`` can't be used with ``'r'`` or
+        ``segment_size``, and ``'write'`` can't be used with
+        ``write_buffer_size``.
+
+    :param sync_interval: The maximum number of seconds between the
+        syncs of ``durability='group'``.
+
+    :param sync_bytes: With ``durability='group'``, sync as soon as this
+        many bytes have been written since the last sync.
+
+    :param fdatasync: Sync the data file with ``os.fdatasync()`` instead
+        of ``os.fsync()`` where it's available (defaults to False).  This
+        skips syncing file metadata that isn't needed to read the data.
+
+    :param metrics: Count operations and record their latencies
+        (defaults to False).  The db then provides a ``stats()`` method
+        that returns the counters and latency histograms as a dict, and
+        ``reset_stats()`` to start over.  Lookups, writes, deletes (one
+        at a time or in bulk), batches, syncs, fsyncs, compactions, and
+        loading the index are timed.
+        With ``lazy``, only the part of the load that isn't done in the
+        background is timed.
+
     """
-    kwargs = _create_default_params(verify_checksums=verify_checksums)
-    if flag == 'r':
-        return _SemiDBMReadOnly(filename, **kwargs)
-    elif flag == 'c':
-        return _SemiDBM(filename, **kwargs)
-    elif flag == 'w':
-        return _SemiDBMReadWrite(filename, **kwargs)
-    elif flag == 'n':
-        return _SemiDBMNew(filename, **kwargs)
-    else:
+
+    if flag not in _DB_CLASSES:
         raise ValueError("flag argument must be 'r', 'c', 'w', or 'n'")
+    if index not in _INDEX_TYPES:
+        raise ValueError("index argument must be one of: %s" %
+                         ', '.join(sorted(_INDEX_TYPES)))
+    if use_mmap and flag != 'r':
+        raise ValueError("use_mmap can only be used with flag='r'")
+    if use_mmap and mmap is None:
+        raise ValueError("use_mmap requires mmap support")
+    if index in ('disk', 'shared') and mmap is None:
+        raise ValueError("index='%s' requires mmap support" % index)
+    if index in ('disk', 'shared') and (hint_file or load_workers or
+                                        segment_size is not None):
+        raise ValueError("index='%s' can't be used with hint_file, "
+                         "load_workers, or segment_size" % index)
+    if index == 'shared' and flag != 'r':
+        raise ValueError("index='shared' can only be used with flag='r'")
+    if thread_safe and index != 'dict':
+        # The other indexes update an entry in more than one step,
+        # so a reader can see a partially updated entry.
+        raise ValueError("thread_safe can only be used with index='dict'")
+    if thread_safe and write_buffer_size:
+        raise ValueError("thread_safe can't be used with write_buffer_size")
+    if thread_safe and cache_size:
+        # A read that misses the cache could put a value in the cache
+        # after another thread has written a newer value.
+        raise ValueError("thread_safe can't be used with cache_size")
+    if segment_size is not None and (hint_file or thread_safe or
+                                     use_mmap or write_buffer_size or
+                                     load_workers or lazy or
+                                     refresh_interval is not None):
+        raise ValueError("segment_size can't be used with hint_file, "
+                         "thread_safe, use_mmap, write_buffer_size, "
+                         "load_workers, lazy, or refresh_interval")
+    if refresh_interval is not None and flag != 'r':
+        raise ValueError("refresh_interval can only be used with flag='r'")
+    if auto_compact_ratio is not None and (flag == 'r' or
+                                           segment_size is not None):
+        raise ValueError("auto_compact_ratio can't be used with flag='r' "
+                         "or segment_size")
+    if durability not in _DURABILITY_MODES:
+        raise ValueError("durability argument must be one of: %s" %
+                         ', '.join(_DURABILITY_MODES))
+    if durability != 'os' and (flag == 'r' or segment_size is not None):
+        raise ValueError("durability='%s' can't be used with flag='r' "
+                         "or segment_size" % durability)
+    if durability == 'write' and write_buffer_size:
+        raise ValueError("durability='write' can't be used with "
+                         "write_buffer_size")
+    if auto_compact_background and index == 'disk':
+        raise ValueError("auto_compact_background can't be used with "
+                         "index='disk'")
+    if auto_compact_background and not thread_safe:
+        # Otherwise the compacted data file is only swapped in by
+        # CompactionHandle.wait(), which nothing calls.
+        raise ValueError("auto_compact_background can only be used with "
+                         "thread_safe=True")
+    if compression is not None and compression not in _COMPRESSION_CODECS:
+        raise ValueError("compression argument must be one of: %s" %
+                         ', '.join(_COMPRESSION_CODECS))
+    kwargs = _create_default_params(
+        verify_checksums=verify_checksums, hint_file=hint_file,
+        index_factory=_INDEX_TYPES[index], compression=compression,
+        compression_threshold=compression_threshold,
+        load_workers=load_workers, fdatasync=fdatasync)
+    mixins = []
+    if metrics:
+        # The outermost mixin, so the latencies include the time spent
+        # in every other mixin (such as refreshes and cache lookups).
+        mixins.append(_MetricsMixin)
+    if refresh_interval is not None:
+        # Cached values are only checked for updates by a refresh, so
+        # a read has to refresh before looking in the cache.
+        if use_mmap:
+            mixins.append(_AutoRefreshMMapMixin)
+        else:
+            mixins.append(_AutoRefreshMixin)
+        kwargs['refresh_interval'] = refresh_interval
+    if auto_compact_ratio is not None:
+        # Compacts after the inner mixins have synced (and flushed).
+        mixins.append(_AutoCompactMixin)
+        kwargs['auto_compact_ratio'] = auto_compact_ratio
+        kwargs['auto_compact_min_size'] = auto_compact_min_size
+        kwargs['auto_compact_interval'] = auto_compact_interval
+        kwargs['auto_compact_background'] = auto_compact_background
+    if cache_size:
+        # The cache is outside of the mixins that buffer, lock, or
+        # write to the data file, so it sees every write, including
+        # writes that are buffered.
+        mixins.append(_CachedReadsMixin)
+        kwargs['cache_size'] = cache_size
+    if segment_size is not None:
+        from semidbm.segmented import SEGMENTED_DB_CLASSES
+        return _db_class(SEGMENTED_DB_CLASSES[flag], mixins)(
+            filename, segment_size=segment_size,
+            merge_threshold=merge_threshold, **kwargs)
+    if use_mmap:
+        if lazy:
+            mixins.append(_LazyLoadMMapMixin)
+        if index == 'disk':
+            mixins.append(_DiskIndexMixin)
+        elif index == 'shared':
+            mixins.append(_SharedIndexMixin)
+        return _db_class(_SemiDBMReadOnlyMMap, mixins)(filename, **kwargs)
+    if lazy:
+        # Waits for the index before any of the inner mixins use it.
+        mixins.append(_LazyLoadMixin)
+    if thread_safe:
+        mixins.append(_ThreadSafeMixin)
+    # The sync lock of a group commit is always acquired after the
+    # write lock of a thread safe db.  Buffered writes are synced once
+    # they've been written out to the data file.
+    if durability == 'write':
+        mixins.append(_SyncEachWriteMixin)
+        kwargs['durability'] = durability
+    elif durability == 'group':
+        mixins.append(_GroupCommitMixin)
+        kwargs['durability'] = durability
+        kwargs['sync_interval'] = sync_interval
+        kwargs['sync_bytes'] = sync_bytes
+    if write_buffer_size and flag != 'r':
+        mixins.append(_BufferedWritesMixin)
+        kwargs['write_buffer_size'] = write_buffer_size
+        kwargs['write_buffer_count'] = write_buffer_count
+    if index == 'disk':
+        mixins.append(_DiskIndexMixin)
+    elif index == 'shared':
+        mixins.append(_SharedIndexMixin)
+    return _db_class(_DB_CLASSES[flag], mixins)(filename, **kwargs)
@@ -0,0 +1,441 @@
+"""An on disk hash table index.
+
+The index of a db opened with ``index='disk'`` is an open addressing
+hash table (with linear probing) in an ``index`` file next to the data
+file.  The file is memory mapped, so only the pages of the table that
+are used need to be in memory, regardless of the number of keys.
+
+Keys aren't stored in the table.  Each slot holds a 64 bit hash of the
+key, the offset and size of the value, and the size of the key.  The
+key of an entry is stored in the data file right before its value, so
+a slot whose hash matches is confirmed by reading the key from the data
+file.  This read is from the same page as the value, so a lookup costs
+one probe of the table plus one read of the data file.
+
+Like hint files, the data file is the source of truth.  The header of
+the index file records the offset in the data file that the table
+covers along with a fingerprint of the data file, and whether the table
+has been modified since it was last synced.  A table that's missing,
+corrupt, modified since it was synced (e.g. after a crash), or doesn't
+match the data file is rebuilt by replaying the data file.
+
+Read only dbs can share an index file between processes (see
+``open_shared()``).  The file is mapped copy on write, so every process
+that maps it uses the same pages of the page cache.  An index file is
+never modified in place once it's shared, it's always rebuilt in a new
+file that replaces it, so processes that have the old file mapped keep
+a consistent table.
+
+"""
+import os
+import hashlib
+import mmap
+import shutil
+import struct
+import tempfile
+import contextlib
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from semidbm import compat
+from semidbm.hint import data_fingerprint
+
+
+INDEX_IDENTIFIER = b'\x53\x45\x4d\x58'
+# Major, Minor version.
+INDEX_FORMAT_VERSION = (1, 0)
+# <magic><major><minor><capacity><count><used><data offset covered>
+# <data fingerprint><dirty>
+_HEADER = struct.Struct('!4sHHQQQQIB')
+_HEADER_SIZE = 64
+# <key hash><value offset><value size><key size>
+_SLOT = struct.Struct('=QqiI')
+# Value offsets are never 0 (that's the data file header), so an
+# offset of 0 marks an empty slot.
+_EMPTY = 0
+_TOMBSTONE = -1
+MIN_CAPACITY = 1024
+# The table is resized once this fraction of the slots are used
+# (including the slots of deleted keys).
+MAX_LOAD = 0.75
+_READ_FLAGS = os.O_RDONLY | getattr(os, 'O_BINARY', 0)
+
+
+if hasattr(hashlib, 'blake2b'):
+    def key_hash(key, blake2b=hashlib.blake2b, unpack=struct.unpack):
+        return unpack('=Q', blake2b(key, digest_size=8).digest())[0]
+else:
+    def key_hash(key, md5=hashlib.md5, unpack=struct.unpack):
+        return unpack('=Q', md5(key).digest()[:8])[0]
+
+
+class DiskIndex(object):
+    """A memory mapped hash table mapping keys to ``(offset, size)``.
+
+    :param filename: The index file.  An existing index file is used if
+        it's up to date, anything else is replaced by an empty table.
+
+    :param data_filename: The data file the index belongs to.  Keys are
+        read from this file.
+
+    :param renamer: Used to rename a resized table over the index file.
+        Resized tables are written to a new file, which replaces the
+        index file once it's populated.
+
+    :param read_only: Never write to the index file.  An up to date
+        index file is mapped copy on write, a new table is kept in an
+        anonymous temporary file.
+
+    Once the index is created, ``covered_offset`` is the offset in the
+    data file up to which the table is up to date, or None if the table
+    is empty and the whole data file needs to be replayed.
+
+    """
+    def __init__(self, filename, data_filename, renamer, read_only=False):
+        self._filename = filename
+        self._data_filename = data_filename
+        self._renamer = renamer
+        self._read_only = read_only
+        self._file = None
+        self._table = None
+        self._capacity = 0
+        self._count = 0
+        # The number of slots used by live and deleted keys.
+        self._used = 0
+        self._dirty = False
+        self._data_fd = os.open(data_filename, _READ_FLAGS)
+        try:
+            self.covered_offset = self._open_table()
+            if self.covered_offset is None:
+                self._file, self._table = self._create_table(MIN_CAPACITY,
+                                                             filename)
+                self._capacity = MIN_CAPACITY
+        except BaseException:
+            os.close(self._data_fd)
+            raise
+
+    def _open_table(self):
+        try:
+            f = compat.file_open(self._filename,
+                                 'rb' if self._read_only else 'r+b')
+        except (IOError, OSError):
+            return None
+        try:
+            header = self._read_header(f)
+            if header is None:
+                f.close()
+                return None
+            if self._read_only:
+                # Replaying the end of the data file must not change
+                # the index file.
+                access = mmap.ACCESS_COPY
+            else:
+                access = mmap.ACCESS_WRITE
+            table = mmap.mmap(f.fileno(), 0, access=access)
+        except BaseException:
+            f.close()
+            raise
+        self._file = f
+        self._table = table
+        self._capacity, self._count, self._used, offset = header
+        return offset
+
+    def _read_header(self, f):
+        # Returns (capacity, count, used, covered offset) if the table
+        # in f is up to date with the data file, otherwise None.
+        header = f.read(_HEADER_SIZE)
+        if len(header) < _HEADER_SIZE:
+            return None
+        (magic, major, minor, capacity, count, used, offset, fingerprint,
+         dirty) = _HEADER.unpack_from(header)
+        if magic != INDEX_IDENTIFIER or major != INDEX_FORMAT_VERSION[0]:
+            return None
+        if dirty or os.path.getsize(self._filename) != (
+                _HEADER_SIZE + capacity * _SLOT.size):
+            return None
+        if os.path.getsize(self._data_filename) < offset:
+            return None
+        if data_fingerprint(self._data_filename, offset) != fingerprint:
+            return None
+        return capacity, count, used, offset
+
+    def _create_table(self, capacity, filename):
+        if self._read_only:
+            f = tempfile.TemporaryFile()
+        else:
+            f = compat.file_open(filename, 'w+b')
+        try:
+            f.truncate(_HEADER_SIZE + capacity * _SLOT.size)
+            table = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE)
+        except BaseException:
+            f.close()
+            raise
+        # A new table isn't up to date until it's flushed.
+        self._write_header(table, capacity, 0, 0, 0, 0, True)
+        table.flush(0, _HEADER_SIZE)
+        self._dirty = True
+        return f, table
+
+    def _write_header(self, table, capacity, count, used, offset,
+                      fingerprint, dirty):
+        _HEADER.pack_into(table, 0, INDEX_IDENTIFIER,
+                          INDEX_FORMAT_VERSION[0], INDEX_FORMAT_VERSION[1],
+                          capacity, count, used, offset, fingerprint,
+                          1 if dirty else 0)
+
+    def _mark_dirty(self):
+        # The dirty flag has to be on disk before any of the slots are,
+        # so that a table that was modified but not synced is never
+        # mistaken for an up to date one.
+        if not self._read_only:
+            self._write_header(self._table, self._capacity, self._count,
+                               self._used, 0, 0, True)
+            self._table.flush(0, _HEADER_SIZE)
+        self._dirty = True
+
+    if compat.pread is not None:
+        def _read_key(self, offset, key_size, pread=compat.pread):
+            return pread(self._data_fd, key_size, offset - key_size)
+    else:
+        def _read_key(self, offset, key_size):
+            os.lseek(self._data_fd, offset - key_size, os.SEEK_SET)
+            return os.read(self._data_fd, key_size)
+
+    def _find(self, key, h, unpack_from=_SLOT.unpack_from,
+              slot_size=_SLOT.size, len=len):
+        # Returns the slot of key (or -1 if key isn't in the table), and
+        # the slot that a new entry for key would be stored in.
+        table = self._table
+        mask = self._capacity - 1
+        i = h & mask
+        free = -1
+        while True:
+            slot_hash, offset, size, key_size = unpack_from(
+                table, _HEADER_SIZE + i * slot_size)
+            if offset == _EMPTY:
+                if free < 0:
+                    free = i
+                return -1, free
+            if offset == _TOMBSTONE:
+                if free < 0:
+                    free = i
+            elif (slot_hash == h and key_size == len(key) and
+                    self._read_key(offset, key_size) == key):
+                return i, free
+            i = (i + 1) & mask
+
+    def __getitem__(self, key):
+        slot = self._find(key, key_hash(key))[0]
+        if slot < 0:
+            raise KeyError(key)
+        return _SLOT.unpack_from(
+            self._table, _HEADER_SIZE + slot * _SLOT.size)[1:3]
+
+    def get(self, key, default=None):
+        slot = self._find(key, key_hash(key))[0]
+        if slot < 0:
+            return default
+        return _SLOT.unpack_from(
+            self._table, _HEADER_SIZE + slot * _SLOT.size)[1:3]
+
+    def __contains__(self, key):
+        if not isinstance(key, bytes):
+            # Like a dict, a key that isn't bytes is never in the index.
+            return False
+        return self._find(key, key_hash(key))[0] >= 0
+
+    def __setitem__(self, key, location):
+        if not self._dirty:
+            self._mark_dirty()
+        h = key_hash(key)
+        slot, free = self._find(key, h)
+        if slot < 0:
+            if self._used + 1 > self._capacity * MAX_LOAD:
+                self._resize(self._count + 1)
+                free = self._find(key, h)[1]
+            slot = free
+            if _SLOT.unpack_from(self._table, _HEADER_SIZE +
+                                 slot * _SLOT.size)[1] == _EMPTY:
+                self._used += 1
+            self._count += 1
+        _SLOT.pack_into(self._table, _HEADER_SIZE + slot * _SLOT.size,
+                        h, location[0], location[1], len(key))
+
+    def __delitem__(self, key):
+        slot = self._find(key, key_hash(key))[0]
+        if slot < 0:
+            raise KeyError(key)
+        if not self._dirty:
+            self._mark_dirty()
+        _SLOT.pack_into(self._table, _HEADER_SIZE + slot * _SLOT.size,
+                        0, _TOMBSTONE, 0, 0)
+        self._count -= 1
+
+    def __len__(self):
+        return self._count
+
+    def _iter_slots(self, unpack_from=_SLOT.unpack_from):
+        table = self._table
+        for i in range(self._capacity):
+            slot = unpack_from(table, _HEADER_SIZE + i * _SLOT.size)
+            if slot[1] > 0:
+                yield slot
+
+    def __iter__(self):
+        for slot_hash, offset, size, key_size in self._iter_slots():
+            yield self._read_key(offset, key_size)
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        for slot_hash, offset, size, key_size in self._iter_slots():
+            yield self._read_key(offset, key_size), (offset, size)
+
+    def _resize(self, count):
+        capacity = MIN_CAPACITY
+        # Leave the resized table at most half as full as MAX_LOAD.
+        while count > capacity * MAX_LOAD / 2:
+            capacity *= 2
+        new_filename = self._filename + '.new'
+        new_file, new_table = self._create_table(capacity, new_filename)
+        mask = capacity - 1
+        unpack_from = _SLOT.unpack_from
+        pack_into = _SLOT.pack_into
+        # Keys are unique, so the slots can be copied over using only
+        # their hashes.
+        for slot in self._iter_slots():
+            i = slot[0] & mask
+            while unpack_from(new_table, _HEADER_SIZE +
+                              i * _SLOT.size)[1] != _EMPTY:
+                i = (i + 1) & mask
+            pack_into(new_table, _HEADER_SIZE + i * _SLOT.size, *slot)
+        self._close_table()
+        if not self._read_only:
+            self._renamer(new_filename, self._filename)
+        self._file = new_file
+        self._table = new_table
+        self._capacity = capacity
+        self._used = self._count
+
+    def flush(self, covered_offset):
+        """Write the table to disk, marking it up to date with the data
+        file up to ``covered_offset``.
+
+        The data file must already be synced up to ``covered_offset``.
+
+        """
+        if self._read_only:
+            return
+        table = self._table
+        # The slots have to be on disk before the header says the
+        # table is up to date.
+        self._write_header(table, self._capacity, self._count, self._used,
+                           0, 0, True)
+        table.flush()
+        self._write_header(
+            table, self._capacity, self._count, self._used, covered_offset,
+            data_fingerprint(self._data_filename, covered_offset), False)
+        table.flush(0, _HEADER_SIZE)
+        self._dirty = False
+
+    def _close_table(self):
+        self._table.close()
+        self._file.close()
+
+    def close(self):
+        """Close the index without writing it to disk (see flush())."""
+        self._close_table()
+        os.close(self._data_fd)
+
+
+def open_shared(filename, data_filename, renamer, replay):
+    """Open an index file for reading, updating it first if needed.
+
+    If the index file doesn't cover the whole data file, one process
+    updates it while any other processes opening the same index wait
+    for it (on platforms with ``fcntl``), and then use the updated file
+    instead of building their own table.  The index is updated in a
+    copy of the index file which then replaces it.
+
+    :param replay: Called with a ``DiskIndex`` and the offset in the
+        data file it covers (None for an empty table), replays the data
+        file into the index and returns the offset just past the last
+        entry it replayed.  An entry that's still being written isn't
+        replayed, so the index only ever covers complete entries.
+
+    :returns: A read only ``DiskIndex``.  If the index file can't be
+        written (for example because the db directory is read only), the
+        index is only updated in memory, as with ``read_only=True``.
+
+    """
+    index = _open_current(filename, data_filename, renamer, replay)
+    if index is not None:
+        return index
+    try:
+        with _exclusive_lock(filename + '.lock'):
+            # Another process may have updated the index while we were
+            # waiting for the lock.
+            index = _open_current(filename, data_filename, renamer, replay)
+            if index is not None:
+                return index
+            _update_copy(filename, data_filename, renamer, replay)
+    except (IOError, OSError):
+        pass
+    return DiskIndex(filename, data_filename, renamer, read_only=True)
+
+
+def _open_current(filename, data_filename, renamer, replay):
+    # Returns a read only index if the index file covers every complete
+    # entry of the data file, otherwise None.
+    index = DiskIndex(filename, data_filename, renamer, read_only=True)
+    covered = index.covered_offset
+    if covered is not None:
+        if covered == os.path.getsize(data_filename):
+            return index
+        # The rest of the data file may only be an entry that's still
+        # being written.  The index is mapped copy on write, so
+        # replaying into it doesn't change the index file.
+        if replay(index, covered) == covered:
+            return index
+    index.close()
+    return None
+
+
+def _update_copy(filename, data_filename, renamer, replay):
+    tmp_filename = filename + '.tmp'
+    if os.path.exists(filename):
+        # Only the end of the data file needs to be replayed if the
+        # index file is up to date with the rest of it.
+        shutil.copyfile(filename, tmp_filename)
+    index = DiskIndex(tmp_filename, data_filename, renamer)
+    try:
+        index.flush(replay(index, index.covered_offset))
+    finally:
+        index.close()
+    if os.path.exists(filename):
+        renamer(tmp_filename, filename)
+    else:
+        os.rename(tmp_filename, filename)
+
+
+@contextlib.contextmanager
+def _exclusive_lock(lock_filename):
+    if fcntl is None:
+        yield
+        return
+    with compat.file_open(lock_filename, 'ab') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def remove_index(index_filename):
+    for filename in (index_filename, index_filename + '.new',
+                     index_filename + '.tmp', index_filename + '.tmp.new'):
+        if os.path.exists(filename):
+            os.remove(filename)
@@ -0,0 +1,269 @@
+"""Frozen (read only) snapshots of a db.
+
+A frozen file is a single file containing the live entries of a db
+followed by a precomputed hash table of their keys, similar to a
+constant database (cdb).  There are no deleted or superseded entries,
+and there's no index to build when the file is opened: the file is
+memory mapped and lookups probe the hash table directly.
+
+The file consists of a header, the entries, and the hash table.  The
+entries have the same format as the entries of a data file (the values
+are stored uncompressed).  The hash table has a power of 2 number of
+slots, at most half of which are used, and each slot holds the hash
+of a key and the offset of its entry (0 for an empty slot).  Collisions
+are resolved with linear probing.  The longest probe sequence of any key
+is recorded in the header, so a lookup never probes more slots than
+that.
+
+"""
+import os
+import mmap
+import struct
+from binascii import crc32
+
+from semidbm import compat
+from semidbm.diskindex import key_hash
+from semidbm.exceptions import DBMLoadError, DBMChecksumError
+
+
+FROZEN_IDENTIFIER = b'\x53\x45\x4d\x46'
+# Major, Minor version.
+FROZEN_FORMAT_VERSION = (1, 0)
+# <magic><major><minor><number of keys><number of slots>
+# <hash table offset><max probes>
+_HEADER = struct.Struct('!4sHHQQQI')
+# <key hash><entry offset>
+_SLOT = struct.Struct('!QQ')
+# <keysize><valsize>
+_ENTRY_HEADER = struct.Struct('!ii')
+# The number of values read from the db at a time.
+_EXPORT_BATCH_SIZE = 1024
+
+
+def write_frozen(filename, locations, get_many, renamer):
+    """Write a frozen file.
+
+    :param locations: A list of ``(key, (offset, size))`` of the live
+        keys of the db.
+
+    :param get_many: The ``get_many()`` method of the db.  The values
+        are read in the order of their offsets.
+
+    """
+    locations.sort(key=lambda item: item[1][0])
+    tmp_filename = filename + '.tmp'
+    hashes = []
+    offsets = []
+    with compat.file_open(tmp_filename, 'wb') as f:
+        # The header is written once the hash table is built.
+        f.write(b'\x00' * _HEADER.size)
+        offset = _HEADER.size
+        pack = _ENTRY_HEADER.pack
+        for i in range(0, len(locations), _EXPORT_BATCH_SIZE):
+            keys = [key for key, location in
+                    locations[i:i + _EXPORT_BATCH_SIZE]]
+            values = get_many(keys)
+            for key in keys:
+                value = values[key]
+                keyval = key + value
+                f.write(pack(len(key), len(value)))
+                f.write(keyval)
+                f.write(struct.pack('!I', crc32(keyval) & 0xffffffff))
+                hashes.append(key_hash(key))
+                offsets.append(offset)
+                offset += 12 + len(keyval)
+        num_slots, max_probes, table = _build_table(hashes, offsets)
+        f.write(table)
+        f.seek(0)
+        f.write(_HEADER.pack(FROZEN_IDENTIFIER, FROZEN_FORMAT_VERSION[0],
+                             FROZEN_FORMAT_VERSION[1], len(hashes),
+                             num_slots, offset, max_probes))
+        f.flush()
+        os.fsync(f.fileno())
+    if os.path.exists(filename):
+        renamer(tmp_filename, filename)
+    else:
+        os.rename(tmp_filename, filename)
+
+
+def _build_table(hashes, offsets):
+    num_slots = 1
+    while num_slots < len(hashes) * 2:
+        num_slots *= 2
+    mask = num_slots - 1
+    # The hashes are unsigned 64 bit ints, which don't fit in an array
+    # on every python version, so the slots are packed as they're used.
+    # Empty slots are all zeros.
+    table = bytearray(num_slots * _SLOT.size)
+    used = [False] * num_slots
+    pack_into = _SLOT.pack_into
+    max_probes = 0
+    for h, offset in zip(hashes, offsets):
+        i = h & mask
+        probes = 1
+        while used[i]:
+            i = (i + 1) & mask
+            probes += 1
+        used[i] = True
+        pack_into(table, i * _SLOT.size, h, offset)
+        if probes > max_probes:
+            max_probes = probes
+    return num_slots, max_probes, bytes(table)
+
+
+class FrozenSemiDBM(object):
+    """A read only db backed by a frozen file.
+
+    Opening the db only maps the file, so it takes the same time
+    regardless of the number of keys, and the only memory used is the
+    page cache of the mapped file.
+
+    """
+    def __init__(self, filename, verify_checksums=False):
+        self._verify_checksums = verify_checksums
+        with compat.file_open(filename, 'rb') as f:
+            header = f.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                raise DBMLoadError("File is not a frozen semidbm file.")
+            (magic, major, minor, self._num_keys, self._num_slots,
+             self._table_offset, self._max_probes) = _HEADER.unpack(header)
+            if magic != FROZEN_IDENTIFIER:
+                raise DBMLoadError("File is not a frozen semidbm file.")
+            if major != FROZEN_FORMAT_VERSION[0]:
+                raise DBMLoadError(
+                    'Incompatible file version (got: v%s, can handle: v%s)'
+                    % (major, FROZEN_FORMAT_VERSION[0]))
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._view = memoryview(self._map)
+        except TypeError:
+            # Python 2's mmap doesn't support the new buffer protocol,
+            # in which case slices of the mmap (copies) are returned.
+            self._view = self._map
+
+    def _find(self, key, len=len, unpack_from=_SLOT.unpack_from,
+              unpack_entry=_ENTRY_HEADER.unpack_from):
+        # Returns the (offset, size) of the value of key, or None.
+        contents = self._map
+        h = key_hash(key)
+        mask = self._num_slots - 1
+        i = h & mask
+        table_offset = self._table_offset
+        for probe in range(self._max_probes):
+            slot_hash, offset = unpack_from(contents, table_offset + i * 16)
+            if not offset:
+                return None
+            if slot_hash == h:
+                key_size, size = unpack_entry(contents, offset)
+                if (key_size == len(key) and
+                        contents[offset + 8:offset + 8 + key_size] == key):
+                    return offset + 8 + key_size, size
+            i = (i + 1) & mask
+        return None
+
+    def __getitem__(self, key, str_type=compat.str_type,
+                    isinstance=isinstance):
+        if isinstance(key, str_type):
+            key = key.encode('utf-8')
+        location = self._find(key)
+        if location is None:
+            raise KeyError(key)
+        offset, size = location
+        if not self._verify_checksums:
+            return self._map[offset:offset + size]
+        return self._verify_checksum_data(
+            key, self._map[offset:offset + size + 4])
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def get_view(self, key):
+        """Return a memoryview of the value associated with a key.
+
+        The memoryview references the memory map of the file, so no
+        data is copied.  The returned view must not be used after the db
+        is closed.  On python 2 the value is returned as bytes instead.
+
+        """
+        if isinstance(key, compat.str_type):
+            key = key.encode('utf-8')
+        location = self._find(key)
+        if location is None:
+            raise KeyError(key)
+        offset, size = location
+        value = self._view[offset:offset + size]
+        if self._verify_checksums:
+            self._verify_checksum_data(
+                key, self._map[offset:offset + size + 4])
+        return value
+
+    def _verify_checksum_data(self, key, data):
+        value = data[:-4]
+        expected = struct.unpack('!I', data[-4:])[0]
+        if crc32(value, crc32(key)) & 0xffffffff != expected:
+            raise DBMChecksumError(
+                "Corrupt data detected: invalid checksum for key %s" % key)
+        return value
+
+    def __contains__(self, key):
+        if isinstance(key, compat.str_type):
+            key = key.encode('utf-8')
+        return self._find(key) is not None
+
+    def __len__(self):
+        return self._num_keys
+
+    def _iter_entries(self):
+        # Yields (key, value offset, value size) in file order.
+        contents = self._map
+        unpack_from = _ENTRY_HEADER.unpack_from
+        offset = _HEADER.size
+        end = self._table_offset
+        while offset < end:
+            key_size, size = unpack_from(contents, offset)
+            value_offset = offset + 8 + key_size
+            yield contents[offset + 8:value_offset], value_offset, size
+            offset = value_offset + size + 4
+
+    def __iter__(self):
+        for key, offset, size in self._iter_entries():
+            yield key
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [self._map[offset:offset + size]
+                for key, offset, size in self._iter_entries()]
+
+    def items(self):
+        """Iterate over the ``(key, value)`` pairs in file order."""
+        contents = self._map
+        for key, offset, size in self._iter_entries():
+            yield key, contents[offset:offset + size]
+
+    def close(self):
+        if self._view is not self._map:
+            self._view.release()
+        try:
+            self._map.close()
+        except BufferError:
+            # There are still views returned from get_view() that
+            # reference the mmap.  The mmap will be closed when the
+            # last of these views is released.
+            pass
+
+
+def open(filename, verify_checksums=False):
+    """Open a frozen file written by ``export_frozen()``.
+
+    :param verify_checksums: Verify the checksum of each value that's
+        read (defaults to False).
+
+    :returns: A ``FrozenSemiDBM``.
+
+    """
+    return FrozenSemiDBM(filename, verify_checksums=verify_checksums)
@@ -0,0 +1,109 @@
+"""Index snapshots ("hint files").
+
+A hint file is a compact copy of the in memory index along with the
+offset in the data file that the copy covers.  Loading a db can then
+populate the index from the hint file and only replay the part of the
+data file that was written after the snapshot was taken.
+
+The data file is always the source of truth.  A hint file that is
+missing, corrupt, or does not match the data file is ignored, in which
+case the whole data file is replayed.
+
+"""
+import os
+import struct
+from binascii import crc32
+
+from semidbm import compat
+
+
+HINT_IDENTIFIER = b'\x53\x45\x4d\x48'
+# Major, Minor version.
+HINT_FORMAT_VERSION = (1, 0)
+# <magic><major><minor><data offset covered><data fingerprint>
+_HEADER = struct.Struct('!4sHHQI')
+# <keysize><value offset><valsize><key>
+_ENTRY = struct.Struct('!iqi')
+# The number of bytes at the end of the covered region of the data file
+# that are checksummed.  This is used to detect a hint file that belongs
+# to a different data file (e.g. the data file was compacted or replaced).
+_FINGERPRINT_SIZE = 64
+
+
+def data_fingerprint(data_filename, offset):
+    start = max(0, offset - _FINGERPRINT_SIZE)
+    with compat.file_open(data_filename, 'rb') as f:
+        f.seek(start)
+        contents = f.read(offset - start)
+    return crc32(contents) & 0xffffffff
+
+
+def write_hint(hint_filename, index, data_filename, offset, renamer):
+    """Write a snapshot of ``index`` covering ``data_filename`` up to
+    ``offset``.
+
+    The snapshot is written to a temporary file which is then renamed
+    over ``hint_filename`` so a crash never leaves a partial hint file.
+
+    """
+    parts = [_HEADER.pack(HINT_IDENTIFIER, HINT_FORMAT_VERSION[0],
+                          HINT_FORMAT_VERSION[1], offset,
+                          data_fingerprint(data_filename, offset))]
+    pack = _ENTRY.pack
+    for key, location in index.items():
+        parts.append(pack(len(key), location[0], location[1]))
+        parts.append(key)
+    body = b''.join(parts)
+    tmp_filename = hint_filename + '.tmp'
+    with compat.file_open(tmp_filename, 'wb') as f:
+        f.write(body)
+        f.write(struct.pack('!I', crc32(body) & 0xffffffff))
+        f.flush()
+        os.fsync(f.fileno())
+    if os.path.exists(hint_filename):
+        renamer(tmp_filename, hint_filename)
+    else:
+        os.rename(tmp_filename, hint_filename)
+
+
+def load_hint(hint_filename, data_filename, index):
+    """Populate ``index`` from a hint file.
+
+    Returns the offset in the data file covered by the hint file, or
+    ``None`` if the hint file is missing or stale, in which case
+    ``index`` is left untouched.
+
+    """
+    try:
+        with compat.file_open(hint_filename, 'rb') as f:
+            contents = f.read()
+    except (IOError, OSError):
+        return None
+    if len(contents) < _HEADER.size + 4:
+        return None
+    body = contents[:-4]
+    expected = struct.unpack('!I', contents[-4:])[0]
+    if crc32(body) & 0xffffffff != expected:
+        return None
+    magic, major, minor, offset, fingerprint = _HEADER.unpack_from(body)
+    if magic != HINT_IDENTIFIER or major != HINT_FORMAT_VERSION[0]:
+        return None
+    if os.path.getsize(data_filename) < offset:
+        return None
+    if data_fingerprint(data_filename, offset) != fingerprint:
+        return None
+    unpack_from = _ENTRY.unpack_from
+    entry_size = _ENTRY.size
+    current = _HEADER.size
+    end = len(body)
+    while current < end:
+        key_size, value_offset, size = unpack_from(body, current)
+        current += entry_size
+        index[body[current:current + key_size]] = (value_offset, size)
+        current += key_size
+    return offset
+
+
+def remove_hint(hint_filename):
+    if os.path.exists(hint_filename):
+        os.remove(hint_filename)
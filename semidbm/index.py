@@ -0,0 +1,167 @@
+"""Alternative in memory index implementations.
+
+The default index is a plain dict mapping a key to a tuple of
+``(offset, size)``.  The classes in this module provide the same
+mapping interface used by the db (``__getitem__``, ``__setitem__``,
+``__delitem__``, ``__contains__``, ``__iter__``, ``keys()``,
+``items()``) with different time/space tradeoffs.
+
+"""
+from array import array
+from bisect import bisect_left
+
+from semidbm import compat
+
+
+class CompactIndex(object):
+    """An index that stores offsets and sizes in packed arrays.
+
+    Each key maps to a slot number, and the offset and size of the value
+    are stored at that slot in two parallel arrays.  This avoids creating
+    a tuple and two int objects for every key, at the cost of slightly
+    slower lookups.  Slots freed by deletes are reused by later inserts.
+
+    """
+    def __init__(self):
+        self._slots = {}
+        self._offsets = array(compat.INT64_TYPECODE)
+        self._sizes = array('i')
+        self._free_slots = []
+
+    def __getitem__(self, key):
+        slot = self._slots[key]
+        return (self._offsets[slot], self._sizes[slot])
+
+    def __setitem__(self, key, location):
+        slot = self._slots.get(key)
+        if slot is None:
+            if self._free_slots:
+                slot = self._free_slots.pop()
+                self._offsets[slot] = location[0]
+                self._sizes[slot] = location[1]
+            else:
+                slot = len(self._offsets)
+                self._offsets.append(location[0])
+                self._sizes.append(location[1])
+            self._slots[key] = slot
+        else:
+            self._offsets[slot] = location[0]
+            self._sizes[slot] = location[1]
+
+    def __delitem__(self, key):
+        self._free_slots.append(self._slots.pop(key))
+
+    def __contains__(self, key):
+        return key in self._slots
+
+    def __iter__(self):
+        return iter(self._slots)
+
+    def __len__(self):
+        return len(self._slots)
+
+    def get(self, key, default=None):
+        slot = self._slots.get(key)
+        if slot is None:
+            return default
+        return (self._offsets[slot], self._sizes[slot])
+
+    def keys(self):
+        return self._slots.keys()
+
+    def items(self):
+        offsets = self._offsets
+        sizes = self._sizes
+        for key, slot in self._slots.items():
+            yield key, (offsets[slot], sizes[slot])
+
+
+class SortedIndex(object):
+    """A dict index that can also iterate over its keys in sorted order.
+
+    The sorted order is kept in a list of the keys.  The list is only
+    built (with a single sort) the first time an ordered iteration is
+    needed, so loading the index is as fast as loading a dict.  After
+    that, new and deleted keys are inserted into and removed from the
+    list with a binary search.  An ordered iteration costs
+    ``O(log n + k)`` for ``k`` keys.
+
+    """
+    def __init__(self):
+        self._locations = {}
+        self._sorted = None
+
+    def __getitem__(self, key):
+        return self._locations[key]
+
+    def __setitem__(self, key, location):
+        locations = self._locations
+        if self._sorted is not None and key not in locations:
+            keys = self._sorted
+            keys.insert(bisect_left(keys, key), key)
+        locations[key] = location
+
+    def __delitem__(self, key):
+        del self._locations[key]
+        if self._sorted is not None:
+            keys = self._sorted
+            del keys[bisect_left(keys, key)]
+
+    def __contains__(self, key):
+        return key in self._locations
+
+    def __iter__(self):
+        return iter(self._locations)
+
+    def __len__(self):
+        return len(self._locations)
+
+    def get(self, key, default=None):
+        return self._locations.get(key, default)
+
+    def keys(self):
+        return self._locations.keys()
+
+    def items(self):
+        return self._locations.items()
+
+    def update(self, locations):
+        if self._sorted is not None:
+            for key, location in locations.items():
+                self[key] = location
+        else:
+            self._locations.update(locations)
+
+    def iter_range(self, start=None, stop=None, reverse=False):
+        """Return the keys from ``start`` (inclusive) up to ``stop``
+        (exclusive) in sorted order.
+
+        ``None`` for ``start`` or ``stop`` means there's no lower or
+        upper bound.  The keys are copied out of the index, so the index
+        can be modified while iterating over them.
+
+        """
+        keys = self._sorted
+        if keys is None:
+            keys = self._sorted = sorted(self._locations)
+        lo = 0 if start is None else bisect_left(keys, start)
+        hi = len(keys) if stop is None else bisect_left(keys, stop)
+        if reverse:
+            return reversed(keys[lo:hi])
+        return iter(keys[lo:hi])
+
+    def iter_prefix(self, prefix, reverse=False):
+        """Return the keys that start with ``prefix`` in sorted order."""
+        return self.iter_range(prefix, prefix_end(prefix), reverse)
+
+
+def prefix_end(prefix):
+    """Return the smallest key greater than every key starting with
+    ``prefix``, or None if there isn't one."""
+    prefix = bytearray(prefix)
+    while prefix and prefix[-1] == 0xff:
+        prefix.pop()
+    if not prefix:
+        return None
+    prefix[-1] += 1
+    return bytes(prefix)
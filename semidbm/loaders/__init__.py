@@ -1,20 +1,101 @@
+import os
 import struct
+from binascii import crc32
 
 
 from semidbm.exceptions import DBMLoadError
+from semidbm import compat
 
 
 # Major, Minor version.
-FILE_FORMAT_VERSION = (1, 1)
+FILE_FORMAT_VERSION = (3, 0)
+# Version 2 added compressed values and version 3 added batches,
+# everything else is the same as version 1, so version 1 and 2 files
+# can still be read.
+READABLE_MAJOR_VERSIONS = (1, 2, 3)
 FILE_IDENTIFIER = b'\x53\x45\x4d\x49'
 _DELETED = -1
+# <keysize><valsize>
+_ENTRY_HEADER = struct.Struct('!ii')
+# A batch is a begin record, the entries of the batch, and a commit
+# record.  The begin record is an entry header with a key size of
+# _BATCH_BEGIN and the number of bytes of the entries as the value size.
+_BATCH_BEGIN = -2
+_BATCH_COMMIT = -3
+# <_BATCH_COMMIT><number of entries><crc32 of the entries>
+_BATCH_COMMIT_RECORD = struct.Struct('!iiI')
+# The number of bytes a batch adds to its entries.
+BATCH_OVERHEAD = _ENTRY_HEADER.size + _BATCH_COMMIT_RECORD.size
+
+
+def stored_size(size):
+    """Return the number of value bytes in the data file for a value size.
+
+    A value size of -1 marks a deleted key (no value bytes), and a value
+    size below -1 marks a compressed value of ``-1 - size`` bytes.
+
+    """
+    if size < 0:
+        return -1 - size
+    return size
+
+
+def parse_batch(data, start, body_size):
+    """Parse the entries of a batch.
+
+    ``start`` is the position in ``data`` of the batch's begin record,
+    whose value size is ``body_size``, and ``data`` must contain the
+    whole batch (``body_size + BATCH_OVERHEAD`` bytes).
+
+    Returns a list of ``(key, value position, value size)`` for the
+    entries of the batch, where the positions are indexes into ``data``,
+    or None if the batch wasn't committed (its commit record is missing
+    or doesn't match its entries).  A batch that wasn't committed must
+    not be replayed.
+
+    """
+    body_start = start + _ENTRY_HEADER.size
+    body_end = body_start + body_size
+    marker, count, checksum = _BATCH_COMMIT_RECORD.unpack_from(
+        data, body_end)
+    if (marker != _BATCH_COMMIT or
+            crc32(data[body_start:body_end]) & 0xffffffff != checksum):
+        return None
+    unpack_from = _ENTRY_HEADER.unpack_from
+    entries = []
+    current = body_start
+    while current < body_end:
+        key_size, val_size = unpack_from(data, current)
+        key_start = current + 8
+        value_position = key_start + key_size
+        # 4 bytes is for the checksum.
+        current = value_position + stored_size(val_size) + 4
+        if key_size < 0 or current > body_end:
+            return None
+        entries.append((data[key_start:value_position], value_position,
+                        val_size))
+    if len(entries) != count:
+        return None
+    return entries
+
+
+def _skip_commit_record(filename, offset):
+    # iter_keys() only yields entries, if the last one was the last
+    # entry of a batch, the batch ends after its commit record.
+    with compat.file_open(filename, 'rb') as f:
+        f.seek(offset)
+        record = f.read(_BATCH_COMMIT_RECORD.size)
+    if (len(record) == _BATCH_COMMIT_RECORD.size and
+            _BATCH_COMMIT_RECORD.unpack(record)[0] == _BATCH_COMMIT):
+        return offset + _BATCH_COMMIT_RECORD.size
+    return offset
 
 
 class DBMLoader(object):
     def __init__(self):
         pass
 
-    def iter_keys(self, filename):
+    def iter_keys(self, filename, start_offset=None):
         """Load the keys given a filename.
 
         Subclasses need to implement this method that accepts a filename and
@@ -25,16 +106,118 @@ class DBMLoader(object):
 
         Where key_name is the name of the key (bytes), offset is the integer
         offset within the file of the value associated with the key, and size
-        is the size of the value in bytes.
+        is the size of the value in bytes.  The size is negative for
+        deleted keys and compressed values (see ``stored_size()``).
+
+        If ``start_offset`` is given, it must be the offset of an entry
+        in the file, and only the entries at or after this offset are
+        iterated over.  The file header is still verified.
+
+        The entries of a batch are only yielded if the batch was
+        committed (see ``parse_batch()``).
         """
         raise NotImplementedError("iter_keys")
 
+    def load_index(self, filename, index, start_offset=None):
+        """Replay the entries of a data file into an index.
+
+        Every key that's set is mapped to ``(offset, size)`` in ``index``,
+        and every deleted key is removed from ``index``.  ``start_offset``
+        has the same meaning as for ``iter_keys()``.
+
+        This is how a db populates its index when it's loaded.  This
+        implementation is based on ``iter_keys()``, subclasses can provide
+        a faster one that doesn't create a tuple for every entry.
+
+        Returns the offset in the file just past the last entry that was
+        replayed, or the commit record of its batch (or the offset
+        replaying started at if there were no entries).
+        """
+        end = 8
+        if start_offset is not None and start_offset > end:
+            end = start_offset
+        for key_name, offset, size in self.iter_keys(filename, start_offset):
+            if size == _DELETED:
+                # This is a deleted item so we need to make sure that this
+                # value is not in the index.  We know that the key is already
+                # in the index, because a delete is only written to the index
+                # if the key already exists in the db.
+                del index[key_name]
+            else:
+                index[key_name] = (offset, size)
+            # 4 bytes is for the checksum.
+            end = offset + stored_size(size) + 4
+        return _skip_commit_record(filename, end)
+
+    def load_tail(self, filename, index, start_offset, end_offset=None):
+        """Replay the entries appended to a data file into an index.
+
+        This is used to follow a data file that's being written to by
+        another process.  ``start_offset`` must be the offset of an entry
+        (usually the offset returned by a previous ``load_index()`` or
+        ``load_tail()``).  Unlike ``load_index()``, an entry that's only
+        partially written (a torn tail) isn't an error, replaying stops
+        before it, and a deleted key that isn't in ``index`` is ignored,
+        so entries that were already replayed can be replayed again.
+
+        :param end_offset: Only replay the entries that end at or before
+            this offset (defaults to the size of the file).
+
+        Returns the offset just past the last entry that was replayed,
+        which is where the next ``load_tail()`` should start.
+        """
+        unpack = _ENTRY_HEADER.unpack
+        with compat.file_open(filename, 'rb') as f:
+            self._verify_header(f.read(8))
+            if end_offset is None:
+                end_offset = os.fstat(f.fileno()).st_size
+            f.seek(start_offset)
+            end = start_offset
+            while end + 8 <= end_offset:
+                header = f.read(8)
+                if len(header) < 8:
+                    break
+                key_size, val_size = unpack(header)
+                if key_size == _BATCH_BEGIN:
+                    batch_end = end + val_size + BATCH_OVERHEAD
+                    if val_size < 0 or batch_end > end_offset:
+                        break
+                    data = header + f.read(batch_end - end - 8)
+                    if len(data) != batch_end - end:
+                        break
+                    entries = parse_batch(data, 0, val_size)
+                    # A batch that wasn't committed is skipped.
+                    for key, position, size in entries or ():
+                        if size == _DELETED:
+                            if key in index:
+                                del index[key]
+                        else:
+                            index[key] = (end + position, size)
+                    end = batch_end
+                    continue
+                if key_size < 0:
+                    break
+                key = f.read(key_size)
+                stored = stored_size(val_size)
+                # 4 bytes is for the checksum.
+                entry_end = end + 8 + key_size + stored + 4
+                if len(key) != key_size or entry_end > end_offset:
+                    break
+                if val_size == _DELETED:
+                    if key in index:
+                        del index[key]
+                else:
+                    index[key] = (end + 8 + key_size, val_size)
+                f.seek(stored + 4, os.SEEK_CUR)
+                end = entry_end
+        return end
+
     def _verify_header(self, header):
         sig = header[:4]
         if sig != FILE_IDENTIFIER:
             raise DBMLoadError("File is not a semidbm db file.")
         major, minor = struct.unpack('!HH', header[4:])
-        if major != FILE_FORMAT_VERSION[0]:
+        if major not in READABLE_MAJOR_VERSIONS:
             raise DBMLoadError(
                 'Incompatible file version (got: v%s, can handle: v%s)' % (
-                    (major, FILE_FORMAT_VERSION[0])))
+                    (major, ', v'.join(map(str, READABLE_MAJOR_VERSIONS)))))
@@ -3,7 +3,8 @@ import mmap
 import struct
 
 
-from semidbm.loaders import DBMLoader, _DELETED
+from semidbm.loaders import DBMLoader, _DELETED, _ENTRY_HEADER
+from semidbm.loaders import _BATCH_BEGIN, BATCH_OVERHEAD, parse_batch
 from semidbm.exceptions import DBMLoadError
 from semidbm import compat
 
@@ -15,12 +16,11 @@ class MMapLoader(DBMLoader):
     def __init__(self):
         pass
 
-    def iter_keys(self, filename):
+    def iter_keys(self, filename, start_offset=None):
         # yields keyname, offset, size
         f = compat.file_open(filename, 'rb')
         header = f.read(8)
         self._verify_header(header)
-        contents = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
         remap_size = mmap.ALLOCATIONGRANULARITY * _MAPPED_LOAD_PAGES
         # We need to track the max_index to use as the upper bound
         # in the .find() calls to be compatible with python 2.6.
@@ -35,6 +35,19 @@ class MMapLoader(DBMLoader):
         file_size_bytes = max_index
         num_resizes = 0
         current = 8
+        if start_offset is not None and start_offset > current:
+            # mmap offsets have to be a multiple of the allocation
+            # granularity, so we start from the remap window that
+            # contains start_offset.
+            num_resizes = start_offset // remap_size
+            current = start_offset - (num_resizes * remap_size)
+            max_index -= num_resizes * remap_size
+        if current >= max_index:
+            f.close()
+            return
+        offset = num_resizes * remap_size
+        contents = mmap.mmap(f.fileno(), file_size_bytes - offset,
+                             access=mmap.ACCESS_READ, offset=offset)
         try:
             while current != max_index:
                 try:
@@ -42,21 +55,36 @@ class MMapLoader(DBMLoader):
                         '!ii', contents[current:current+8])
                 except struct.error:
                     raise DBMLoadError()
-                key = contents[current+8:current+8+key_size]
-                if len(key) != key_size:
-                    raise DBMLoadError()
-                offset = (remap_size * num_resizes) + current + 8 + key_size
-                if offset + val_size > file_size_bytes:
-                    # If this happens then the index is telling us
-                    # to read past the end of the file.  What we need
-                    # to do is stop reading from the index.
-                    return
-                yield (key, offset, val_size)
-                if val_size == _DELETED:
-                    val_size = 0
-                # Also need to skip past the 4 byte checksum, hence
-                # the '+ 4' at the end
-                current = current + 8 + key_size + val_size + 4
+                base = remap_size * num_resizes
+                if key_size == _BATCH_BEGIN:
+                    if val_size < 0:
+                        raise DBMLoadError("Bad batch size: %s" % val_size)
+                    batch_end = current + val_size + BATCH_OVERHEAD
+                    if base + batch_end > file_size_bytes:
+                        # The batch was never completely written.
+                        return
+                    for key, position, size in (
+                            parse_batch(contents, current, val_size) or ()):
+                        yield (key, base + position, size)
+                    current = batch_end
+                else:
+                    key = contents[current+8:current+8+key_size]
+                    if len(key) != key_size:
+                        raise DBMLoadError()
+                    offset = base + current + 8 + key_size
+                    stored = val_size
+                    if stored < 0:
+                        # A delete or a compressed value.
+                        stored = _DELETED - val_size
+                    if offset + stored > file_size_bytes:
+                        # If this happens then the index is telling us
+                        # to read past the end of the file.  What we need
+                        # to do is stop reading from the index.
+                        return
+                    yield (key, offset, val_size)
+                    # Also need to skip past the 4 byte checksum, hence
+                    # the '+ 4' at the end
+                    current = current + 8 + key_size + stored + 4
                 if current >= remap_size:
                     contents.close()
                     num_resizes += 1
@@ -75,3 +103,67 @@ class MMapLoader(DBMLoader):
         finally:
             contents.close()
             f.close()
+
+    def load_index(self, filename, index, start_offset=None):
+        # The entry headers are unpacked straight from the mmap, so the
+        # only object created for an entry (besides the index entry
+        # itself) is the key.
+        f = compat.file_open(filename, 'rb')
+        try:
+            header = f.read(8)
+            self._verify_header(header)
+            file_size_bytes = os.path.getsize(filename)
+            current = 8
+            if start_offset is not None and start_offset > current:
+                current = start_offset
+            if current >= file_size_bytes:
+                return current
+            contents = mmap.mmap(f.fileno(), file_size_bytes,
+                                 access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        unpack_from = _ENTRY_HEADER.unpack_from
+        try:
+            while current < file_size_bytes:
+                if current + 8 > file_size_bytes:
+                    raise DBMLoadError()
+                key_size, val_size = unpack_from(contents, current)
+                if key_size == _BATCH_BEGIN:
+                    if val_size < 0:
+                        raise DBMLoadError("Bad batch size: %s" % val_size)
+                    batch_end = current + val_size + BATCH_OVERHEAD
+                    if batch_end > file_size_bytes:
+                        # The batch was never completely written.
+                        return current
+                    for key, position, size in (
+                            parse_batch(contents, current, val_size) or ()):
+                        if size == _DELETED:
+                            del index[key]
+                        else:
+                            index[key] = (position, size)
+                    current = batch_end
+                    continue
+                value_offset = current + 8 + key_size
+                if value_offset > file_size_bytes:
+                    raise DBMLoadError()
+                stored = val_size
+                if stored < 0:
+                    # A delete or a compressed value.
+                    stored = _DELETED - val_size
+                if value_offset + stored > file_size_bytes:
+                    # If this happens then the index is telling us
+                    # to read past the end of the file.  What we need
+                    # to do is stop reading from the index.
+                    return current
+                if val_size == _DELETED:
+                    del index[contents[current + 8:value_offset]]
+                else:
+                    index[contents[current + 8:value_offset]] = (
+                        value_offset, val_size)
+                # Also need to skip past the 4 byte checksum.
+                current = value_offset + stored + 4
+            if current > file_size_bytes:
+                raise DBMLoadError()
+            return current
+        finally:
+            contents.close()
@@ -1,20 +1,28 @@
 import os
 import struct
 
-from semidbm.loaders import DBMLoader, _DELETED
+from semidbm.loaders import DBMLoader, _DELETED, _ENTRY_HEADER
+from semidbm.loaders import _BATCH_BEGIN, BATCH_OVERHEAD, parse_batch
 from semidbm.exceptions import DBMLoadError
 
 
+# The number of bytes read at a time by load_index().
+_READ_SIZE = 1024 * 1024
+
+
 class SimpleFileLoader(DBMLoader):
     def __init__(self):
         pass
 
-    def iter_keys(self, filename):
+    def iter_keys(self, filename, start_offset=None):
         # yields keyname, offset, size
         with open(filename, 'rb') as f:
             header = f.read(8)
             self._verify_header(header)
             current_offset = 8
+            if start_offset is not None and start_offset > current_offset:
+                current_offset = start_offset
+                f.seek(current_offset)
             file_size_bytes = os.path.getsize(filename)
             while True:
                 current_contents = f.read(8)
@@ -29,6 +37,21 @@ class SimpleFileLoader(DBMLoader):
                         return
                 key_size, val_size = struct.unpack(
                     '!ii', current_contents)
+                if key_size == _BATCH_BEGIN:
+                    if val_size < 0:
+                        raise DBMLoadError("Bad batch size: %s" % val_size)
+                    batch_start = current_offset - 8
+                    batch_end = batch_start + val_size + BATCH_OVERHEAD
+                    if batch_end > file_size_bytes:
+                        # The batch was never completely written.
+                        return
+                    data = current_contents + f.read(
+                        batch_end - current_offset)
+                    for key, position, size in (
+                            parse_batch(data, 0, val_size) or ()):
+                        yield (key, batch_start + position, size)
+                    current_offset = batch_end
+                    continue
                 key = f.read(key_size)
                 if len(key) != key_size:
                     raise DBMLoadError(
@@ -36,16 +59,103 @@ class SimpleFileLoader(DBMLoader):
                         "(expected %s bytes, got %s instead."
                         % (key_size, len(key)))
                 value_offset = current_offset + key_size
-                if value_offset + val_size > file_size_bytes:
+                stored = val_size
+                if stored < 0:
+                    # A delete or a compressed value.
+                    stored = _DELETED - val_size
+                if value_offset + stored > file_size_bytes:
                     return
                 yield (key, value_offset, val_size)
-                if val_size == _DELETED:
-                    val_size = 0
                 # 4 bytes is for the checksum.
-                skip_ahead = key_size + val_size + 4
+                skip_ahead = key_size + stored + 4
                 current_offset += skip_ahead
                 if current_offset > file_size_bytes:
                     raise DBMLoadError(
                         "Error loading db: reading past the "
                         "end of the file (file possibly truncated)")
                 f.seek(current_offset)
+
+    def load_index(self, filename, index, start_offset=None):
+        # Entries are parsed from large reads of the data file instead
+        # of reading each entry separately.  Only the header and the key
+        # of an entry need to be in the buffer, the reads skip over
+        # values that are larger than the buffer.
+        unpack_from = _ENTRY_HEADER.unpack_from
+        with open(filename, 'rb') as f:
+            header = f.read(8)
+            self._verify_header(header)
+            # The offset in the file of buf[0].
+            base = 8
+            if start_offset is not None and start_offset > base:
+                base = start_offset
+                f.seek(base)
+            file_size_bytes = os.path.getsize(filename)
+            buf = f.read(_READ_SIZE)
+            # The position in buf of the next entry.
+            i = 0
+            while True:
+                buf_size = len(buf)
+                while i + 8 <= buf_size:
+                    key_size, val_size = unpack_from(buf, i)
+                    if key_size == _BATCH_BEGIN:
+                        if val_size < 0:
+                            raise DBMLoadError(
+                                "Bad batch size: %s" % val_size)
+                        batch_end = i + val_size + BATCH_OVERHEAD
+                        if base + batch_end > file_size_bytes:
+                            # The batch was never completely written.
+                            return base + i
+                        if batch_end > buf_size:
+                            break
+                        for key, position, size in (
+                                parse_batch(buf, i, val_size) or ()):
+                            if size == _DELETED:
+                                del index[key]
+                            else:
+                                index[key] = (base + position, size)
+                        i = batch_end
+                        continue
+                    key_end = i + 8 + key_size
+                    if key_end > buf_size:
+                        break
+                    value_offset = base + key_end
+                    stored = val_size
+                    if stored < 0:
+                        # A delete or a compressed value.
+                        stored = _DELETED - val_size
+                    if value_offset + stored > file_size_bytes:
+                        return base + i
+                    if val_size == _DELETED:
+                        del index[buf[i + 8:key_end]]
+                    else:
+                        index[buf[i + 8:key_end]] = (value_offset, val_size)
+                    # 4 bytes is for the checksum.
+                    i = key_end + stored + 4
+                if i >= buf_size:
+                    # The next entry starts at or past the end of the
+                    # buffer.
+                    base += i
+                    if base > file_size_bytes:
+                        raise DBMLoadError(
+                            "Error loading db: reading past the "
+                            "end of the file (file possibly truncated)")
+                    if i > buf_size:
+                        f.seek(base)
+                    buf = f.read(_READ_SIZE)
+                    i = 0
+                    if not buf:
+                        return base
+                else:
+                    # The next entry is only partially in the buffer.
+                    more = f.read(_READ_SIZE)
+                    if not more:
+                        if buf_size - i < 8:
+                            raise DBMLoadError(
+                                'Error loading db: partial header read')
+                        raise DBMLoadError(
+                            "Error loading db: key size does not match "
+                            "(expected %s bytes, got %s instead."
+                            % (key_size, buf_size - i - 8))
+                    base += i
+                    buf = buf[i:] + more
+                    i = 0
@@ -0,0 +1,86 @@
+"""Operation counters and latency histograms."""
+import threading
+from bisect import bisect_left
+
+
+# The upper bounds, in seconds, of the latency histogram buckets.  A
+# final bucket counts everything slower than the last bound.
+LATENCY_BUCKETS = (
+    0.00001, 0.00002, 0.00005,
+    0.0001, 0.0002, 0.0005,
+    0.001, 0.002, 0.005,
+    0.01, 0.02, 0.05,
+    0.1, 0.2, 0.5,
+    1.0, 2.0, 5.0,
+    10.0,
+)
+# The operations whose latency is recorded.
+OPERATIONS = ('get', 'set', 'delete', 'get_many', 'set_many', 'delete_many',
+              'batch', 'sync', 'fsync', 'compact', 'load')
+COUNTERS = ('bytes_read', 'bytes_written', 'get_misses',
+            'checksum_failures')
+
+
+class LatencyHistogram(object):
+    """A histogram of latencies with fixed buckets.
+
+    Besides the count of each bucket, the total number of latencies
+    recorded, their sum, and the largest one are kept, so the mean can
+    be computed from a snapshot.
+
+    """
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds, bisect_left=bisect_left):
+        self.counts[bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'max': self.max,
+            'bounds': list(self.bounds),
+            'counts': list(self.counts),
+        }
+
+
+class Metrics(object):
+    """The counters and latency histograms of a db.
+
+    Updates are made with a lock held, the group commit thread records
+    fsyncs while other threads record reads and writes.
+
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._counters = dict((name, 0) for name in COUNTERS)
+            self._latencies = dict((name, LatencyHistogram())
+                                   for name in OPERATIONS)
+
+    def record(self, operation, seconds):
+        with self._lock:
+            self._latencies[operation].record(seconds)
+
+    def add(self, counter, amount=1):
+        with self._lock:
+            self._counters[counter] += amount
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            for name, histogram in self._latencies.items():
+                stats[name] = histogram.snapshot()
+        return stats
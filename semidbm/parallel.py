@@ -0,0 +1,248 @@
+"""Parallel index loading.
+
+Entries in a data file have variable sizes, so a data file can't be
+split into regions that can be parsed independently without knowing
+where entries start.  A db that's loaded in parallel keeps a
+"boundaries" side file in the db directory, which lists the offsets of
+entries roughly every ``BOUNDARY_INTERVAL`` bytes, up to the offset
+covered by the file.
+
+To load the index, the data file is split into regions at these offsets
+and each region is parsed in a separate process.  The part of the data
+file written after the boundaries file is parsed as one final region,
+which also finds the boundaries in that part of the file.  Each process
+returns the last location of every key set in its region and the keys
+whose last entry in its region is a delete.  These partial indexes are
+merged in file order, so later entries always win.
+
+Like hint files, the data file is the source of truth.  A boundaries
+file that's missing, corrupt, or doesn't match the data file is
+ignored, in which case the whole data file is parsed as one region.
+
+"""
+import os
+import struct
+from binascii import crc32
+try:
+    import mmap
+except ImportError:
+    mmap = None
+
+from semidbm import compat
+from semidbm.exceptions import DBMLoadError
+from semidbm.hint import data_fingerprint
+from semidbm.loaders import _DELETED
+from semidbm.loaders import _BATCH_BEGIN, BATCH_OVERHEAD, parse_batch
+
+
+BOUNDARIES_IDENTIFIER = b'\x53\x45\x4d\x42'
+# Major, Minor version.
+BOUNDARIES_FORMAT_VERSION = (1, 0)
+# <magic><major><minor><data offset covered><data fingerprint><count>
+_HEADER = struct.Struct('!4sHHQIQ')
+# <keysize><valsize>
+_ENTRY_HEADER = struct.Struct('!ii')
+BOUNDARY_INTERVAL = 16 * 1024 * 1024
+# Data files with less than this many bytes to load are always loaded
+# in a single process, starting the processes would take longer.
+MIN_PARALLEL_SIZE = 4 * BOUNDARY_INTERVAL
+
+
+def write_boundaries(boundaries_filename, boundaries, data_filename,
+                     offset, renamer):
+    """Write the entry offsets in ``boundaries`` covering
+    ``data_filename`` up to ``offset``."""
+    body = _HEADER.pack(BOUNDARIES_IDENTIFIER, BOUNDARIES_FORMAT_VERSION[0],
+                        BOUNDARIES_FORMAT_VERSION[1], offset,
+                        data_fingerprint(data_filename, offset),
+                        len(boundaries))
+    body += struct.pack('!%dQ' % len(boundaries), *boundaries)
+    tmp_filename = boundaries_filename + '.tmp'
+    with compat.file_open(tmp_filename, 'wb') as f:
+        f.write(body)
+        f.write(struct.pack('!I', crc32(body) & 0xffffffff))
+        f.flush()
+        os.fsync(f.fileno())
+    if os.path.exists(boundaries_filename):
+        renamer(tmp_filename, boundaries_filename)
+    else:
+        os.rename(tmp_filename, boundaries_filename)
+
+
+def load_boundaries(boundaries_filename, data_filename):
+    """Return ``(boundaries, covered offset)`` from a boundaries file.
+
+    Returns ``([], None)`` if the boundaries file is missing or stale.
+
+    """
+    try:
+        with compat.file_open(boundaries_filename, 'rb') as f:
+            contents = f.read()
+    except (IOError, OSError):
+        return [], None
+    if len(contents) < _HEADER.size + 4:
+        return [], None
+    body = contents[:-4]
+    expected = struct.unpack('!I', contents[-4:])[0]
+    if crc32(body) & 0xffffffff != expected:
+        return [], None
+    magic, major, minor, offset, fingerprint, count = _HEADER.unpack_from(
+        body)
+    if magic != BOUNDARIES_IDENTIFIER or \
+            major != BOUNDARIES_FORMAT_VERSION[0] or \
+            len(body) != _HEADER.size + count * 8:
+        return [], None
+    if os.path.getsize(data_filename) < offset:
+        return [], None
+    if data_fingerprint(data_filename, offset) != fingerprint:
+        return [], None
+    boundaries = list(struct.unpack_from('!%dQ' % count, body, _HEADER.size))
+    return boundaries, offset
+
+
+def remove_boundaries(boundaries_filename):
+    if os.path.exists(boundaries_filename):
+        os.remove(boundaries_filename)
+
+
+def can_load_in_parallel():
+    return mmap is not None
+
+
+def parse_region(task):
+    """Parse the entries of a region of a data file.
+
+    ``task`` is a tuple of ``(filename, start, end, interval)``.  ``start``
+    must be the offset of an entry, and ``end`` either the offset of an
+    entry or None to parse until the end of the file.
+
+    Returns a tuple of ``(live, deleted, boundaries, end)``, where ``live``
+    maps each key set in the region to its last ``(offset, size)``,
+    ``deleted`` is the set of keys whose last entry is a delete,
+    ``boundaries`` are the offsets of the first entry after every
+    multiple of ``interval`` bytes, and ``end`` is the offset the
+    region was parsed up to.
+
+    """
+    filename, start, end, interval = task
+    live = {}
+    deleted = set()
+    boundaries = []
+    with compat.file_open(filename, 'rb') as f:
+        file_size_bytes = os.fstat(f.fileno()).st_size
+        if end is None:
+            end = file_size_bytes
+        if start >= end:
+            return live, deleted, boundaries, start
+        contents = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    unpack_from = _ENTRY_HEADER.unpack_from
+    next_boundary = (start // interval + 1) * interval
+    current = start
+    try:
+        while current < end:
+            if current >= next_boundary:
+                boundaries.append(current)
+                next_boundary = (current // interval + 1) * interval
+            if current + 8 > file_size_bytes:
+                raise DBMLoadError('Error loading db: partial header read')
+            key_size, val_size = unpack_from(contents, current)
+            if key_size == _BATCH_BEGIN:
+                if val_size < 0:
+                    raise DBMLoadError(
+                        'Error loading db: bad batch size %s' % val_size)
+                batch_end = current + val_size + BATCH_OVERHEAD
+                if batch_end > file_size_bytes:
+                    # The last write was interrupted.
+                    break
+                for key, position, size in (
+                        parse_batch(contents, current, val_size) or ()):
+                    if size == _DELETED:
+                        live.pop(key, None)
+                        deleted.add(key)
+                    else:
+                        live[key] = (position, size)
+                        deleted.discard(key)
+                current = batch_end
+                continue
+            value_offset = current + 8 + key_size
+            stored = val_size
+            if stored < 0:
+                # A delete or a compressed value.
+                stored = _DELETED - val_size
+            if value_offset + stored > file_size_bytes:
+                # The last write was interrupted.
+                break
+            key = contents[current + 8:value_offset]
+            if val_size == _DELETED:
+                live.pop(key, None)
+                deleted.add(key)
+            else:
+                live[key] = (value_offset, val_size)
+                deleted.discard(key)
+            # 4 bytes is for the checksum.
+            current = value_offset + stored + 4
+            if current > file_size_bytes:
+                raise DBMLoadError(
+                    "Error loading db: reading past the "
+                    "end of the file (file possibly truncated)")
+    finally:
+        contents.close()
+    return live, deleted, boundaries, current
+
+
+def load_index(filename, index, start_offset, workers, boundaries_filename):
+    """Load the entries of ``filename`` from ``start_offset`` on into
+    ``index`` using up to ``workers`` processes.
+
+    Returns a tuple of ``(end, new_boundaries)``.  ``end`` is the offset
+    just past the last complete entry that was loaded.  ``new_boundaries``
+    is None if the boundaries file is up to date, otherwise a tuple of
+    ``(boundaries, covered offset)`` describing the whole data file that
+    can be written to a new boundaries file.
+
+    """
+    known, covered = load_boundaries(boundaries_filename, filename)
+    up_to_date = covered is not None
+    if covered is None or covered < start_offset:
+        covered = start_offset
+    boundaries = [offset for offset in known if offset <= start_offset]
+    starts = [start_offset] + [offset for offset in known
+                               if start_offset < offset < covered]
+    if covered > start_offset:
+        starts.append(covered)
+    ends = starts[1:] + [None]
+    tasks = [(filename, start, end, BOUNDARY_INTERVAL)
+             for start, end in zip(starts, ends)]
+    if len(tasks) == 1 or workers < 2:
+        results = map(parse_region, tasks)
+        pool = None
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(min(workers, len(tasks)))
+        # imap returns the results in order, so they can be merged
+        # while the remaining regions are still being parsed.
+        results = pool.imap(parse_region, tasks)
+    update = getattr(index, 'update', None)
+    end = start_offset
+    try:
+        for live, deleted, found, end in results:
+            for key in deleted:
+                if key in index:
+                    del index[key]
+            if update is not None:
+                update(live)
+            else:
+                for key, location in live.items():
+                    index[key] = location
+            if found:
+                # Only the last region, which is parsed past the offset
+                # covered by the boundaries file, finds new boundaries.
+                boundaries.extend(found)
+                up_to_date = False
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    if up_to_date:
+        return end, None
+    return end, (boundaries, end)
@@ -0,0 +1,234 @@
+"""Verifying the checksums of a whole data file.
+
+Checking the checksum of each value as it's read (``verify_checksums``)
+only finds corruption in the values that happen to be read, and reading
+every key through the db is a random read per key.  ``verify_file()``
+instead streams the data file from start to end with large sequential
+reads and checks the checksum of every entry, so it runs at the
+sequential read bandwidth of the disk.
+
+The data file is split into regions at the offsets of live entries
+(known from the index), roughly every ``REGION_SIZE`` bytes.  Regions
+are verified in order, and for large data files they can be verified in
+separate processes, which spreads the checksum computations over
+multiple CPUs.  By default only the live entries (the last entry of
+each key) are verified.  Superseded entries and deletes are skipped
+without computing their checksums, and skipped values that aren't in
+the current read buffer aren't read at all.
+
+"""
+import struct
+from array import array
+from bisect import bisect_left
+from binascii import crc32
+
+from semidbm import compat
+from semidbm.loaders import _BATCH_BEGIN, _BATCH_COMMIT, _BATCH_COMMIT_RECORD
+
+
+REGION_SIZE = 16 * 1024 * 1024
+# Data files with less than this many bytes to verify are always
+# verified in a single process, starting the processes would take
+# longer.
+MIN_PARALLEL_SIZE = 4 * REGION_SIZE
+# The number of bytes read at a time.
+_READ_SIZE = 4 * 1024 * 1024
+# <keysize><valsize>
+_ENTRY_HEADER = struct.Struct('!ii')
+_CHECKSUM = struct.Struct('!I')
+
+
+def verify_file(filename, end_offset, locations, include_superseded=False,
+                workers=0, progress_callback=None):
+    """Verify the checksums of the entries of a data file.
+
+    :param end_offset: The offset of the end of the last entry to
+        verify.
+
+    :param locations: An iterable of ``(key, (offset, size))`` for the
+        live keys of the data file (the items of the db's index).
+
+    :param include_superseded: Also verify the superseded entries and
+        the deletes.
+
+    :param workers: The number of processes to verify the data file
+        with.  Only data files with at least ``MIN_PARALLEL_SIZE`` bytes
+        are verified in parallel.
+
+    :param progress_callback: Called with the number of bytes verified
+        so far and the total number of bytes to verify, after each
+        region is verified.
+
+    :returns: A list of ``(offset, key)`` for the entries whose checksum
+        doesn't match, in file order, where ``offset`` is the offset of
+        the start of the entry.  If an entry's header is corrupt, the
+        entries after it in its region can't be found, in which case
+        ``(offset, None)`` is reported and the rest of the region is
+        skipped.
+
+    """
+    value_offsets = []
+    entry_offsets = []
+    for key, location in locations:
+        value_offsets.append(location[0])
+        entry_offsets.append(location[0] - 8 - len(key))
+    value_offsets.sort()
+    entry_offsets.sort()
+    starts = _split_regions(entry_offsets, 8, end_offset, REGION_SIZE)
+    ends = starts[1:] + [end_offset]
+    tasks = []
+    for start, end in zip(starts, ends):
+        if include_superseded:
+            live = None
+        else:
+            live = array(compat.INT64_TYPECODE, value_offsets[
+                bisect_left(value_offsets, start):
+                bisect_left(value_offsets, end)])
+        tasks.append((filename, start, end, live))
+    total = end_offset - 8
+    if workers < 2 or len(tasks) < 2 or total < MIN_PARALLEL_SIZE:
+        results = map(verify_region, tasks)
+        pool = None
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(min(workers, len(tasks)))
+        # imap returns the results in order, so progress is reported
+        # while the remaining regions are still being verified.
+        results = pool.imap(verify_region, tasks)
+    bad = []
+    verified = 0
+    try:
+        for (filename, start, end, live), region_bad in zip(tasks, results):
+            bad.extend(region_bad)
+            verified += end - start
+            if progress_callback is not None:
+                progress_callback(verified, total)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return bad
+
+
+def _split_regions(entry_offsets, start, end, region_size):
+    # Returns the start offsets of regions of at least region_size
+    # bytes, which are all offsets of entries.
+    starts = [start]
+    next_start = start + region_size
+    i = bisect_left(entry_offsets, next_start)
+    while i < len(entry_offsets) and entry_offsets[i] < end:
+        starts.append(entry_offsets[i])
+        next_start = entry_offsets[i] + region_size
+        i = bisect_left(entry_offsets, next_start, i)
+    return starts
+
+
+def verify_region(task):
+    """Verify the checksums of the entries of a region of a data file.
+
+    ``task`` is a tuple of ``(filename, start, end, live)``.  ``start``
+    must be the offset of an entry and ``end`` the offset of the end of
+    an entry.  ``live`` is a sorted array of the value offsets of the
+    live entries in the region, only these entries are verified, or None
+    to verify every entry.
+
+    Returns a list of ``(offset, key)`` of the corrupt entries (see
+    ``verify_file()``).
+
+    """
+    filename, start, end, live = task
+    bad = []
+    unpack_from = _ENTRY_HEADER.unpack_from
+    unpack_checksum = _CHECKSUM.unpack_from
+    check_all = live is None
+    if check_all:
+        live = ()
+    num_live = len(live)
+    next_live = 0
+    with compat.file_open(filename, 'rb') as f:
+        f.seek(start)
+        buf = b''
+        view = memoryview(buf)
+        buf_size = 0
+        # The position in buf of the entry at current.
+        i = 0
+        current = start
+        while current < end:
+            if buf_size - i < 8:
+                buf, i = _refill(f, buf, i, 8, end - current)
+                view = memoryview(buf)
+                buf_size = len(buf)
+                if buf_size < 8:
+                    bad.append((current, None))
+                    break
+            key_size, val_size = unpack_from(buf, i)
+            if key_size == _BATCH_BEGIN or key_size == _BATCH_COMMIT:
+                # The entries of a batch have their own checksums, so
+                # its begin and commit records are stepped over.
+                if key_size == _BATCH_BEGIN:
+                    record_size = 8
+                else:
+                    record_size = _BATCH_COMMIT_RECORD.size
+                if current + record_size > end:
+                    bad.append((current, None))
+                    break
+                if buf_size - i >= record_size:
+                    i += record_size
+                else:
+                    f.seek(current + record_size)
+                    buf = b''
+                    buf_size = 0
+                    i = 0
+                current += record_size
+                continue
+            stored = val_size
+            if stored < 0:
+                # A delete or a compressed value.
+                stored = -1 - val_size
+            # 4 bytes is for the checksum.
+            entry_size = 8 + key_size + stored + 4
+            if key_size < 0 or current + entry_size > end:
+                bad.append((current, None))
+                break
+            if check_all:
+                check = True
+            else:
+                value_offset = current + 8 + key_size
+                while next_live < num_live and live[next_live] < value_offset:
+                    next_live += 1
+                check = (next_live < num_live and
+                         live[next_live] == value_offset)
+            if check:
+                if buf_size - i < entry_size:
+                    buf, i = _refill(f, buf, i, entry_size, end - current)
+                    view = memoryview(buf)
+                    buf_size = len(buf)
+                    if buf_size < entry_size:
+                        bad.append((current, None))
+                        break
+                checksum_offset = i + entry_size - 4
+                if crc32(view[i + 8:checksum_offset]) & 0xffffffff != \
+                        unpack_checksum(buf, checksum_offset)[0]:
+                    bad.append((current, buf[i + 8:i + 8 + key_size]))
+                i += entry_size
+            elif buf_size - i >= entry_size:
+                i += entry_size
+            else:
+                # Skip the rest of the entry without reading it.
+                f.seek(current + entry_size)
+                buf = b''
+                buf_size = 0
+                i = 0
+            current += entry_size
+    return bad
+
+
+def _refill(f, buf, i, needed, remaining):
+    # Returns the unread part of buf followed by more of the file, with
+    # at least needed bytes (unless the region ends first).
+    unread = buf[i:]
+    size = max(_READ_SIZE, needed - len(unread))
+    size = min(size, remaining - len(unread))
+    if size <= 0:
+        return unread, 0
+    return unread + f.read(size), 0
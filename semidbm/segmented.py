@@ -0,0 +1,396 @@
+"""Segmented data file storage.
+
+Instead of a single data file, a segmented db appends to the newest of a
+sequence of segment files, and starts a new segment once the current
+one reaches a size threshold.  Compaction only rewrites the segments
+where enough of the data has been superseded or deleted, so its cost
+depends on how much data has changed rather than on the size of the db.
+
+Segment files have the same format as a regular data file and are
+named ``segment.<sequence>.<generation>``.  The index is rebuilt by
+replaying the segments ordered by ``(sequence, generation)``.  Merging a
+set of segments writes the live entries of those segments to a new
+segment that has the sequence of the newest merged segment and the next
+generation, so it's replayed right after the segments it replaces and
+before any newer segments.
+
+The index keeps the ``(offset, size)`` format of a regular db.  The
+offset encodes the segment as well as the offset within the segment
+file: ``(slot << _SEGMENT_SHIFT) | offset``, where the slot is the
+position of the segment in the db's list of segments.  Slots are only
+meaningful for the lifetime of a db object.
+
+"""
+import os
+import re
+import struct
+
+from semidbm import compat
+from semidbm.db import (_SemiDBM, _SemiDBMReadOnly, _SemiDBMReadWrite,
+                        _SemiDBMNew, _pack_delete, _write_all)
+from semidbm.exceptions import DBMError, DBMLoadError
+from semidbm.loaders import _DELETED, FILE_FORMAT_VERSION, FILE_IDENTIFIER
+from semidbm.loaders import stored_size
+
+
+_SEGMENT_SHIFT = 40
+_OFFSET_MASK = (1 << _SEGMENT_SHIFT) - 1
+_SEGMENT_FILENAME = re.compile(r'^segment\.(\d+)\.(\d+)$')
+_READ_FLAGS = os.O_RDONLY | getattr(os, 'O_BINARY', 0)
+DEFAULT_MERGE_THRESHOLD = 0.5
+
+
+class _Segment(object):
+    def __init__(self, slot, sequence, generation, filename):
+        self.slot = slot
+        self.sequence = sequence
+        self.generation = generation
+        self.filename = filename
+        self.fd = None
+
+    @property
+    def order(self):
+        return (self.sequence, self.generation)
+
+
+class _SegmentedSemiDBM(_SemiDBM):
+    def __init__(self, dbdir, renamer, data_loader=None,
+                 verify_checksums=False, segment_size=None,
+                 merge_threshold=DEFAULT_MERGE_THRESHOLD, **kwargs):
+        self._segment_size = segment_size
+        self._merge_threshold = merge_threshold
+        # Indexed by slot, merged segments are replaced with None.
+        self._segments = []
+        self._active = None
+        super(_SegmentedSemiDBM, self).__init__(
+            dbdir, renamer, data_loader=data_loader,
+            verify_checksums=verify_checksums, **kwargs)
+
+    def _segment_filename(self, sequence, generation):
+        return os.path.join(self._dbdir, 'segment.%08d.%04d' % (
+            sequence, generation))
+
+    def _list_segments(self):
+        segments = []
+        for name in os.listdir(self._dbdir):
+            match = _SEGMENT_FILENAME.match(name)
+            if match is not None:
+                segments.append((int(match.group(1)), int(match.group(2)),
+                                 os.path.join(self._dbdir, name)))
+        segments.sort()
+        return segments
+
+    def _verify_db_exists(self):
+        if not os.path.isdir(self._dbdir) or not self._list_segments():
+            raise DBMError("No segment files in: %s" % self._dbdir)
+
+    def _remove_files_in_dbdir(self):
+        super(_SegmentedSemiDBM, self)._remove_files_in_dbdir()
+        for sequence, generation, filename in self._list_segments():
+            os.remove(filename)
+
+    def _load_db(self):
+        self._create_db_dir()
+        self._index = self._index_factory()
+        self._segments = []
+        found = self._list_segments()
+        if not found:
+            filename = self._segment_filename(1, 0)
+            self._write_headers(filename)
+            found = [(1, 0, filename)]
+        for sequence, generation, filename in found:
+            segment = self._add_segment(sequence, generation, filename)
+            try:
+                self._replay_segment(segment)
+            except ValueError as e:
+                raise DBMLoadError("Bad segment file %s: %s" % (filename, e))
+        self._activate(self._segments[-1])
+
+    def _add_segment(self, sequence, generation, filename):
+        segment = _Segment(len(self._segments), sequence, generation,
+                           filename)
+        self._segments.append(segment)
+        return segment
+
+    def _replay_segment(self, segment):
+        index = self._index
+        base = segment.slot << _SEGMENT_SHIFT
+        for key, offset, size in self._data_loader.iter_keys(
+                segment.filename):
+            if size == _DELETED:
+                # Merges can leave behind deletes of keys that are
+                # not in any older segment.
+                if key in index:
+                    del index[key]
+            else:
+                index[key] = (base | offset, size)
+
+    def _activate(self, segment):
+        if segment.fd is not None:
+            os.close(segment.fd)
+        segment.fd = os.open(segment.filename, compat.DATA_OPEN_FLAGS)
+        self._active = segment
+        self._data_fd = segment.fd
+        self._data_filename = segment.filename
+        self._compress_values = self._can_compress(segment.filename)
+        self._atomic_batches = self._can_write_batches(segment.filename)
+        self._current_offset = (
+            (segment.slot << _SEGMENT_SHIFT) |
+            os.lseek(segment.fd, 0, os.SEEK_END))
+
+    def _segment_fd(self, slot):
+        segment = self._segments[slot]
+        if segment.fd is None:
+            segment.fd = os.open(segment.filename, _READ_FLAGS)
+        return segment.fd
+
+    if compat.pread is not None:
+        def _read_at(self, offset, size, pread=compat.pread):
+            return pread(self._segment_fd(offset >> _SEGMENT_SHIFT), size,
+                         offset & _OFFSET_MASK)
+    else:
+        def _read_at(self, offset, size):
+            fd = self._segment_fd(offset >> _SEGMENT_SHIFT)
+            os.lseek(fd, offset & _OFFSET_MASK, os.SEEK_SET)
+            return os.read(fd, size)
+
+    def __getitem__(self, key, str_type=compat.str_type,
+                    isinstance=isinstance):
+        if isinstance(key, str_type):
+            key = key.encode('utf-8')
+        offset, size = self._index[key]
+        if size < 0:
+            return self._read_compressed(key, offset, size, self._read_at)
+        if not self._verify_checksums:
+            return self._read_at(offset, size)
+        else:
+            return self._verify_checksum_data(
+                key, self._read_at(offset, size + 4))
+
+    def __setitem__(self, key, value):
+        super(_SegmentedSemiDBM, self).__setitem__(key, value)
+        if (self._current_offset & _OFFSET_MASK) >= self._segment_size:
+            self._roll_over()
+
+    def __delitem__(self, key):
+        super(_SegmentedSemiDBM, self).__delitem__(key)
+        if (self._current_offset & _OFFSET_MASK) >= self._segment_size:
+            self._roll_over()
+
+    def set_many(self, items):
+        super(_SegmentedSemiDBM, self).set_many(items)
+        if (self._current_offset & _OFFSET_MASK) >= self._segment_size:
+            self._roll_over()
+
+    def delete_many(self, keys, missing='raise'):
+        super(_SegmentedSemiDBM, self).delete_many(keys, missing)
+        if (self._current_offset & _OFFSET_MASK) >= self._segment_size:
+            self._roll_over()
+
+    def _write_batch(self, writes):
+        super(_SegmentedSemiDBM, self)._write_batch(writes)
+        if (self._current_offset & _OFFSET_MASK) >= self._segment_size:
+            self._roll_over()
+
+    def _roll_over(self):
+        # The previous segment is never written to again, so it
+        # only needs to be fsync'd once.
+        self._fsync(self._active.fd)
+        sequence = max(segment.sequence for segment in self._segments
+                       if segment is not None) + 1
+        filename = self._segment_filename(sequence, 0)
+        self._write_headers(filename)
+        self._activate(self._add_segment(sequence, 0, filename))
+
+    def sync(self):
+        # Hint files aren't supported, the slots in the index
+        # are only meaningful for this db object.
+        self._fsync(self._data_fd)
+
+    def _close_data_fd(self):
+        for segment in self._segments:
+            if segment is not None and segment.fd is not None:
+                os.close(segment.fd)
+                segment.fd = None
+
+    def compact_async(self, progress_callback=None):
+        raise DBMError("Can't compact_async: not supported by "
+                       "segmented dbs, use compact().")
+
+    def verify(self, include_superseded=False, workers=0,
+               progress_callback=None):
+        raise DBMError("Can't verify: not supported by segmented dbs.")
+
+    def _stream_snapshot(self):
+        # Sorting the locations sorts them by segment, and then by
+        # offset within the segment.  A read never spans two segments
+        # since their offsets are 2 ** _SEGMENT_SHIFT bytes apart.
+        locations, read_at, advise = super(
+            _SegmentedSemiDBM, self)._stream_snapshot()
+        return locations, self._read_at, None
+
+    def segment_stats(self):
+        """Return a list of dicts describing each segment.
+
+        Each dict has the segment ``filename``, its ``size`` in bytes,
+        the number of ``live_bytes`` (entries that are not superseded
+        or deleted), and its ``dead_ratio``.
+
+        """
+        live_bytes = self._live_bytes()
+        stats = []
+        for segment in self._segments:
+            if segment is None:
+                continue
+            size = os.path.getsize(segment.filename)
+            live = live_bytes.get(segment.slot, 0)
+            stats.append({
+                'filename': segment.filename,
+                'size': size,
+                'live_bytes': live,
+                'dead_ratio': self._dead_ratio(size, live),
+            })
+        return stats
+
+    def space_stats(self):
+        size = 0
+        live_bytes = 0
+        dead_bytes = 0
+        for stats in self.segment_stats():
+            size += stats['size']
+            live_bytes += stats['live_bytes']
+            dead_bytes += stats['size'] - 8 - stats['live_bytes']
+        total = live_bytes + dead_bytes
+        return {
+            'size': size,
+            'live_bytes': live_bytes,
+            'dead_bytes': dead_bytes,
+            'dead_ratio': dead_bytes / float(total) if total else 0.0,
+        }
+
+    def _live_bytes(self):
+        live_bytes = {}
+        for key, location in self._index.items():
+            slot = location[0] >> _SEGMENT_SHIFT
+            # <keysize><valsize><key><val><keyvalcksum>
+            live_bytes[slot] = (live_bytes.get(slot, 0) + 8 + len(key) +
+                                stored_size(location[1]) + 4)
+        return live_bytes
+
+    def _dead_ratio(self, size, live_bytes):
+        # The 8 byte file header isn't counted.
+        if size <= 8:
+            return 0.0
+        return 1 - (live_bytes / float(size - 8))
+
+    def compact(self):
+        """Merge the segments with enough superseded or deleted data.
+
+        Segments whose ratio of dead bytes to total bytes is at least
+        the db's ``merge_threshold`` are merged into a single new
+        segment containing only their live entries.  All other segments
+        are left untouched.
+
+        """
+        live_bytes = self._live_bytes()
+        active = self._active
+        active_size = self._current_offset & _OFFSET_MASK
+        if active_size > 8 and self._dead_ratio(
+                active_size, live_bytes.get(active.slot, 0)) >= \
+                self._merge_threshold:
+            # Start a new segment so the active one can be merged.
+            self._roll_over()
+        to_merge = []
+        for segment in self._segments:
+            if segment is None or segment is self._active:
+                continue
+            size = os.path.getsize(segment.filename)
+            if size > 8 and self._dead_ratio(
+                    size, live_bytes.get(segment.slot, 0)) >= \
+                    self._merge_threshold:
+                to_merge.append(segment)
+        if to_merge:
+            self._merge(to_merge)
+
+    def _merge(self, to_merge):
+        to_merge.sort(key=lambda segment: segment.order)
+        newest = to_merge[-1]
+        slots = set(segment.slot for segment in to_merge)
+        index = self._index
+        # If a segment older than the newest merged segment isn't part
+        # of the merge, it can have older versions of keys that were
+        # deleted in a merged segment, so the deletes have to be kept.
+        keep_deletes = any(
+            segment is not None and segment.slot not in slots and
+            segment.order < newest.order for segment in self._segments)
+        deleted = []
+        if keep_deletes:
+            last_is_delete = {}
+            for segment in to_merge:
+                for key, offset, size in self._data_loader.iter_keys(
+                        segment.filename):
+                    last_is_delete[key] = size == _DELETED
+            deleted = [key for key, is_delete in last_is_delete.items()
+                       if is_delete and key not in index]
+        live = sorted(
+            (location[0], key, location[1]) for key, location in index.items()
+            if location[0] >> _SEGMENT_SHIFT in slots)
+
+        filename = self._segment_filename(newest.sequence,
+                                          newest.generation + 1)
+        merged = self._add_segment(newest.sequence, newest.generation + 1,
+                                   filename)
+        base = merged.slot << _SEGMENT_SHIFT
+        new_locations = []
+        chunks = [FILE_IDENTIFIER, struct.pack('!HH', *FILE_FORMAT_VERSION)]
+        new_offset = 8
+        for offset, key, size in live:
+            # Entries are copied verbatim, including their checksum.
+            # Entries of older file format versions are also valid
+            # in the current version.
+            entry = self._read_at(offset - 8 - len(key),
+                                  8 + len(key) + stored_size(size) + 4)
+            chunks.append(entry)
+            new_locations.append((key, (base | (new_offset + 8 + len(key)),
+                                        size)))
+            new_offset += len(entry)
+        for key in deleted:
+            chunks.append(_pack_delete(key))
+        fd = os.open(filename, compat.DATA_OPEN_FLAGS)
+        try:
+            _write_all(fd, b''.join(chunks))
+            self._fsync(fd)
+        finally:
+            os.close(fd)
+        for key, location in new_locations:
+            index[key] = location
+        # The merged segments are removed oldest first.  If we crash part
+        # way through, the remaining merged segments are always the
+        # newest ones, so the last entry for a key among them is still
+        # the correct one.
+        for segment in to_merge:
+            if segment.fd is not None:
+                os.close(segment.fd)
+            os.remove(segment.filename)
+            self._segments[segment.slot] = None
+
+
+class _SegmentedSemiDBMReadOnly(_SemiDBMReadOnly, _SegmentedSemiDBM):
+    def refresh(self):
+        raise DBMError("Can't refresh: not supported for segmented dbs.")
+
+
+class _SegmentedSemiDBMReadWrite(_SemiDBMReadWrite, _SegmentedSemiDBM):
+    pass
+
+
+class _SegmentedSemiDBMNew(_SemiDBMNew, _SegmentedSemiDBM):
+    pass
+
+
+SEGMENTED_DB_CLASSES = {
+    'r': _SegmentedSemiDBMReadOnly,
+    'c': _SegmentedSemiDBM,
+    'w': _SegmentedSemiDBMReadWrite,
+    'n': _SegmentedSemiDBMNew,
+}
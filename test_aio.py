@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+"""Tests for semidbm.aio.
+
+These are kept out of test_semidbm.py because they use syntax that older
+versions of python can't parse (see conftest.py).
+
+"""
+import asyncio
+import time
+import unittest
+
+import semidbm
+import semidbm.db
+from semidbm import aio
+
+from test_semidbm import SemiDBMTest
+
+
+class TestAsyncIO(SemiDBMTest):
+    def setUp(self):
+        super(TestAsyncIO, self).setUp()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+        super(TestAsyncIO, self).tearDown()
+
+    def run_until_complete(self, awaitable):
+        return self.loop.run_until_complete(awaitable)
+
+    def open_db_file(self, **kwargs):
+        return aio.open(self.dbdir, 'c', **kwargs)
+
+    def record_get_many(self, db):
+        calls = []
+        get_many = db.db.get_many
+
+        def recording_get_many(keys, *args):
+            calls.append(list(keys))
+            return get_many(keys, *args)
+        db.db.get_many = recording_get_many
+        return calls
+
+    def test_set_get_delete(self):
+        db = self.open_db_file()
+        self.run_until_complete(db.set('foo', 'bar'))
+        self.assertEqual(self.run_until_complete(db.get('foo')), b'bar')
+        self.assertEqual(self.run_until_complete(db.get(b'foo')), b'bar')
+        self.run_until_complete(db.delete('foo'))
+        self.assertIsNone(self.run_until_complete(db.get('foo')))
+        self.assertEqual(
+            self.run_until_complete(db.get('foo', b'default')), b'default')
+        self.run_until_complete(db.close())
+
+    def test_concurrent_gets_are_coalesced(self):
+        db = self.open_db_file()
+        self.run_until_complete(db.set_many(
+            dict(('key%s' % i, 'value%s' % i) for i in range(50))))
+        calls = self.record_get_many(db)
+        keys = ['key%s' % i for i in range(50)] + ['key1', 'missing']
+        values = self.run_until_complete(
+            asyncio.gather(*[db.get(key) for key in keys]))
+        self.assertEqual(values[:50],
+                         [('value%s' % i).encode('ascii') for i in range(50)])
+        self.assertEqual(values[50:], [b'value1', None])
+        # Duplicate keys are only read once.
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(calls[0]), 51)
+        self.run_until_complete(db.close())
+
+    def test_coalesced_reads_are_bounded(self):
+        db = self.open_db_file()
+        calls = self.record_get_many(db)
+        self.run_until_complete(asyncio.gather(
+            *[db.get('key%s' % i) for i in range(aio.MAX_BATCH_SIZE + 1)]))
+        self.assertEqual([len(keys) for keys in calls],
+                         [aio.MAX_BATCH_SIZE, 1])
+        self.run_until_complete(db.close())
+
+    def test_get_errors_are_raised(self):
+        db = self.open_db_file(max_workers=1, verify_checksums=True)
+        self.run_until_complete(db.set('key', 'value'))
+        with self.open_data_file(mode='rb') as f:
+            contents = f.read()
+        with self.open_data_file(mode='wb') as f:
+            f.write(contents.replace(b'value', b'Value'))
+        self.assertRaises(semidbm.DBMChecksumError, self.run_until_complete,
+                          db.get('key'))
+        self.run_until_complete(db.close())
+
+    def test_get_many(self):
+        db = self.open_db_file()
+        self.run_until_complete(db.set_many([('one', '1'), ('two', '2')]))
+        self.assertEqual(
+            self.run_until_complete(db.get_many(['one', 'two'])),
+            {b'one': b'1', b'two': b'2'})
+        self.run_until_complete(db.delete_many(['one']))
+        self.assertEqual(
+            self.run_until_complete(db.get_many(['one', 'two'], 'skip')),
+            {b'two': b'2'})
+        self.run_until_complete(db.close())
+
+    def test_items(self):
+        db = self.open_db_file()
+        expected = dict((('key%s' % i).encode('ascii'), b'value')
+                        for i in range(10))
+        self.run_until_complete(db.set_many(expected))
+        items = db.items(batch_size=3)
+        found = {}
+        while True:
+            try:
+                key, value = self.run_until_complete(items.__anext__())
+            except StopAsyncIteration:
+                break
+            found[key] = value
+        self.assertEqual(found, expected)
+        self.assertEqual(sorted(self.run_until_complete(db.keys())),
+                         sorted(expected))
+        self.run_until_complete(db.close())
+
+    def test_sync_compact_and_reopen(self):
+        db = self.open_db_file()
+        self.run_until_complete(db.set('foo', 'bar'))
+        self.run_until_complete(db.set('foo', 'baz'))
+        self.run_until_complete(db.sync())
+        self.run_until_complete(db.compact())
+        self.run_until_complete(db.close())
+        db = aio.open(self.dbdir, 'r', lazy=True)
+        self.assertTrue(self.run_until_complete(db.wait_loaded()))
+        self.assertEqual(self.run_until_complete(db.get('foo')), b'baz')
+        self.run_until_complete(db.close())
+
+    def test_close_waits_for_pending_gets(self):
+        db = self.open_db_file()
+        self.run_until_complete(db.set('foo', 'bar'))
+        events = []
+        get_many = db.db.get_many
+        close = db.db.close
+
+        def slow_get_many(keys, *args):
+            time.sleep(0.05)
+            values = get_many(keys, *args)
+            events.append('get_many')
+            return values
+
+        def recording_close(*args):
+            events.append('close')
+            close(*args)
+        db.db.get_many = slow_get_many
+        db.db.close = recording_close
+
+        async def get_and_close():
+            get = asyncio.ensure_future(db.get('foo'))
+            await asyncio.sleep(0)
+            await db.close()
+            return await get
+        self.assertEqual(self.run_until_complete(get_and_close()), b'bar')
+        self.assertEqual(events, ['get_many', 'close'])
+
+    def test_uses_thread_safe_db_with_multiple_workers(self):
+        db = self.open_db_file(max_workers=2)
+        self.assertIsInstance(db.db, semidbm.db._ThreadSafeMixin)
+        self.run_until_complete(db.close())
+        db = self.open_db_file(max_workers=1, cache_size=1024)
+        self.assertNotIsInstance(db.db, semidbm.db._ThreadSafeMixin)
+        self.run_until_complete(db.close())
+
+
+if __name__ == '__main__':
+    unittest.main()
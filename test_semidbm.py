@@ -4,7 +4,10 @@ import os
 import sys
 import shutil
 import struct
+import subprocess
 import tempfile
+import threading
+import time
 try:
     import mmap
 except ImportError:
@@ -16,7 +19,31 @@ except ImportError:
 
 import semidbm
 import semidbm.db
+from semidbm.loaders import DBMLoader
+from semidbm.loaders import simpleload
 from semidbm.loaders.simpleload import SimpleFileLoader
+from semidbm.index import CompactIndex, SortedIndex, prefix_end
+from semidbm.cache import LRUCache
+from semidbm.metrics import LatencyHistogram
+from semidbm import compat
+from semidbm import parallel
+from semidbm import scrub
+if mmap is not None:
+    from semidbm import diskindex
+    from semidbm import frozen
+
+
+def view_bytes(view):
+    # get_view() returns bytes on python 2, where mmap doesn't support
+    # memoryview (which python 2.6 doesn't have at all).
+    if hasattr(view, 'tobytes'):
+        return view.tobytes()
+    return view
+
+
+def release_view(view):
+    if hasattr(view, 'release'):
+        view.release()
 
 
 class SemiDBMTest(unittest.TestCase):
@@ -165,6 +192,15 @@ class TestSemiDBM(SemiDBMTest):
                                                 b'three_value']))
         db.close()
 
+    def test_values_in_keys_order(self):
+        db = self.open_db_file()
+        db['a'] = '1'
+        db['b'] = '2'
+        db['a'] = '3'
+        self.assertEqual(dict(zip(db.keys(), db.values())),
+                         {b'a': b'3', b'b': b'2'})
+        db.close()
+
     def test_iterate(self):
         db = self.open_db_file()
         db['one'] = 'foo'
@@ -173,6 +209,18 @@ class TestSemiDBM(SemiDBMTest):
         self.assertEqual(set(db), set([b'one', b'two', b'three']))
         db.close()
 
+    def test_items_in_file_order(self):
+        db = self.open_db_file()
+        db['one'] = 'foo'
+        db['two'] = 'bar'
+        db['three'] = 'baz'
+        db['one'] = 'qux'
+        del db['two']
+        self.assertEqual(list(db.items()),
+                         [(b'three', b'baz'), (b'one', b'qux')])
+        self.assertEqual(list(db.itervalues()), [b'baz', b'qux'])
+        db.close()
+
     def test_sync_contents(self):
         # So there's not really a good way to test this, so
         # I'm just making sure you can call it, and you can see the data.
@@ -184,6 +232,62 @@ class TestSemiDBM(SemiDBMTest):
         self.assertEqual(db2['foo'], b'bar')
         db2.close()
 
+    def test_get_many(self):
+        db = self.open_db_file()
+        db['one'] = 'one'
+        db['two'] = 'two'
+        db['three'] = 'three'
+        self.assertEqual(db.get_many(['three', b'one']),
+                         {b'three': b'three', b'one': b'one'})
+        db.close()
+
+    def test_get_many_missing_keys(self):
+        db = self.open_db_file()
+        db['one'] = 'one'
+        self.assertRaises(KeyError, db.get_many, ['one', 'two'])
+        self.assertEqual(db.get_many(['one', 'two'], missing='skip'),
+                         {b'one': b'one'})
+        self.assertEqual(
+            db.get_many(['one', 'two'], missing='default', default=b'x'),
+            {b'one': b'one', b'two': b'x'})
+        self.assertRaises(ValueError, db.get_many, ['one'], missing='bad')
+        db.close()
+
+    def test_set_many(self):
+        db = self.open_db_file()
+        db.set_many({'one': 'one', 'two': 'two'})
+        db.set_many([('three', 'three'), ('one', 'updated')])
+        self.assertEqual(db['one'], b'updated')
+        self.assertEqual(db['two'], b'two')
+        self.assertEqual(db['three'], b'three')
+        db.close()
+        db2 = self.open_db_file()
+        self.assertEqual(db2['one'], b'updated')
+        self.assertEqual(db2['three'], b'three')
+        db2.close()
+
+    def test_delete_many(self):
+        db = self.open_db_file()
+        db.set_many({'one': 'one', 'two': 'two', 'three': 'three'})
+        db.delete_many(['one', 'three'])
+        self.assertEqual(list(db.keys()), [b'two'])
+        db.close()
+        db2 = self.open_db_file()
+        self.assertEqual(list(db2.keys()), [b'two'])
+        db2.close()
+
+    def test_delete_many_missing_keys(self):
+        db = self.open_db_file()
+        db['one'] = 'one'
+        db['two'] = 'two'
+        self.assertRaises(KeyError, db.delete_many, ['one', 'missing'])
+        # Nothing is deleted if a key is missing.
+        self.assertEqual(db['one'], b'one')
+        db.delete_many(['one', 'missing'], missing='skip')
+        self.assertNotIn(b'one', db)
+        self.assertEqual(db['two'], b'two')
+        db.close()
+
     def test_compaction_does_not_leave_behind_files(self):
         db = self.open_db_file()
         before = len(os.listdir(self.dbdir))
@@ -271,7 +375,7 @@ class TestSemiDBM(SemiDBMTest):
         db.close()
         with self.open_data_file(mode='rb+') as f:
             f.seek(4)
-            f.write(struct.pack('!H', 2))
+            f.write(struct.pack('!H', 4))
         # Opening the db file should now fail.
         self.assertRaises(semidbm.DBMLoadError, self.open_db_file)
 
@@ -337,6 +441,123 @@ class TestSemiDBM(SemiDBMTest):
         self.truncate_data_file(bytes_from_end=8)
         self.assertRaises(semidbm.DBMLoadError, self.open_db_file)
 
+    def test_batch(self):
+        db = self.open_db_file()
+        db['deleted'] = 'value'
+        db['updated'] = 'old'
+        with db.batch() as batch:
+            batch['new'] = 'value'
+            batch['updated'] = 'new'
+            del batch['deleted']
+            self.assertEqual(len(batch), 3)
+            # Nothing is written until the batch is committed.
+            self.assertNotIn('new', db)
+        self.assertEqual(db['new'], b'value')
+        self.assertEqual(db['updated'], b'new')
+        self.assertNotIn('deleted', db)
+        db.close()
+        db = self.open_db_file()
+        self.assertEqual(sorted(db.keys()), [b'new', b'updated'])
+        self.assertEqual(db['updated'], b'new')
+        db.close()
+
+    def test_batch_discarded_on_exception(self):
+        db = self.open_db_file()
+        db['foo'] = 'bar'
+        try:
+            with db.batch() as batch:
+                batch['foo'] = 'changed'
+                batch['new'] = 'value'
+                raise RuntimeError()
+        except RuntimeError:
+            pass
+        self.assertEqual(db['foo'], b'bar')
+        self.assertNotIn('new', db)
+        self.assertRaises(ValueError, batch.commit)
+        db.close()
+
+    def test_batch_delete(self):
+        db = self.open_db_file()
+        db['foo'] = 'bar'
+        batch = db.batch()
+        self.assertRaises(KeyError, batch.__delitem__, 'missing')
+        # Deleting a key only set in the batch leaves nothing to write.
+        batch['new'] = 'value'
+        del batch['new']
+        del batch['foo']
+        self.assertRaises(KeyError, batch.__delitem__, 'foo')
+        self.assertEqual(len(batch), 1)
+        # The key was deleted again before the batch was committed.
+        del db['foo']
+        batch.commit()
+        self.assertNotIn('foo', db)
+        db.close()
+
+    def test_torn_batch_is_not_loaded(self):
+        db = self.open_db_file()
+        db['foo'] = 'bar'
+        with db.batch() as batch:
+            batch['foo'] = 'changed'
+            batch['new'] = 'value'
+        db.close()
+        # Only part of the commit record was written.
+        self.truncate_data_file(bytes_from_end=5)
+        db = self.open_db_file()
+        self.assertEqual(db['foo'], b'bar')
+        self.assertNotIn('new', db)
+        # New writes go after the torn batch, which is never loaded.
+        db['after'] = 'value'
+        db.close()
+        db = self.open_db_file()
+        self.assertEqual(sorted(db.keys()), [b'after', b'foo'])
+        self.assertEqual(db['foo'], b'bar')
+        db.close()
+
+    def test_batch_with_bad_checksum_is_skipped(self):
+        db = self.open_db_file()
+        db['foo'] = 'bar'
+        with db.batch() as batch:
+            batch['foo'] = 'changed'
+            batch['new'] = 'value'
+        db['after'] = 'value'
+        db.close()
+        with self.open_data_file(mode='rb+') as f:
+            contents = f.read()
+            # The second byte of the value in the batch.
+            f.seek(contents.index(b'changed') + 1)
+            f.write(b'X')
+        db = self.open_db_file()
+        self.assertEqual(db['foo'], b'bar')
+        self.assertNotIn('new', db)
+        self.assertEqual(db['after'], b'value')
+        db.close()
+
+    def test_negative_batch_size(self):
+        db = self.open_db_file()
+        db['foo'] = 'bar'
+        db.close()
+        with self.open_data_file(mode='ab') as f:
+            f.write(struct.pack('!ii', -2, -20) + b'\x00' * 40)
+        self.assertRaises(semidbm.DBMLoadError, self.open_db_file)
+
+    def test_batch_in_version_2_file_has_no_commit_record(self):
+        db = self.open_db_file()
+        db.close()
+        with self.open_data_file(mode='rb+') as f:
+            f.seek(4)
+            f.write(struct.pack('!HH', 2, 0))
+        db = self.open_db_file()
+        with db.batch() as batch:
+            batch['foo'] = 'bar'
+        db.close()
+        with self.open_data_file(mode='rb') as f:
+            contents = f.read()
+        # The header and a single entry.
+        self.assertEqual(len(contents), 8 + 8 + 3 + 3 + 4)
+        db = self.open_db_file()
+        self.assertEqual(db['foo'], b'bar')
+        db.close()
+
 
 @unittest.skipIf(mmap is None, 'mmap required')
 class TestRemapping(SemiDBMTest):
@@ -372,6 +593,27 @@ class TestRemapping(SemiDBMTest):
             self.assertEqual(db2[k], values)
         db2.close()
 
+    def test_start_offset_in_later_remap_window(self):
+        size = (
+            semidbm.loaders.mmapload._MAPPED_LOAD_PAGES *
+            mmap.ALLOCATIONGRANULARITY * 2)
+        db = self.open_db_file(hint_file=True)
+        values = b'abcd' * 25
+        for i in range(int(size / 100)):
+            db[str(i)] = values
+        db.close()
+        db = self.open_db_file()
+        db['tail'] = 'tail'
+        del db['0']
+        db.close()
+
+        db2 = self.open_db_file()
+        self.assertTrue(db2._hint_offset > mmap.ALLOCATIONGRANULARITY)
+        self.assertEqual(db2['tail'], b'tail')
+        self.assertNotIn(b'0', db2)
+        self.assertEqual(db2['1'], values)
+        db2.close()
+
 
 class TestReadOnlyMode(SemiDBMTest):
     def open_db_file(self, **kwargs):
@@ -397,6 +639,11 @@ class TestReadOnlyMode(SemiDBMTest):
         self.assertRaises(semidbm.DBMError, db.__delitem__, 'foo')
         db.close()
 
+    def test_cant_batch(self):
+        db = self.open_db_file()
+        self.assertRaises(semidbm.DBMError, db.batch)
+        db.close()
+
     def test_close_never_compacts_index(self):
         db = self.open_db_file()
         db.calls = []
@@ -431,6 +678,20 @@ class TestReadOnlyMode(SemiDBMTest):
         self.assertEqual(read_only[b'baz'], b'foo')
         read_only.close()
 
+    def test_get_many(self):
+        db = semidbm.open(self.dbdir, 'c')
+        db['foo'] = 'bar'
+        db['bar'] = 'baz'
+        db.close()
+
+        read_only = self.open_db_file()
+        self.assertEqual(read_only.get_many(['foo', 'bar', 'baz'],
+                                            missing='skip'),
+                         {b'foo': b'bar', b'bar': b'baz'})
+        self.assertRaises(semidbm.DBMError, read_only.set_many, {'a': 'b'})
+        self.assertRaises(semidbm.DBMError, read_only.delete_many, ['foo'])
+        read_only.close()
+
     def test_key_does_not_exist(self):
         db = semidbm.open(self.dbdir, 'c')
         db['foo'] = 'bar'
@@ -473,6 +734,246 @@ class TestReadOnlyMode(SemiDBMTest):
         db.close()
 
 
+@unittest.skipIf(mmap is None, 'mmap required')
+class TestReadOnlyMMapMode(TestReadOnlyMode):
+    def open_db_file(self, **kwargs):
+        return semidbm.open(self.dbdir, 'r', use_mmap=True, **kwargs)
+
+    def test_items(self):
+        db = semidbm.open(self.dbdir, 'c')
+        db['one'] = 'foo'
+        db['two'] = 'bar'
+        db['one'] = 'baz'
+        db.close()
+        db = self.open_db_file(verify_checksums=True)
+        self.assertEqual(list(db.items()),
+                         [(b'two', b'bar'), (b'one', b'baz')])
+        db.close()
+
+    def create_db(self, **items):
+        db = semidbm.open(self.dbdir, 'c')
+        for key, value in items.items():
+            db[key] = value
+        db.close()
+
+    def test_get_view(self):
+        self.create_db(foo='bar', bar='baz')
+        db = self.open_db_file()
+        view = db.get_view('foo')
+        if sys.version_info[0] >= 3:
+            self.assertIsInstance(view, memoryview)
+        self.assertEqual(view_bytes(view), b'bar')
+        self.assertEqual(view_bytes(db.get_view(b'bar')), b'baz')
+        self.assertRaises(KeyError, db.get_view, b'missing')
+        release_view(view)
+        db.close()
+
+    def test_get_view_verifies_checksums(self):
+        self.create_db(key='value')
+        with self.open_data_file(mode='rb') as f:
+            contents = f.read()
+        with self.open_data_file(mode='wb') as f:
+            f.write(contents.replace(b'value', b'Value'))
+        db = self.open_db_file(verify_checksums=True)
+        self.assertRaises(semidbm.DBMChecksumError, db.get_view, b'key')
+        db.close()
+
+    def test_close_with_outstanding_views(self):
+        self.create_db(foo='bar')
+        db = self.open_db_file()
+        view = db.get_view(b'foo')
+        db.close()
+        self.assertEqual(view_bytes(view), b'bar')
+        release_view(view)
+
+    def test_only_allowed_in_read_only_mode(self):
+        self.assertRaises(ValueError, semidbm.open, self.dbdir, 'c',
+                          use_mmap=True)
+
+
+class TestRefresh(SemiDBMTest):
+    def setUp(self):
+        super(TestRefresh, self).setUp()
+        self.writer = semidbm.open(self.dbdir, 'c')
+        self.writer['one'] = 'one'
+        self.writer['two'] = 'two'
+
+    def tearDown(self):
+        self.writer.close()
+        super(TestRefresh, self).tearDown()
+
+    def open_reader(self, **kwargs):
+        return semidbm.open(self.dbdir, 'r', **kwargs)
+
+    def data_filename(self):
+        return os.path.join(self.dbdir, 'data')
+
+    def test_refresh_loads_new_entries(self):
+        reader = self.open_reader()
+        self.writer['three'] = 'three'
+        self.writer['one'] = 'new'
+        del self.writer['two']
+        self.assertNotIn('three', reader)
+        reader.refresh()
+        self.assertEqual(reader['three'], b'three')
+        self.assertEqual(reader['one'], b'new')
+        self.assertNotIn('two', reader)
+        self.assertEqual(sorted(reader.keys()), [b'one', b'three'])
+        reader.close()
+
+    def test_refresh_without_changes(self):
+        reader = self.open_reader()
+        reader.refresh()
+        self.assertEqual(sorted(reader.keys()), [b'one', b'two'])
+        reader.close()
+
+    def test_refresh_stops_at_torn_tail(self):
+        reader = self.open_reader()
+        self.writer['three'] = 'three'
+        size = os.path.getsize(self.data_filename())
+        self.writer['four'] = 'four'
+        with open(self.data_filename(), 'rb') as f:
+            contents = f.read()
+        # Simulate an entry that's only partially written.
+        with open(self.data_filename(), 'r+b') as f:
+            f.truncate(size + 10)
+        reader.refresh()
+        self.assertEqual(reader['three'], b'three')
+        self.assertNotIn('four', reader)
+        with open(self.data_filename(), 'r+b') as f:
+            f.seek(size + 10)
+            f.write(contents[size + 10:])
+        reader.refresh()
+        self.assertEqual(reader['four'], b'four')
+        reader.close()
+
+    def test_refresh_after_compaction_reloads(self):
+        reader = self.open_reader()
+        del self.writer['one']
+        self.writer['two'] = 'new'
+        self.writer.compact()
+        reader.refresh()
+        self.assertEqual(list(reader.keys()), [b'two'])
+        self.assertEqual(reader['two'], b'new')
+        # Entries written after the compaction are followed too.
+        self.writer['three'] = 'three'
+        reader.refresh()
+        self.assertEqual(reader['three'], b'three')
+        reader.close()
+
+    def test_refresh_after_truncation_reloads(self):
+        reader = self.open_reader()
+        self.writer.close()
+        with open(self.data_filename(), 'r+b') as f:
+            f.truncate(8)
+        reader.refresh()
+        self.assertEqual(list(reader.keys()), [])
+        reader.close()
+        self.writer = semidbm.open(self.dbdir, 'c')
+
+    def test_refresh_interval(self):
+        reader = self.open_reader(refresh_interval=0)
+        self.writer['three'] = 'three'
+        self.assertEqual(reader['three'], b'three')
+        del self.writer['three']
+        self.assertNotIn('three', reader)
+        reader.close()
+
+    def test_long_refresh_interval(self):
+        reader = self.open_reader(refresh_interval=3600)
+        self.writer['three'] = 'three'
+        self.assertNotIn('three', reader)
+        reader.close()
+
+    def test_refresh_interval_requires_read_only(self):
+        self.assertRaises(ValueError, semidbm.open, self.dbdir, 'c',
+                          refresh_interval=1)
+
+    def test_concurrent_refreshes(self):
+        reader = self.open_reader()
+        for i in range(200):
+            self.writer['key%s' % i] = 'value%s' % i
+        for i in range(0, 200, 2):
+            del self.writer['key%s' % i]
+        errors = []
+
+        def refresh():
+            try:
+                reader.refresh()
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=refresh) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(reader.keys()), 102)
+        self.assertNotIn('key0', reader)
+        self.assertEqual(reader['key1'], b'value1')
+        reader.close()
+
+
+class TestRefreshThreadSafe(TestRefresh):
+    def open_reader(self, **kwargs):
+        return semidbm.open(self.dbdir, 'r', thread_safe=True, **kwargs)
+
+
+class TestRefreshWithCache(TestRefresh):
+    def open_reader(self, **kwargs):
+        return semidbm.open(self.dbdir, 'r', cache_size=1024, **kwargs)
+
+    def test_refresh_clears_cache(self):
+        reader = self.open_reader()
+        self.assertEqual(reader['one'], b'one')
+        self.writer['one'] = 'new'
+        self.assertEqual(reader['one'], b'one')
+        reader.refresh()
+        self.assertEqual(reader['one'], b'new')
+        reader.close()
+
+
+class TestRefreshLazy(TestRefresh):
+    def open_reader(self, **kwargs):
+        db = semidbm.open(self.dbdir, 'r', lazy=True, **kwargs)
+        # The tests change the data file right after opening the db,
+        # which would otherwise race with the background load.
+        db.wait_loaded()
+        return db
+
+
+@unittest.skipIf(mmap is None, 'mmap required')
+class TestRefreshMMap(TestRefresh):
+    def open_reader(self, **kwargs):
+        return semidbm.open(self.dbdir, 'r', use_mmap=True, **kwargs)
+
+    def test_views_stay_valid_after_refresh(self):
+        reader = self.open_reader()
+        view = reader.get_view('one')
+        self.writer['three'] = 'three'
+        reader.refresh()
+        self.assertEqual(view_bytes(reader.get_view('three')), b'three')
+        self.assertEqual(view_bytes(view), b'one')
+        release_view(view)
+        reader.close()
+
+
+@unittest.skipIf(mmap is None, 'mmap required')
+class TestRefreshSharedIndex(TestRefresh):
+    def open_reader(self, **kwargs):
+        return semidbm.open(self.dbdir, 'r', index='shared', **kwargs)
+
+
+class TestRefreshSegmented(SemiDBMTest):
+    def test_refresh_not_supported(self):
+        semidbm.open(self.dbdir, 'c', segment_size=4096).close()
+        db = semidbm.open(self.dbdir, 'r', segment_size=4096)
+        self.assertRaises(semidbm.DBMError, db.refresh)
+        db.close()
+        self.assertRaises(ValueError, semidbm.open, self.dbdir, 'r',
+                          segment_size=4096, refresh_interval=1)
+
+
 class TestWriteMode(SemiDBMTest):
     def test_when_index_file_does_not_exist(self):
         self.assertRaises(semidbm.DBMError, semidbm.open, self.dbdir, 'w')
@@ -489,6 +990,17 @@ class TestWriteMode(SemiDBMTest):
         self.assertEqual(db_write_mode['foo'], b'bar')
         db_write_mode.close()
 
+    def test_compact(self):
+        db = self.open_db_file()
+        db['foo'] = 'bar'
+        db.close()
+        db = semidbm.open(self.dbdir, 'w', thread_safe=True)
+        db['foo'] = 'baz'
+        db.compact()
+        self.assertEqual(db['foo'], b'baz')
+        db.close()
+        self.assertFalse(os.path.exists(os.path.join(self.dbdir, 'compact')))
+
 
 class TestNewMode(SemiDBMTest):
     def test_when_file_does_not_exist(self):
@@ -505,6 +1017,128 @@ class TestNewMode(SemiDBMTest):
         db.close()
 
 
+class RecordingLoader(SimpleFileLoader):
+    def __init__(self):
+        self.start_offsets = []
+
+    def load_index(self, filename, index, start_offset=None):
+        self.start_offsets.append(start_offset)
+        return super(RecordingLoader, self).load_index(
+            filename, index, start_offset)
+
+
+class TestHintFile(SemiDBMTest):
+    def open_db_file(self, **kwargs):
+        kwargs.setdefault('hint_file', True)
+        return semidbm.open(self.dbdir, 'c', **kwargs)
+
+    def open_with_recording_loader(self):
+        kwargs = semidbm.db._create_default_params()
+        loader = RecordingLoader()
+        kwargs['data_loader'] = loader
+        return semidbm.db._SemiDBM(self.dbdir, **kwargs), loader
+
+    def hint_filename(self):
+        return os.path.join(self.dbdir, 'hint')
+
+    def test_hint_file_written_on_close(self):
+        db = self.open_db_file()
+        db['foo'] = 'bar'
+        db.close()
+        self.assertTrue(os.path.isfile(self.hint_filename()))
+
+    def test_hint_file_not_written_by_default(self):
+        db = self.open_db_file(hint_file=False)
+        db['foo'] = 'bar'
+        db.close()
+        self.assertFalse(os.path.exists(self.hint_filename()))
+
+    def test_load_replays_only_tail_after_hint(self):
+        db = self.open_db_file()
+        db['one'] = 'one'
+        db['two'] = 'two'
+        db['three'] = 'three'
+        db.close()
+        hint_offset = os.path.getsize(db._data_filename)
+        # Now write more entries without updating the hint file.
+        db = self.open_db_file(hint_file=False)
+        db['four'] = 'four'
+        db['one'] = 'updated'
+        del db['two']
+        db.close()
+
+        db2, loader = self.open_with_recording_loader()
+        self.assertEqual(loader.start_offsets, [hint_offset])
+        self.assertEqual(db2['one'], b'updated')
+        self.assertEqual(db2['three'], b'three')
+        self.assertEqual(db2['four'], b'four')
+        self.assertNotIn(b'two', db2)
+        db2.close()
+
+    def test_corrupt_hint_file_falls_back_to_full_replay(self):
+        db = self.open_db_file()
+        db['foo'] = 'bar'
+        db['bar'] = 'baz'
+        db.close()
+        with open(self.hint_filename(), 'rb+') as f:
+            f.seek(30)
+            f.write(b'\x00\x00\x00\x00')
+        db2, loader = self.open_with_recording_loader()
+        self.assertEqual(loader.start_offsets, [None])
+        self.assertEqual(db2['foo'], b'bar')
+        self.assertEqual(db2['bar'], b'baz')
+        db2.close()
+
+    def test_stale_hint_file_is_ignored(self):
+        db = self.open_db_file()
+        db['foo'] = 'bar'
+        db.close()
+        with open(self.hint_filename(), 'rb') as f:
+            old_hint = f.read()
+        db = self.open_db_file()
+        db['foo'] = 'changed'
+        for i in range(10):
+            db[str(i)] = str(i)
+        db.close(compact=True)
+        # Put a hint file in place that describes a different data file.
+        with open(self.hint_filename(), 'wb') as f:
+            f.write(old_hint)
+        db2, loader = self.open_with_recording_loader()
+        self.assertEqual(loader.start_offsets, [None])
+        expected = [str(i).encode('ascii') for i in range(10)] + [b'foo']
+        self.assertEqual(sorted(db2.keys()), sorted(expected))
+        self.assertEqual(db2['foo'], b'changed')
+        db2.close()
+
+    def test_compact_removes_hint_file(self):
+        db = self.open_db_file()
+        db['foo'] = 'bar'
+        db.sync()
+        self.assertTrue(os.path.isfile(self.hint_filename()))
+        db.compact()
+        self.assertFalse(os.path.exists(self.hint_filename()))
+        db.close()
+        self.assertTrue(os.path.isfile(self.hint_filename()))
+
+    def test_new_mode_removes_hint_file(self):
+        db = self.open_db_file()
+        db['foo'] = 'bar'
+        db.close()
+        db = semidbm.open(self.dbdir, 'n')
+        self.assertFalse(os.path.exists(self.hint_filename()))
+        self.assertEqual(list(db.keys()), [])
+        db.close()
+
+    def test_read_only_mode_uses_hint_file(self):
+        db = self.open_db_file()
+        db['foo'] = 'bar'
+        db.close()
+        db = semidbm.open(self.dbdir, 'r')
+        self.assertEqual(db._hint_offset, os.path.getsize(db._data_filename))
+        self.assertEqual(db['foo'], b'bar')
+        db.close()
+
+
 class TestInvalidModeArgument(unittest.TestCase):
     def test_invalid_open_arg_raises_exception(self):
         self.assertRaises(ValueError, semidbm.open, 'foo.db', 'z')
@@ -519,11 +1153,3022 @@ class TestWithChecksumsOn(TestSemiDBM):
         return semidbm.open(self.dbdir, 'c', **kwargs)
 
 
-class TestSimpleFileLoader(TestSemiDBM):
+class TestWithCompactIndex(TestSemiDBM):
     def open_db_file(self, **kwargs):
-        kwargs = semidbm.db._create_default_params()
-        kwargs['data_loader'] = SimpleFileLoader()
-        return semidbm.db._SemiDBM(self.dbdir, **kwargs)
+        kwargs.setdefault('index', 'compact')
+        return semidbm.open(self.dbdir, 'c', **kwargs)
+
+    def test_index_is_compact(self):
+        db = self.open_db_file()
+        self.assertIsInstance(db._index, CompactIndex)
+        db.close()
+
+    def test_hint_file_with_compact_index(self):
+        db = self.open_db_file(hint_file=True)
+        db['one'] = 'one'
+        db['two'] = 'two'
+        del db['one']
+        db.close()
+        db2 = self.open_db_file()
+        self.assertEqual(list(db2.keys()), [b'two'])
+        self.assertEqual(db2['two'], b'two')
+        db2.close()
+
+    def test_invalid_index_type(self):
+        self.assertRaises(ValueError, self.open_db_file, index='bad')
+
+
+class TestWithSortedIndex(TestSemiDBM):
+    def open_db_file(self, **kwargs):
+        kwargs.setdefault('index', 'sorted')
+        return semidbm.open(self.dbdir, 'c', **kwargs)
+
+    def populate(self, db):
+        for key in ('b', 'a', 'ab', 'abc', 'bz', 'c', 'abd'):
+            db[key] = key.upper()
+
+    def test_iter_range(self):
+        db = self.open_db_file()
+        self.populate(db)
+        self.assertEqual(list(db.iter_range(b'ab', b'b')),
+                         [b'ab', b'abc', b'abd'])
+        self.assertEqual(list(db.iter_range('b')), [b'b', b'bz', b'c'])
+        self.assertEqual(list(db.iter_range(stop=b'ab')), [b'a'])
+        self.assertEqual(list(db.iter_range(b'ab', b'b', reverse=True)),
+                         [b'abd', b'abc', b'ab'])
+        self.assertEqual(list(db.iter_range(b'abc', b'abd', items=True)),
+                         [(b'abc', b'ABC')])
+        db.close()
+
+    def test_iter_prefix(self):
+        db = self.open_db_file()
+        self.populate(db)
+        self.assertEqual(list(db.iter_prefix('ab')), [b'ab', b'abc', b'abd'])
+        self.assertEqual(list(db.iter_prefix(b'ab', reverse=True)),
+                         [b'abd', b'abc', b'ab'])
+        self.assertEqual(list(db.iter_prefix(b'b', items=True)),
+                         [(b'b', b'B'), (b'bz', b'BZ')])
+        self.assertEqual(list(db.iter_prefix(b'x')), [])
+        self.assertEqual(len(list(db.iter_prefix(b''))), 7)
+        db.close()
+
+    def test_writes_after_ordered_iteration(self):
+        db = self.open_db_file()
+        self.populate(db)
+        self.assertEqual(list(db.iter_prefix(b'ab')), [b'ab', b'abc', b'abd'])
+        db['abb'] = 'new'
+        db['abc'] = 'updated'
+        del db['ab']
+        self.assertEqual(list(db.iter_prefix(b'ab', items=True)),
+                         [(b'abb', b'new'), (b'abc', b'updated'),
+                          (b'abd', b'ABD')])
+        db.close()
+
+    def test_ordered_iteration_after_load(self):
+        db = self.open_db_file()
+        self.populate(db)
+        del db['abc']
+        db.close()
+        db = self.open_db_file()
+        self.assertEqual(list(db.iter_prefix(b'a')), [b'a', b'ab', b'abd'])
+        db.compact()
+        self.assertEqual(list(db.iter_prefix(b'a')), [b'a', b'ab', b'abd'])
+        db.close()
+
+    def test_items_skip_keys_deleted_while_iterating(self):
+        db = self.open_db_file()
+        self.populate(db)
+        found = []
+        for key, value in db.iter_prefix(b'ab', items=True):
+            found.append(key)
+            if key == b'ab':
+                del db['abc']
+        self.assertEqual(found, [b'ab', b'abd'])
+        db.close()
+
+    def test_write_buffer_is_flushed(self):
+        db = self.open_db_file(write_buffer_size=1024 * 1024)
+        self.populate(db)
+        self.assertEqual(list(db.iter_prefix(b'ab')), [b'ab', b'abc', b'abd'])
+        db.close()
+
+    def test_requires_sorted_index(self):
+        db = semidbm.open(self.dbdir, 'c')
+        self.assertRaises(semidbm.DBMError, db.iter_range)
+        self.assertRaises(semidbm.DBMError, db.iter_prefix, b'a')
+        db.close()
+
+    def test_cant_combine_with_thread_safe(self):
+        self.assertRaises(ValueError, self.open_db_file, thread_safe=True)
+
+
+@unittest.skipIf(mmap is None, 'mmap required')
+class TestWithDiskIndex(TestSemiDBM):
+    def open_db_file(self, **kwargs):
+        kwargs.setdefault('index', 'disk')
+        return semidbm.open(self.dbdir, 'c', **kwargs)
+
+
+@unittest.skipIf(mmap is None, 'mmap required')
+class TestDiskIndex(SemiDBMTest):
+    def open_db_file(self, **kwargs):
+        kwargs.setdefault('index', 'disk')
+        return semidbm.open(self.dbdir, 'c', **kwargs)
+
+    def open_with_recording_loader(self, base=semidbm.db._SemiDBM):
+        kwargs = semidbm.db._create_default_params()
+        loader = RecordingLoader()
+        kwargs['data_loader'] = loader
+        cls = semidbm.db._db_class(base, [semidbm.db._DiskIndexMixin])
+        return cls(self.dbdir, **kwargs), loader
+
+    def index_filename(self):
+        return os.path.join(self.dbdir, 'index')
+
+    def test_index_file_is_used_on_load(self):
+        db = self.open_db_file()
+        db['one'] = 'one'
+        db['two'] = 'two'
+        db.close()
+        self.assertTrue(os.path.isfile(self.index_filename()))
+        db, loader = self.open_with_recording_loader()
+        data_size = os.path.getsize(db._data_filename)
+        self.assertEqual(loader.start_offsets, [data_size])
+        self.assertIsInstance(db._index, diskindex.DiskIndex)
+        self.assertEqual(db['one'], b'one')
+        self.assertEqual(sorted(db.keys()), [b'one', b'two'])
+        db.close()
+
+    def test_load_replays_tail_written_without_disk_index(self):
+        db = self.open_db_file()
+        db['one'] = 'one'
+        db['two'] = 'two'
+        db.close()
+        covered = os.path.getsize(db._data_filename)
+        db = semidbm.open(self.dbdir, 'c')
+        db['three'] = 'three'
+        del db['one']
+        db.close()
+        db, loader = self.open_with_recording_loader()
+        self.assertEqual(loader.start_offsets, [covered])
+        self.assertEqual(sorted(db.keys()), [b'three', b'two'])
+        self.assertEqual(len(db._index), 2)
+        db.close()
+
+    def test_unsynced_index_is_rebuilt(self):
+        db = self.open_db_file()
+        db['one'] = 'one'
+        db.sync()
+        db['two'] = 'two'
+        del db['one']
+        # Simulate a crash: the index is never synced.
+        db._index.close()
+        os.close(db._data_fd)
+        db, loader = self.open_with_recording_loader()
+        self.assertEqual(loader.start_offsets, [None])
+        self.assertEqual(list(db.keys()), [b'two'])
+        db.close()
+
+    def test_index_for_different_data_file_is_rebuilt(self):
+        db = self.open_db_file()
+        db['one'] = 'one'
+        db['one'] = 'updated'
+        db.close()
+        semidbm.open(self.dbdir, 'c').compact()
+        db, loader = self.open_with_recording_loader()
+        self.assertEqual(loader.start_offsets, [None])
+        self.assertEqual(db['one'], b'updated')
+        db.close()
+
+    def test_compaction_replaces_index_file(self):
+        db = self.open_db_file()
+        for i in range(10):
+            db['key%s' % i] = 'value%s' % i
+            db['key%s' % i] = 'updated%s' % i
+        del db['key0']
+        db.compact()
+        self.assertEqual(db['key1'], b'updated1')
+        self.assertNotIn(b'key0', db)
+        self.assertFalse(os.path.exists(os.path.join(self.dbdir, 'compact')))
+        db.close()
+        db, loader = self.open_with_recording_loader()
+        self.assertEqual(loader.start_offsets,
+                         [os.path.getsize(db._data_filename)])
+        self.assertEqual(len(db._index), 9)
+        db.close()
+
+    def test_resize_and_reopen(self):
+        db = self.open_db_file()
+        for i in range(3000):
+            db['key%s' % i] = 'value%s' % i
+        for i in range(0, 3000, 2):
+            del db['key%s' % i]
+        db.close()
+        self.assertGreater(db._index._capacity, diskindex.MIN_CAPACITY)
+        self.assertFalse(os.path.exists(self.index_filename() + '.new'))
+        db = self.open_db_file()
+        self.assertEqual(len(db._index), 1500)
+        self.assertEqual(db['key2999'], b'value2999')
+        self.assertNotIn(b'key2998', db)
+        db.close()
+
+    def test_hash_collisions(self):
+        original = diskindex.key_hash
+        diskindex.key_hash = lambda key: 7
+        try:
+            db = self.open_db_file()
+            db['one'] = 'one'
+            db['two'] = 'two'
+            db['three'] = 'three'
+            del db['two']
+            db['four'] = 'four'
+            self.assertEqual(db['one'], b'one')
+            self.assertEqual(db['three'], b'three')
+            self.assertEqual(db['four'], b'four')
+            self.assertNotIn(b'two', db)
+            self.assertEqual(db._index._used, 3)
+            db.close()
+        finally:
+            diskindex.key_hash = original
+
+    def test_read_only_never_writes_index_file(self):
+        db = self.open_db_file()
+        db['one'] = 'one'
+        db.close()
+        db = semidbm.open(self.dbdir, 'c')
+        db['two'] = 'two'
+        db.close()
+        with open(self.index_filename(), 'rb') as f:
+            contents = f.read()
+        db = semidbm.open(self.dbdir, 'r', index='disk')
+        self.assertEqual(db['two'], b'two')
+        db.close()
+        os.remove(self.index_filename())
+        db = semidbm.open(self.dbdir, 'r', index='disk', use_mmap=True)
+        self.assertEqual(db['one'], b'one')
+        db.close()
+        self.assertFalse(os.path.exists(self.index_filename()))
+        db = self.open_db_file()
+        db.close()
+        with open(self.index_filename(), 'rb') as f:
+            self.assertNotEqual(f.read(), contents)
+
+    def test_new_db_removes_index_file(self):
+        db = self.open_db_file()
+        db['one'] = 'one'
+        db.close()
+        db = semidbm.open(self.dbdir, 'n', index='disk')
+        self.assertEqual(db.keys(), [])
+        db.close()
+
+    def test_compact_async_not_supported(self):
+        db = self.open_db_file()
+        self.assertRaises(semidbm.DBMError, db.compact_async)
+        db.close()
+
+    def test_invalid_combinations(self):
+        self.assertRaises(ValueError, self.open_db_file, hint_file=True)
+        self.assertRaises(ValueError, self.open_db_file, load_workers=2)
+        self.assertRaises(ValueError, self.open_db_file, segment_size=1024)
+        self.assertRaises(ValueError, self.open_db_file, thread_safe=True)
+
+
+@unittest.skipIf(mmap is None, 'mmap required')
+class TestReadOnlyWithSharedIndex(TestReadOnlyMode):
+    def open_db_file(self, **kwargs):
+        return semidbm.open(self.dbdir, 'r', index='shared', **kwargs)
+
+
+@unittest.skipIf(mmap is None, 'mmap required')
+class TestSharedIndex(SemiDBMTest):
+    def create_db(self, **items):
+        db = semidbm.open(self.dbdir, 'c')
+        for key, value in items.items():
+            db[key] = value
+        db.close()
+
+    def open_with_recording_loader(self):
+        kwargs = semidbm.db._create_default_params()
+        loader = RecordingLoader()
+        kwargs['data_loader'] = loader
+        cls = semidbm.db._db_class(semidbm.db._SemiDBMReadOnly,
+                                   [semidbm.db._SharedIndexMixin])
+        return cls(self.dbdir, **kwargs), loader
+
+    def index_filename(self):
+        return os.path.join(self.dbdir, 'index')
+
+    def test_first_open_writes_index_file(self):
+        self.create_db(one='one', two='two')
+        db, loader = self.open_with_recording_loader()
+        data_size = os.path.getsize(db._data_filename)
+        # The index file is built from the whole data file, after which
+        # there's nothing left to replay.
+        self.assertEqual(loader.start_offsets, [None, data_size])
+        self.assertTrue(os.path.isfile(self.index_filename()))
+        self.assertEqual(db['one'], b'one')
+        self.assertEqual(sorted(db.keys()), [b'one', b'two'])
+        db.close()
+
+    def test_other_handles_attach_without_building(self):
+        self.create_db(one='one', two='two')
+        first, loader = self.open_with_recording_loader()
+        inode = os.stat(self.index_filename()).st_ino
+        second, loader = self.open_with_recording_loader()
+        # The data file is only replayed to load the tail past the
+        # covered offset, which is empty.
+        data_size = os.path.getsize(second._data_filename)
+        self.assertEqual(loader.start_offsets, [data_size])
+        self.assertEqual(os.stat(self.index_filename()).st_ino, inode)
+        self.assertEqual(second['two'], b'two')
+        first.close()
+        second.close()
+
+    def test_appended_entries_update_index_file(self):
+        self.create_db(one='one', two='two')
+        semidbm.open(self.dbdir, 'r', index='shared').close()
+        covered = os.path.getsize(os.path.join(self.dbdir, 'data'))
+        db = semidbm.open(self.dbdir, 'w')
+        db['three'] = 'three'
+        del db['one']
+        db.close()
+        db, loader = self.open_with_recording_loader()
+        # Only the appended entries are replayed into a copy of the
+        # index file.
+        self.assertEqual(loader.start_offsets[0], covered)
+        self.assertEqual(sorted(db.keys()), [b'three', b'two'])
+        db.close()
+        db, loader = self.open_with_recording_loader()
+        self.assertEqual(sorted(db.keys()), [b'three', b'two'])
+        db.close()
+
+    def test_entry_being_written_is_not_covered(self):
+        self.create_db(**dict(('key%s' % i, 'value%s' % i)
+                              for i in range(10)))
+        entry = semidbm.db._pack_entry(b'new', b'x' * 100)
+        with self.open_data_file(mode='ab') as f:
+            f.write(entry[:20])
+        db = semidbm.open(self.dbdir, 'r', index='shared')
+        self.assertEqual(len(db.keys()), 10)
+        db.close()
+        inode = os.stat(self.index_filename()).st_ino
+        # Other handles use the index file as is while the entry is
+        # still incomplete.
+        db = semidbm.open(self.dbdir, 'r', index='shared')
+        self.assertEqual(len(db.keys()), 10)
+        db.close()
+        self.assertEqual(os.stat(self.index_filename()).st_ino, inode)
+        with self.open_data_file(mode='ab') as f:
+            f.write(entry[20:])
+        for i in range(2):
+            db = semidbm.open(self.dbdir, 'r', index='shared')
+            self.assertEqual(len(db.keys()), 11)
+            self.assertEqual(db['new'], b'x' * 100)
+            db.close()
+
+    def test_compacted_db_is_detected(self):
+        self.create_db(one='one', two='two')
+        reader = semidbm.open(self.dbdir, 'r', index='shared')
+        db = semidbm.open(self.dbdir, 'c')
+        del db['one']
+        db['two'] = 'new'
+        db.compact()
+        db.close()
+        db, loader = self.open_with_recording_loader()
+        self.assertEqual(loader.start_offsets[0], None)
+        self.assertEqual(db.keys(), [b'two'])
+        self.assertEqual(db['two'], b'new')
+        db.close()
+        # A handle opened before the compaction keeps using the index
+        # and data file it was opened with.
+        self.assertEqual(reader['one'], b'one')
+        self.assertEqual(reader['two'], b'two')
+        reader.close()
+
+    def test_uses_index_synced_by_disk_index_writer(self):
+        db = semidbm.open(self.dbdir, 'c', index='disk')
+        db['one'] = 'one'
+        db.close()
+        inode = os.stat(self.index_filename()).st_ino
+        db = semidbm.open(self.dbdir, 'r', index='shared')
+        self.assertEqual(db['one'], b'one')
+        self.assertEqual(os.stat(self.index_filename()).st_ino, inode)
+        db.close()
+
+    def test_unwritable_index_file_falls_back_to_private_index(self):
+        self.create_db(one='one')
+        # A directory in place of the temporary file makes the index
+        # file impossible to update.
+        os.mkdir(self.index_filename() + '.tmp')
+        db = semidbm.open(self.dbdir, 'r', index='shared')
+        self.assertEqual(db['one'], b'one')
+        db.close()
+        self.assertFalse(os.path.exists(self.index_filename()))
+
+    def test_requires_read_only(self):
+        self.create_db(one='one')
+        self.assertRaises(ValueError, semidbm.open, self.dbdir, 'c',
+                          index='shared')
+        self.assertRaises(ValueError, semidbm.open, self.dbdir, 'r',
+                          index='shared', hint_file=True)
+
+
+class TestThreadSafe(TestSemiDBM):
+    def open_db_file(self, **kwargs):
+        kwargs.setdefault('thread_safe', True)
+        return semidbm.open(self.dbdir, 'c', **kwargs)
+
+    def test_cant_combine_with_compact_index(self):
+        self.assertRaises(ValueError, self.open_db_file, index='compact')
+
+    def test_compact_without_pread(self):
+        # The read lock is only used without os.pread, which is decided
+        # when semidbm is imported, so this runs in a new interpreter.
+        script = '\n'.join([
+            'import os, sys',
+            'if hasattr(os, "pread"):',
+            '    del os.pread',
+            'sys.path.insert(0, %r)' % os.path.dirname(
+                os.path.dirname(os.path.abspath(semidbm.__file__))),
+            'import semidbm',
+            'assert semidbm.compat.pread is None',
+            'db = semidbm.open(%r, "c", thread_safe=True)' % self.dbdir,
+            'db["foo"] = "bar"',
+            'db["foo"] = "baz"',
+            'db.compact()',
+            'assert db["foo"] == b"baz"',
+            'db.close()',
+        ])
+        process = subprocess.Popen([sys.executable, '-c', script])
+        deadline = time.time() + 30
+        while process.poll() is None and time.time() < deadline:
+            time.sleep(0.01)
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+            self.fail("compact() deadlocked without pread")
+        self.assertEqual(process.returncode, 0)
+
+    def test_concurrent_reads_writes_and_compaction(self):
+        db = self.open_db_file()
+        for i in range(100):
+            db[str(i)] = str(i) * 10
+        errors = []
+        done = threading.Event()
+
+        def reader():
+            try:
+                while not done.is_set():
+                    for i in range(100):
+                        self.assertEqual(db[str(i)],
+                                         str(i).encode('ascii') * 10)
+            except Exception as e:
+                errors.append(e)
+
+        def writer():
+            try:
+                for i in range(50):
+                    db['extra%s' % i] = 'extra'
+                    del db['extra%s' % i]
+                    if i % 10 == 0:
+                        db.compact()
+            except Exception as e:
+                errors.append(e)
+
+        readers = [threading.Thread(target=reader) for i in range(4)]
+        writers = [threading.Thread(target=writer) for i in range(2)]
+        for t in readers + writers:
+            t.start()
+        for t in writers:
+            t.join()
+        done.set()
+        for t in readers:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(db.keys()), 100)
+        db.close()
+
+    def test_iterate_while_writing(self):
+        db = self.open_db_file()
+        db['one'] = 'one'
+        db['two'] = 'two'
+        for key in db:
+            db[key + b'-copy'] = db[key]
+        self.assertEqual(len(db.keys()), 4)
+        db.close()
+
+    def test_read_only_thread_safe(self):
+        db = self.open_db_file()
+        db['foo'] = 'bar'
+        db.close()
+        db = semidbm.open(self.dbdir, 'r', thread_safe=True)
+        self.assertEqual(db['foo'], b'bar')
+        self.assertRaises(semidbm.DBMError, db.__setitem__, 'foo', 'bar')
+        db.close()
+
+    def test_compactions_close_old_data_files(self):
+        db = self.open_db_file()
+        db['foo'] = 'bar'
+        for i in range(20):
+            db['foo'] = 'bar%s' % i
+            db.compact()
+        self.assertEqual(db._retired_states, [])
+        self.assertEqual(db['foo'], b'bar19')
+        db.close()
+
+    @unittest.skipIf(compat.pread is None, 'pread required')
+    def test_data_file_kept_open_while_read(self):
+        db = self.open_db_file()
+        db['foo'] = 'bar'
+        state = db._acquire_reader_state()
+        db.compact()
+        # A reader that's still using the old data file can read it.
+        self.assertEqual(compat.pread(state.fd, 3, state.index[b'foo'][0]),
+                         b'bar')
+        self.assertFalse(state.closed)
+        state.release()
+        self.assertTrue(state.closed)
+        self.assertEqual(db._retired_states, [state])
+        db['foo'] = 'baz'
+        db.compact()
+        self.assertEqual(db._retired_states, [])
+        self.assertEqual(db['foo'], b'baz')
+        db.close()
+
+    def test_stream_keeps_data_file_open(self):
+        db = self.open_db_file()
+        db['one'] = 'one'
+        db['two'] = 'two'
+        items = db.items()
+        self.assertEqual(next(items), (b'one', b'one'))
+        db.compact()
+        self.assertEqual(list(items), [(b'two', b'two')])
+        self.assertTrue(all(state.closed for state in db._retired_states))
+        db.close()
+
+
+class TestWithWriteBuffer(TestSemiDBM):
+    def open_db_file(self, **kwargs):
+        kwargs.setdefault('write_buffer_size', 64)
+        return semidbm.open(self.dbdir, 'c', **kwargs)
+
+    def data_file_size(self):
+        return os.path.getsize(os.path.join(self.dbdir, 'data'))
+
+    def test_writes_are_buffered(self):
+        db = self.open_db_file(write_buffer_size=1024)
+        db['foo'] = 'bar'
+        self.assertEqual(self.data_file_size(), 8)
+        self.assertEqual(db['foo'], b'bar')
+        self.assertIn('foo', db)
+        db.flush()
+        self.assertEqual(self.data_file_size(), 8 + 8 + 6 + 4)
+        self.assertEqual(db['foo'], b'bar')
+        db.close()
+
+    def test_writes_to_same_key_are_collapsed(self):
+        db = self.open_db_file(write_buffer_size=1024)
+        for i in range(10):
+            db['foo'] = str(i)
+        db.close()
+        # Only the last value is written to the data file.
+        self.assertEqual(self.data_file_size(), 8 + 8 + 4 + 4)
+        db2 = self.open_db_file()
+        self.assertEqual(db2['foo'], b'9')
+        db2.close()
+
+    def test_delete_of_buffered_key_writes_nothing(self):
+        db = self.open_db_file(write_buffer_size=1024)
+        db['foo'] = 'bar'
+        del db['foo']
+        self.assertNotIn('foo', db)
+        self.assertRaises(KeyError, db.__getitem__, 'foo')
+        self.assertRaises(KeyError, db.__delitem__, 'foo')
+        db.close()
+        self.assertEqual(self.data_file_size(), 8)
+
+    def test_buffered_delete_of_existing_key(self):
+        db = self.open_db_file(write_buffer_size=1024)
+        db['foo'] = 'bar'
+        db.flush()
+        del db['foo']
+        self.assertNotIn('foo', db)
+        self.assertRaises(KeyError, db.__getitem__, 'foo')
+        db.close()
+        db2 = self.open_db_file()
+        self.assertNotIn(b'foo', db2)
+        db2.close()
+
+    def test_buffer_flushed_when_count_reached(self):
+        db = self.open_db_file(write_buffer_size=1024 * 1024,
+                               write_buffer_count=3)
+        db['one'] = '1'
+        db['two'] = '2'
+        self.assertEqual(self.data_file_size(), 8)
+        db['three'] = '3'
+        self.assertTrue(self.data_file_size() > 8)
+        self.assertEqual(db._pending, {})
+        db.close()
+
+    def test_buffer_flushed_with_single_write(self):
+        db = self.open_db_file(write_buffer_size=1024)
+        writes = []
+        original_write = os.write
+
+        def recording_write(fd, data):
+            writes.append(data)
+            return original_write(fd, data)
+        for i in range(10):
+            db[str(i)] = str(i)
+        os.write = recording_write
+        try:
+            db.flush()
+        finally:
+            os.write = original_write
+        self.assertEqual(len(writes), 1)
+        db.close()
+
+    def test_failed_flush_leaves_index_unchanged(self):
+        db = self.open_db_file(write_buffer_size=1024)
+        db['foo'] = 'bar'
+        db['gone'] = 'value'
+        db.flush()
+        db.space_stats()
+        db['foo'] = 'new'
+        db['new'] = 'value'
+        del db['gone']
+        index = dict(db._index)
+        dead_bytes = db._dead_bytes
+        original_write_all = semidbm.db._write_all
+
+        def failing_write_all(fd, data):
+            raise OSError(28, 'No space left on device')
+        semidbm.db._write_all = failing_write_all
+        try:
+            self.assertRaises(OSError, db.flush)
+        finally:
+            semidbm.db._write_all = original_write_all
+        self.assertEqual(dict(db._index), index)
+        self.assertEqual(db._dead_bytes, dead_bytes)
+        # The buffered writes are kept and written by the next flush.
+        db.flush()
+        self.assertEqual(db['foo'], b'new')
+        self.assertNotIn('gone', db)
+        db.close()
+        db = self.open_db_file()
+        self.assertEqual(sorted(db.keys()), [b'foo', b'new'])
+        db.close()
+
+    def test_cant_combine_with_thread_safe(self):
+        self.assertRaises(ValueError, self.open_db_file, thread_safe=True)
+
+
+class TestBatchMethods(SemiDBMTest):
+    def record_reads(self, db):
+        reads = []
+        original = db._read_at
+
+        def read_at(offset, size):
+            reads.append((offset, size))
+            return original(offset, size)
+        db._read_at = read_at
+        return reads
+
+    def test_adjacent_values_read_together(self):
+        db = self.open_db_file()
+        for i in range(10):
+            db[str(i)] = str(i) * 10
+        reads = self.record_reads(db)
+        values = db.get_many([str(i) for i in reversed(range(10))])
+        self.assertEqual(len(reads), 1)
+        for i in range(10):
+            self.assertEqual(values[str(i).encode('ascii')],
+                             str(i).encode('ascii') * 10)
+        db.close()
+
+    def test_distant_values_read_separately(self):
+        db = self.open_db_file()
+        db['first'] = 'first'
+        db['filler'] = b'x' * (semidbm.db._COALESCE_GAP + 1)
+        db['last'] = 'last'
+        reads = self.record_reads(db)
+        values = db.get_many(['last', 'first'])
+        self.assertEqual(values, {b'first': b'first', b'last': b'last'})
+        self.assertEqual(len(reads), 2)
+        db.close()
+
+    def test_get_many_verifies_checksums(self):
+        db = self.open_db_file()
+        db['key'] = 'value'
+        db['other'] = 'other'
+        db.close()
+        with self.open_data_file(mode='rb') as f:
+            contents = f.read()
+        with self.open_data_file(mode='wb') as f:
+            f.write(contents.replace(b'value', b'Value'))
+        db = self.open_db_file(verify_checksums=True)
+        self.assertRaises(semidbm.DBMChecksumError, db.get_many,
+                          ['key', 'other'])
+        db.close()
+
+    def test_set_many_uses_single_write(self):
+        db = self.open_db_file()
+        writes = []
+        original_write = os.write
+
+        def recording_write(fd, data):
+            writes.append(data)
+            return original_write(fd, data)
+        os.write = recording_write
+        try:
+            db.set_many(dict((str(i), str(i)) for i in range(10)))
+            db.delete_many([str(i) for i in range(5)])
+        finally:
+            os.write = original_write
+        self.assertEqual(len(writes), 2)
+        self.assertEqual(len(db.keys()), 5)
+        db.close()
+
+
+class TestBackgroundCompaction(SemiDBMTest):
+    def populate(self, db, num_keys=100):
+        for i in range(num_keys):
+            db[str(i)] = 'original'
+        for i in range(num_keys):
+            db[str(i)] = str(i)
+
+    def blocking_callback(self):
+        # Returns a progress callback that blocks the compaction thread
+        # once all the keys have been copied, until the returned event
+        # is set.
+        resume = threading.Event()
+
+        def callback(copied, total):
+            if copied == total:
+                resume.wait(5)
+        return callback, resume
+
+    def test_compact_async(self):
+        db = self.open_db_file()
+        self.populate(db)
+        size_before = os.path.getsize(db._data_filename)
+        handle = db.compact_async()
+        self.assertTrue(handle.wait())
+        self.assertTrue(handle.done())
+        self.assertEqual(handle.progress, 1.0)
+        self.assertTrue(os.path.getsize(db._data_filename) < size_before)
+        self.assertFalse(os.path.exists(os.path.join(self.dbdir, 'compact')))
+        for i in range(100):
+            self.assertEqual(db[str(i)], str(i).encode('ascii'))
+        db.close()
+
+    def test_writes_during_compaction_are_kept(self):
+        db = self.open_db_file()
+        self.populate(db)
+        callback, resume = self.blocking_callback()
+        handle = db.compact_async(progress_callback=callback)
+        db['new'] = 'new'
+        db['0'] = 'updated'
+        del db['1']
+        resume.set()
+        handle.wait()
+        self.assertEqual(db['new'], b'new')
+        self.assertEqual(db['0'], b'updated')
+        self.assertNotIn(b'1', db)
+        self.assertEqual(db['2'], b'2')
+        db['after'] = 'after'
+        db.close()
+
+        db2 = self.open_db_file()
+        self.assertEqual(db2['new'], b'new')
+        self.assertEqual(db2['0'], b'updated')
+        self.assertEqual(db2['after'], b'after')
+        self.assertNotIn(b'1', db2)
+        self.assertEqual(len(db2.keys()), 101)
+        db2.close()
+
+    def test_batch_during_compaction_is_kept(self):
+        db = self.open_db_file()
+        self.populate(db)
+        callback, resume = self.blocking_callback()
+        handle = db.compact_async(progress_callback=callback)
+        with db.batch() as batch:
+            batch['new'] = 'new'
+            del batch['1']
+        resume.set()
+        handle.wait()
+        db.close()
+        db2 = self.open_db_file()
+        self.assertEqual(db2['new'], b'new')
+        self.assertNotIn(b'1', db2)
+        self.assertEqual(len(db2.keys()), 100)
+        db2.close()
+
+    def test_cancel(self):
+        db = self.open_db_file()
+        self.populate(db)
+        size_before = os.path.getsize(db._data_filename)
+        callback, resume = self.blocking_callback()
+        handle = db.compact_async(progress_callback=callback)
+        self.assertTrue(handle.cancel())
+        resume.set()
+        self.assertTrue(handle.wait())
+        self.assertTrue(handle.cancelled())
+        self.assertEqual(os.path.getsize(db._data_filename), size_before)
+        self.assertFalse(os.path.exists(os.path.join(self.dbdir, 'compact')))
+        # Another compaction can be started after a cancelled one.
+        db.compact_async().wait()
+        self.assertEqual(db['5'], b'5')
+        db.close()
+
+    def test_progress_callback(self):
+        db = self.open_db_file()
+        self.populate(db, num_keys=10)
+        calls = []
+        db.compact_async(
+            progress_callback=lambda *args: calls.append(args)).wait()
+        self.assertEqual(calls[-1], (10, 10))
+        db.close()
+
+    def test_only_one_compaction_at_a_time(self):
+        db = self.open_db_file()
+        self.populate(db)
+        callback, resume = self.blocking_callback()
+        handle = db.compact_async(progress_callback=callback)
+        self.assertRaises(semidbm.DBMError, db.compact_async)
+        self.assertRaises(semidbm.DBMError, db.compact)
+        resume.set()
+        handle.wait()
+        db.close()
+
+    def test_close_waits_for_compaction(self):
+        db = self.open_db_file()
+        self.populate(db)
+        handle = db.compact_async()
+        db.close()
+        self.assertTrue(handle.done())
+        db2 = self.open_db_file()
+        self.assertEqual(db2['99'], b'99')
+        db2.close()
+
+    def test_thread_safe_db_swaps_in_background(self):
+        db = self.open_db_file(thread_safe=True)
+        self.populate(db)
+        callback, resume = self.blocking_callback()
+        handle = db.compact_async(progress_callback=callback)
+        db['new'] = 'new'
+        resume.set()
+        handle._thread.join(5)
+        # The compacted file was swapped in without calling wait().
+        self.assertTrue(handle.done())
+        self.assertEqual(db['new'], b'new')
+        self.assertEqual(db['50'], b'50')
+        db.close()
+
+    def test_read_only_cant_compact_async(self):
+        db = self.open_db_file()
+        db.close()
+        db = semidbm.open(self.dbdir, 'r')
+        self.assertRaises(semidbm.DBMError, db.compact_async)
+        db.close()
+
+
+class TestSegmented(TestSemiDBM):
+    def open_db_file(self, **kwargs):
+        kwargs.setdefault('segment_size', 64)
+        return semidbm.open(self.dbdir, 'c', **kwargs)
+
+    def segment_files(self):
+        return sorted(name for name in os.listdir(self.dbdir)
+                      if name.startswith('segment.'))
+
+    # These tests modify or count the files of a single file db.
+    @unittest.skip('single data file test')
+    def test_compaction_does_not_leave_behind_files(self):
+        pass
+
+    @unittest.skip('single data file test')
+    def test_bad_magic_number(self):
+        pass
+
+    @unittest.skip('single data file test')
+    def test_incompatible_version_number(self):
+        pass
+
+    @unittest.skip('single data file test')
+    def test_recover_from_last_failed_write(self):
+        pass
+
+    @unittest.skip('single data file test')
+    def test_file_thats_truncated(self):
+        pass
+
+    @unittest.skip('single data file test')
+    def test_key_size_says_to_read_past_end_of_file(self):
+        pass
+
+    @unittest.skip('single data file test')
+    def test_torn_batch_is_not_loaded(self):
+        pass
+
+    @unittest.skip('single data file test')
+    def test_batch_with_bad_checksum_is_skipped(self):
+        pass
+
+    @unittest.skip('single data file test')
+    def test_batch_in_version_2_file_has_no_commit_record(self):
+        pass
+
+    @unittest.skip('single data file test')
+    def test_negative_batch_size(self):
+        pass
+
+    def test_rolls_over_to_new_segments(self):
+        db = self.open_db_file()
+        for i in range(20):
+            db[str(i)] = 'value%s' % i
+        db.close()
+        self.assertTrue(len(self.segment_files()) > 1)
+        for filename in self.segment_files():
+            self.assertTrue(os.path.getsize(
+                os.path.join(self.dbdir, filename)) < 64 + 30)
+        db2 = self.open_db_file()
+        for i in range(20):
+            self.assertEqual(db2[str(i)], ('value%s' % i).encode('ascii'))
+        db2.close()
+
+    def test_compact_only_merges_dirty_segments(self):
+        db = self.open_db_file(segment_size=100)
+        for i in range(10):
+            db['cold%s' % i] = 'cold'
+        cold = self.segment_files()[:-1]
+        self.assertTrue(len(cold) >= 2)
+        # Now create segments full of superseded data.
+        for i in range(20):
+            db['hot'] = 'hot%s' % i
+        db.compact()
+        remaining = self.segment_files()
+        for filename in cold:
+            self.assertIn(filename, remaining)
+        self.assertTrue(len(remaining) < len(cold) + 5, remaining)
+        self.assertEqual(db['hot'], b'hot19')
+        db.close()
+        db2 = self.open_db_file(segment_size=100)
+        self.assertEqual(db2['hot'], b'hot19')
+        for i in range(10):
+            self.assertEqual(db2['cold%s' % i], b'cold')
+        db2.close()
+
+    def test_deletes_kept_when_older_segments_not_merged(self):
+        db = self.open_db_file(segment_size=100)
+        for i in range(10):
+            db['key%s' % i] = 'value'
+        # key0 lives in the oldest (clean) segment.  Delete it in
+        # a segment that is mostly dead.
+        del db['key0']
+        for i in range(20):
+            db['hot'] = 'hot%s' % i
+        db.compact()
+        self.assertNotIn(b'key0', db)
+        db.close()
+        db2 = self.open_db_file(segment_size=100)
+        self.assertNotIn(b'key0', db2)
+        self.assertEqual(db2['key1'], b'value')
+        db2.close()
+
+    def test_interrupted_merge(self):
+        db = self.open_db_file(segment_size=100)
+        db['gone'] = 'value'
+        db['kept'] = 'value'
+        del db['gone']
+        for i in range(20):
+            db['hot'] = 'hot%s' % i
+        before = {}
+        for filename in self.segment_files():
+            with open(os.path.join(self.dbdir, filename), 'rb') as f:
+                before[filename] = f.read()
+        db.compact()
+        db.close()
+        removed = sorted(set(before) - set(self.segment_files()))
+        self.assertTrue(len(removed) > 1)
+        # Simulate crashing after writing the merged segment, but before
+        # removing some (or all) of the merged segments.  Segments are
+        # removed oldest first.
+        for num_removed in range(len(removed)):
+            for filename in removed[num_removed:]:
+                with open(os.path.join(self.dbdir, filename), 'wb') as f:
+                    f.write(before[filename])
+            db2 = self.open_db_file(segment_size=100)
+            self.assertNotIn(b'gone', db2)
+            self.assertEqual(db2['kept'], b'value')
+            self.assertEqual(db2['hot'], b'hot19')
+            db2.close()
+
+    def test_segment_stats(self):
+        db = self.open_db_file(segment_size=1000)
+        db['foo'] = 'bar'
+        db['foo'] = 'baz'
+        stats = db.segment_stats()
+        self.assertEqual(len(stats), 1)
+        self.assertEqual(stats[0]['size'], 8 + 2 * (8 + 6 + 4))
+        self.assertEqual(stats[0]['live_bytes'], 8 + 6 + 4)
+        self.assertEqual(stats[0]['dead_ratio'], 0.5)
+        db.close()
+
+    def test_open_modes(self):
+        self.assertRaises(semidbm.DBMError, semidbm.open, self.dbdir, 'w',
+                          segment_size=64)
+        db = self.open_db_file()
+        db['foo'] = 'bar'
+        db.close()
+        db = semidbm.open(self.dbdir, 'w', segment_size=64)
+        self.assertEqual(db['foo'], b'bar')
+        db.close()
+        db = semidbm.open(self.dbdir, 'r', segment_size=64)
+        self.assertEqual(db['foo'], b'bar')
+        self.assertRaises(semidbm.DBMError, db.__setitem__, 'foo', 'bar')
+        db.close()
+        db = semidbm.open(self.dbdir, 'n', segment_size=64)
+        self.assertEqual(list(db.keys()), [])
+        self.assertEqual(len(self.segment_files()), 1)
+        db.close()
+
+    def test_incompatible_options(self):
+        for option in ['hint_file', 'thread_safe', 'write_buffer_size']:
+            self.assertRaises(ValueError, self.open_db_file,
+                              **{option: 1024})
+        db = self.open_db_file()
+        self.assertRaises(semidbm.DBMError, db.compact_async)
+        db.close()
+
+
+class TestWithCompression(TestSemiDBM):
+    def open_db_file(self, **kwargs):
+        kwargs.setdefault('compression', 'zlib')
+        kwargs.setdefault('compression_threshold', 0)
+        return semidbm.open(self.dbdir, 'c', **kwargs)
+
+    def test_recover_from_last_failed_write(self):
+        # Same as the base test, except with a large value that doesn't
+        # compress, so truncating the data file only cuts off this value.
+        db = self.open_db_file()
+        db['foobar'] = 'foobar'
+        db['key'] = 'value'
+        db['largevalue'] = os.urandom(1024 * 10)
+        db.close()
+        self.truncate_data_file(bytes_from_end=100)
+        db2 = self.open_db_file()
+        self.assertEqual(db2['foobar'], b'foobar')
+        self.assertEqual(db2['key'], b'value')
+        self.assertNotIn('largevalue', db2)
+        db2.close()
+
+
+class TestCompression(SemiDBMTest):
+    value = b'compressible value ' * 100
+
+    def open_db_file(self, **kwargs):
+        kwargs.setdefault('compression', 'zlib')
+        return semidbm.open(self.dbdir, 'c', **kwargs)
+
+    def data_file_size(self):
+        return os.path.getsize(os.path.join(self.dbdir, 'data'))
+
+    def test_values_are_compressed(self):
+        db = self.open_db_file()
+        db['foo'] = self.value
+        self.assertLess(self.data_file_size(), len(self.value))
+        self.assertEqual(db['foo'], self.value)
+        db.close()
+        db2 = self.open_db_file()
+        self.assertEqual(db2['foo'], self.value)
+        db2.close()
+
+    def test_all_codecs(self):
+        for codec in semidbm.db._COMPRESSION_CODECS:
+            db = semidbm.open(self.dbdir, 'n', compression=codec)
+            db['foo'] = self.value
+            db.close()
+            db2 = semidbm.open(self.dbdir, 'r')
+            self.assertEqual(db2['foo'], self.value)
+            db2.close()
+
+    def test_values_below_threshold_are_not_compressed(self):
+        db = self.open_db_file(compression_threshold=len(self.value) + 1)
+        db['foo'] = self.value
+        self.assertGreater(self.data_file_size(), len(self.value))
+        self.assertEqual(db['foo'], self.value)
+        db.close()
+
+    def test_incompressible_values_are_stored_as_is(self):
+        db = self.open_db_file(compression_threshold=0)
+        db['foo'] = b'x'
+        self.assertEqual(db._index[b'foo'][1], 1)
+        db.close()
+
+    def test_read_without_compression_enabled(self):
+        db = self.open_db_file()
+        db['foo'] = self.value
+        db['bar'] = b'bar'
+        db.close()
+        db2 = semidbm.open(self.dbdir, 'r', verify_checksums=True)
+        self.assertEqual(db2['foo'], self.value)
+        self.assertEqual(db2.get_many(['foo', 'bar']),
+                         {b'foo': self.value, b'bar': b'bar'})
+        db2.close()
+
+    def test_simple_file_loader(self):
+        db = self.open_db_file()
+        db['foo'] = self.value
+        db['bar'] = self.value * 2
+        del db['foo']
+        db.close()
+        kwargs = semidbm.db._create_default_params()
+        kwargs['data_loader'] = SimpleFileLoader()
+        db2 = semidbm.db._SemiDBMReadOnly(self.dbdir, **kwargs)
+        self.assertEqual(list(db2.keys()), [b'bar'])
+        self.assertEqual(db2['bar'], self.value * 2)
+        db2.close()
+
+    def test_batch_methods(self):
+        db = self.open_db_file()
+        db.set_many([('foo', self.value), ('bar', b'bar')])
+        self.assertEqual(db.get_many(['foo', 'bar']),
+                         {b'foo': self.value, b'bar': b'bar'})
+        db.close()
+
+    def test_write_buffer(self):
+        db = self.open_db_file(write_buffer_size=1024 * 1024)
+        db['foo'] = self.value
+        db.flush()
+        self.assertLess(self.data_file_size(), len(self.value))
+        self.assertEqual(db['foo'], self.value)
+        db.close()
+
+    def test_thread_safe(self):
+        db = self.open_db_file(thread_safe=True)
+        db['foo'] = self.value
+        self.assertEqual(db['foo'], self.value)
+        db.close()
+
+    @unittest.skipIf(mmap is None, 'mmap not available')
+    def test_mmap_mode(self):
+        db = self.open_db_file()
+        db['foo'] = self.value
+        db.close()
+        db2 = semidbm.open(self.dbdir, 'r', use_mmap=True)
+        self.assertEqual(db2['foo'], self.value)
+        self.assertEqual(view_bytes(db2.get_view('foo')), self.value)
+        db2.close()
+
+    def test_compact(self):
+        db = self.open_db_file()
+        db['foo'] = self.value
+        db['foo'] = self.value * 2
+        db.compact()
+        self.assertEqual(db['foo'], self.value * 2)
+        db.close()
+
+    def test_compact_async(self):
+        db = self.open_db_file()
+        db['foo'] = self.value
+        db['foo'] = self.value * 2
+        db['bar'] = self.value
+        db.compact_async().wait()
+        self.assertEqual(db['foo'], self.value * 2)
+        self.assertEqual(db['bar'], self.value)
+        db.close()
+
+    def test_hint_file(self):
+        db = self.open_db_file(hint_file=True)
+        db['foo'] = self.value
+        db.close()
+        db2 = self.open_db_file()
+        self.assertIsNotNone(db2._hint_offset)
+        self.assertEqual(db2['foo'], self.value)
+        db2.close()
+
+    def test_segmented(self):
+        db = self.open_db_file(segment_size=1024)
+        for i in range(10):
+            db[str(i)] = self.value
+        db['0'] = b'new'
+        db.compact()
+        db.close()
+        db2 = self.open_db_file(segment_size=1024)
+        self.assertEqual(db2['0'], b'new')
+        self.assertEqual(db2['9'], self.value)
+        db2.close()
+
+    def write_version_1_1_db(self):
+        db = semidbm.open(self.dbdir, 'n')
+        db['foo'] = self.value
+        db.close()
+        with self.open_data_file(mode='rb+') as f:
+            f.seek(4)
+            f.write(struct.pack('!HH', 1, 1))
+
+    def test_read_version_1_1_file(self):
+        self.write_version_1_1_db()
+        db = self.open_db_file()
+        self.assertEqual(db['foo'], self.value)
+        db.close()
+
+    def test_version_1_1_file_not_compressed_until_compacted(self):
+        self.write_version_1_1_db()
+        db = self.open_db_file()
+        db['bar'] = self.value
+        self.assertGreater(self.data_file_size(), len(self.value) * 2)
+        db.compact()
+        self.assertLess(self.data_file_size(), len(self.value))
+        db.close()
+        with self.open_data_file(mode='rb') as f:
+            f.seek(4)
+            self.assertEqual(struct.unpack('!HH', f.read(4)),
+                             semidbm.db.FILE_FORMAT_VERSION)
+
+    def test_corrupt_compressed_value_detected_with_checksums(self):
+        db = self.open_db_file()
+        db['foo'] = self.value
+        db.close()
+        with self.open_data_file(mode='rb+') as f:
+            # Flip a byte in the compressed value.
+            f.seek(-10, os.SEEK_END)
+            f.write(b'\x00')
+        db2 = self.open_db_file(verify_checksums=True)
+        self.assertRaises(semidbm.DBMChecksumError, db2.__getitem__, 'foo')
+        db2.close()
+
+    def test_unknown_codec(self):
+        db = self.open_db_file()
+        db['foo'] = self.value
+        db.close()
+        with self.open_data_file(mode='rb+') as f:
+            # The codec byte is right after <keysize><valsize><key>.
+            f.seek(8 + 8 + 3)
+            f.write(b'\xff')
+        db2 = self.open_db_file()
+        self.assertRaises(semidbm.DBMError, db2.__getitem__, 'foo')
+        db2.close()
+
+    def test_invalid_codec(self):
+        self.assertRaises(ValueError, self.open_db_file, compression='bad')
+
+
+class TestWithValueCache(TestSemiDBM):
+    def open_db_file(self, **kwargs):
+        kwargs.setdefault('cache_size', 1024 * 1024)
+        return semidbm.open(self.dbdir, 'c', **kwargs)
+
+
+class TestValueCache(SemiDBMTest):
+    def open_db_file(self, **kwargs):
+        kwargs.setdefault('cache_size', 1024)
+        return semidbm.open(self.dbdir, 'c', **kwargs)
+
+    def test_hits_and_misses(self):
+        db = self.open_db_file()
+        db['foo'] = 'bar'
+        self.assertEqual(db['foo'], b'bar')
+        self.assertEqual(db['foo'], b'bar')
+        self.assertEqual(db['foo'], b'bar')
+        stats = db.cache_stats()
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['entries'], 1)
+        self.assertEqual(stats['bytes'], 6)
+        db.close()
+
+    def test_evicts_least_recently_used(self):
+        db = self.open_db_file(cache_size=250)
+        for key in ('a', 'b', 'c'):
+            db[key] = key * 99
+            db[key]
+        # 'a' was evicted to make room for 'c'.
+        db['b']
+        stats = db.cache_stats()
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual(stats['hits'], 1)
+        db['a']
+        self.assertEqual(db.cache_stats()['misses'], 4)
+        # Reading 'a' evicted 'c', the least recently used key.
+        self.assertEqual(db.cache_stats()['evictions'], 2)
+        self.assertNotIn(b'c', db._cache)
+        db.close()
+
+    def test_invalidated_by_writes(self):
+        db = self.open_db_file()
+        db['foo'] = 'one'
+        db['bar'] = 'one'
+        db['baz'] = 'one'
+        db.get_many(['foo', 'bar', 'baz'])
+        db['foo'] = 'two'
+        self.assertEqual(db['foo'], b'two')
+        db.set_many({'bar': 'two'})
+        self.assertEqual(db['bar'], b'two')
+        del db['foo']
+        self.assertRaises(KeyError, db.__getitem__, 'foo')
+        db.delete_many(['bar'])
+        self.assertRaises(KeyError, db.__getitem__, 'bar')
+        self.assertEqual(db['baz'], b'one')
+        db.close()
+
+    def test_invalidated_by_compaction(self):
+        db = self.open_db_file()
+        db['foo'] = 'bar'
+        db['foo']
+        db.compact()
+        self.assertEqual(len(db._cache), 0)
+        self.assertEqual(db['foo'], b'bar')
+        db.compact_async().wait()
+        self.assertEqual(len(db._cache), 0)
+        self.assertEqual(db['foo'], b'bar')
+        db.close()
+
+    def test_cached_values_are_not_verified_again(self):
+        db = self.open_db_file(verify_checksums=True)
+        db['foo'] = 'bar'
+        self.assertEqual(db['foo'], b'bar')
+        db.close()
+        db = self.open_db_file(verify_checksums=True)
+        self.assertEqual(db['foo'], b'bar')
+        with self.open_data_file(mode='rb+') as f:
+            f.seek(-4, os.SEEK_END)
+            f.write(b'\x00\x00\x00\x00')
+        # Served from the cache, the corrupt checksum isn't seen.
+        self.assertEqual(db['foo'], b'bar')
+        db._cache.clear()
+        self.assertRaises(semidbm.DBMChecksumError, db.__getitem__, 'foo')
+        db.close()
+
+    def test_get_many_defaults_are_not_cached(self):
+        db = self.open_db_file()
+        db['foo'] = 'bar'
+        self.assertEqual(db.get_many(['foo', 'missing'], missing='default'),
+                         {b'foo': b'bar', b'missing': None})
+        self.assertEqual(db.get_many(['foo', 'missing'], missing='skip'),
+                         {b'foo': b'bar'})
+        self.assertRaises(KeyError, db.get_many, ['missing'])
+        self.assertNotIn(b'missing', db._cache)
+        self.assertEqual(db.cache_stats()['hits'], 1)
+        db.close()
+
+    def test_large_values_are_not_cached(self):
+        db = self.open_db_file(cache_size=10)
+        db['foo'] = 'a' * 100
+        self.assertEqual(db['foo'], b'a' * 100)
+        self.assertEqual(db.cache_stats()['entries'], 0)
+        db.close()
+
+    def test_with_write_buffer(self):
+        db = self.open_db_file(write_buffer_size=1024 * 1024)
+        db['foo'] = 'one'
+        self.assertEqual(db['foo'], b'one')
+        db['foo'] = 'two'
+        db.flush()
+        self.assertEqual(db['foo'], b'two')
+        db.close()
+
+    def test_read_only(self):
+        db = self.open_db_file()
+        db['foo'] = 'bar'
+        db.close()
+        db2 = semidbm.open(self.dbdir, 'r', cache_size=1024)
+        self.assertEqual(db2['foo'], b'bar')
+        self.assertEqual(db2['foo'], b'bar')
+        self.assertEqual(db2.cache_stats()['hits'], 1)
+        self.assertRaises(semidbm.DBMError, db2.__setitem__, 'foo', 'baz')
+        db2.close()
+
+    def test_segmented(self):
+        db = self.open_db_file(segment_size=64)
+        for i in range(10):
+            db[str(i)] = 'value'
+            db[str(i)]
+        db['0'] = 'new'
+        db.compact()
+        self.assertEqual(db['0'], b'new')
+        self.assertEqual(db['9'], b'value')
+        db.close()
+
+    def test_cant_be_used_with_thread_safe(self):
+        self.assertRaises(ValueError, self.open_db_file, thread_safe=True)
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_put_and_get(self):
+        cache = LRUCache(100)
+        cache.put(b'foo', b'bar')
+        self.assertEqual(cache.get(b'foo'), b'bar')
+        self.assertIsNone(cache.get(b'missing'))
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 1)
+
+    def test_replace_updates_size(self):
+        cache = LRUCache(100)
+        cache.put(b'foo', b'bar')
+        cache.put(b'foo', b'barbaz')
+        self.assertEqual(cache.current_bytes, 9)
+        self.assertEqual(len(cache), 1)
+
+    def test_evicts_until_within_budget(self):
+        cache = LRUCache(20)
+        cache.put(b'a', b'x' * 9)
+        cache.put(b'b', b'x' * 9)
+        cache.put(b'c', b'x' * 19)
+        self.assertEqual(cache.evictions, 2)
+        self.assertEqual(cache.current_bytes, 20)
+        self.assertIsNone(cache.get(b'a'))
+
+    def test_discard_and_clear(self):
+        cache = LRUCache(100)
+        cache.put(b'a', b'1')
+        cache.put(b'b', b'2')
+        cache.discard(b'a')
+        cache.discard(b'missing')
+        self.assertEqual(cache.current_bytes, 2)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.current_bytes, 0)
+
+    def test_get_moves_to_most_recently_used(self):
+        cache = LRUCache(20)
+        cache.put(b'a', b'x' * 9)
+        cache.put(b'b', b'x' * 9)
+        cache.get(b'a')
+        cache.put(b'c', b'x' * 9)
+        self.assertIn(b'a', cache)
+        self.assertNotIn(b'b', cache)
+
+
+class TestLRUCacheWithoutOrderedDict(TestLRUCache):
+    # The fallback used on python 2.6.
+    def setUp(self):
+        self.original = semidbm.cache.OrderedDict
+        semidbm.cache.OrderedDict = semidbm.cache._OrderedEntries
+
+    def tearDown(self):
+        semidbm.cache.OrderedDict = self.original
+
+    def test_ordered_entries(self):
+        entries = semidbm.cache._OrderedEntries()
+        for key in 'abcd':
+            entries[key] = key.upper()
+        entries['b'] = 'new'
+        self.assertEqual(len(entries), 4)
+        self.assertEqual(entries.pop('c'), 'C')
+        self.assertNotIn('c', entries)
+        self.assertRaises(KeyError, entries.pop, 'c')
+        self.assertIsNone(entries.pop('c', None))
+        self.assertEqual(entries.popitem(last=False), ('a', 'A'))
+        self.assertEqual(entries.popitem(), ('d', 'D'))
+        self.assertEqual(entries.popitem(), ('b', 'new'))
+        self.assertRaises(KeyError, entries.popitem)
+        entries['e'] = 'E'
+        entries.clear()
+        self.assertEqual(len(entries), 0)
+        entries['f'] = 'F'
+        self.assertEqual(entries.popitem(last=False), ('f', 'F'))
+
+
+@unittest.skipIf(mmap is None, 'mmap not available')
+class TestVerify(SemiDBMTest):
+    def populate(self, **kwargs):
+        db = semidbm.open(self.dbdir, 'c', **kwargs)
+        for i in range(100):
+            db['key%s' % i] = 'value%s' % i
+        db['old'] = 'superseded'
+        db['old'] = 'live'
+        db['deleted'] = 'deleted'
+        del db['deleted']
+        db.close()
+
+    def open_db_file(self, **kwargs):
+        return semidbm.open(self.dbdir, 'c', **kwargs)
+
+    def corrupt(self, data):
+        # Flips the first byte of data in the data file.
+        filename = os.path.join(self.dbdir, 'data')
+        with open(filename, 'r+b') as f:
+            contents = f.read()
+            offset = contents.index(data)
+            f.seek(offset)
+            f.write(b'X')
+        return offset
+
+    def entry_offset(self, db, key):
+        return db._index[key][0] - 8 - len(key)
+
+    def test_no_corruption(self):
+        self.populate()
+        db = self.open_db_file()
+        self.assertEqual(db.verify(), [])
+        self.assertEqual(db.verify(include_superseded=True), [])
+        db.close()
+
+    def test_corrupt_live_value(self):
+        self.populate()
+        self.corrupt(b'value42')
+        db = self.open_db_file()
+        self.assertEqual(db.verify(),
+                         [(self.entry_offset(db, b'key42'), b'key42')])
+        db.close()
+
+    def test_superseded_entries_are_optional(self):
+        self.populate()
+        self.corrupt(b'superseded')
+        db = self.open_db_file()
+        self.assertEqual(db.verify(), [])
+        bad = db.verify(include_superseded=True)
+        self.assertEqual([key for offset, key in bad], [b'old'])
+        self.assertLess(bad[0][0], self.entry_offset(db, b'old'))
+        db.close()
+
+    def test_corrupt_header(self):
+        self.populate()
+        db = self.open_db_file()
+        offset = self.entry_offset(db, b'key99')
+        # A db with a corrupt header can't be loaded, so the header is
+        # corrupted after the db is opened.
+        with open(os.path.join(self.dbdir, 'data'), 'r+b') as f:
+            f.seek(offset)
+            f.write(struct.pack('!i', 1024 * 1024))
+        self.assertEqual(db.verify(), [(offset, None)])
+        db.close()
+
+    def test_compressed_values(self):
+        self.populate(compression='zlib', compression_threshold=0)
+        db = self.open_db_file()
+        self.assertEqual(db.verify(), [])
+        db.close()
+
+    def test_progress_callback(self):
+        self.populate()
+        db = self.open_db_file()
+        progress = []
+        db.verify(progress_callback=lambda done, total: progress.append(
+            (done, total)))
+        total = os.path.getsize(os.path.join(self.dbdir, 'data')) - 8
+        self.assertEqual(progress[-1], (total, total))
+        db.close()
+
+    def test_entries_written_by_buffered_db(self):
+        db = self.open_db_file(write_buffer_size=1024 * 1024)
+        db['one'] = 'one'
+        self.assertEqual(db.verify(include_superseded=True), [])
+        self.assertEqual(os.path.getsize(db._data_filename),
+                         db._current_offset)
+        db.close()
+
+    def test_segmented_not_supported(self):
+        db = self.open_db_file(segment_size=4096)
+        self.assertRaises(semidbm.DBMError, db.verify)
+        db.close()
+
+    def test_batches(self):
+        self.populate()
+        db = self.open_db_file()
+        with db.batch() as batch:
+            for i in range(10):
+                batch['batch%s' % i] = 'batched%s' % i
+            del batch['key0']
+        self.assertEqual(db.verify(include_superseded=True), [])
+        self.corrupt(b'batched5')
+        self.assertEqual(db.verify(),
+                         [(self.entry_offset(db, b'batch5'), b'batch5')])
+        db.close()
+
+
+class TestVerifyRegions(TestVerify):
+    def setUp(self):
+        super(TestVerifyRegions, self).setUp()
+        self.original_settings = (scrub.REGION_SIZE, scrub._READ_SIZE,
+                                  scrub.MIN_PARALLEL_SIZE)
+        scrub.REGION_SIZE = 256
+        scrub._READ_SIZE = 13
+        scrub.MIN_PARALLEL_SIZE = 0
+
+    def tearDown(self):
+        scrub.REGION_SIZE, scrub._READ_SIZE, scrub.MIN_PARALLEL_SIZE = \
+            self.original_settings
+        super(TestVerifyRegions, self).tearDown()
+
+    def test_progress_is_reported_per_region(self):
+        self.populate()
+        db = self.open_db_file()
+        progress = []
+        db.verify(progress_callback=lambda done, total: progress.append(
+            done))
+        self.assertGreater(len(progress), 5)
+        self.assertEqual(progress, sorted(progress))
+        db.close()
+
+    def test_verify_in_parallel(self):
+        self.populate()
+        self.corrupt(b'value42')
+        self.corrupt(b'superseded')
+        db = self.open_db_file()
+        self.assertEqual(db.verify(workers=2),
+                         [(self.entry_offset(db, b'key42'), b'key42')])
+        bad = db.verify(include_superseded=True, workers=2)
+        self.assertEqual(sorted(key for offset, key in bad),
+                         [b'key42', b'old'])
+        db.close()
+
+
+class TestSpaceStats(SemiDBMTest):
+    def open_db_file(self, **kwargs):
+        return semidbm.open(self.dbdir, 'c', **kwargs)
+
+    def assert_counted(self, db):
+        # The incrementally maintained count has to match a count
+        # from scratch.
+        stats = db.space_stats()
+        self.assertEqual(stats['dead_bytes'], db._count_dead_bytes())
+        self.assertEqual(stats['size'],
+                         os.path.getsize(os.path.join(self.dbdir, 'data')))
+        return stats
+
+    def test_empty_db(self):
+        db = self.open_db_file()
+        self.assertEqual(db.space_stats(), {
+            'size': 8, 'live_bytes': 0, 'dead_bytes': 0, 'dead_ratio': 0.0})
+        db.close()
+
+    def test_overwrite_and_delete(self):
+        db = self.open_db_file()
+        db['a'] = 'b'
+        db.space_stats()
+        # <keysize><valsize><key><val><keyvalcksum> is 14 bytes.
+        db['a'] = 'c'
+        self.assertEqual(self.assert_counted(db)['dead_bytes'], 14)
+        del db['a']
+        # The delete itself is dead too.
+        stats = self.assert_counted(db)
+        self.assertEqual(stats['dead_bytes'], 14 + 14 + 13)
+        self.assertEqual(stats['live_bytes'], 0)
+        self.assertEqual(stats['dead_ratio'], 1.0)
+        db.close()
+
+    def test_counts_are_loaded_from_existing_db(self):
+        db = self.open_db_file()
+        db['a'] = 'b'
+        db['a'] = 'c'
+        db['b'] = 'd'
+        db.close()
+        db = self.open_db_file()
+        stats = db.space_stats()
+        self.assertEqual(stats['dead_bytes'], 14)
+        self.assertEqual(stats['live_bytes'], 28)
+        self.assertEqual(stats['dead_ratio'], 14 / 42.0)
+        db.close()
+
+    def test_batch_writes(self):
+        db = self.open_db_file()
+        db.set_many({'a': '1', 'b': '2', 'c': '3'})
+        db.space_stats()
+        db.set_many({'a': '4', 'd': '5'})
+        db.delete_many(['b', 'c'])
+        self.assertEqual(self.assert_counted(db)['dead_bytes'],
+                         14 * 3 + 13 * 2)
+        db.close()
+
+    def test_buffered_writes(self):
+        db = self.open_db_file(write_buffer_size=1024)
+        db['a'] = '1'
+        db['b'] = '2'
+        db.space_stats()
+        db['a'] = '3'
+        db['a'] = '4'
+        del db['b']
+        self.assertEqual(self.assert_counted(db)['dead_bytes'],
+                         14 * 2 + 13)
+        db.close()
+
+    def test_compaction_reclaims_dead_bytes(self):
+        db = self.open_db_file()
+        for i in range(10):
+            db['key'] = 'value%s' % i
+        self.assertGreater(db.space_stats()['dead_ratio'], 0.8)
+        db.compact()
+        self.assertEqual(self.assert_counted(db)['dead_bytes'], 0)
+        db['key'] = 'new'
+        self.assertEqual(self.assert_counted(db)['dead_bytes'], 21)
+        db.close()
+
+    def test_background_compaction(self):
+        db = self.open_db_file()
+        for i in range(10):
+            db['key'] = 'value%s' % i
+        db.space_stats()
+        db.compact_async().wait()
+        self.assertEqual(self.assert_counted(db)['dead_bytes'], 0)
+        db.close()
+
+    def test_read_only_refresh(self):
+        writer = self.open_db_file()
+        writer['a'] = 'b'
+        writer.sync()
+        reader = semidbm.open(self.dbdir, 'r')
+        self.assertEqual(reader.space_stats()['dead_bytes'], 0)
+        writer['a'] = 'c'
+        writer.sync()
+        reader.refresh()
+        self.assertEqual(reader.space_stats()['dead_bytes'], 14)
+        reader.close()
+        writer.close()
+
+    def test_thread_safe(self):
+        db = self.open_db_file(thread_safe=True)
+        db['a'] = 'b'
+        db['a'] = 'c'
+        self.assertEqual(self.assert_counted(db)['dead_bytes'], 14)
+        db.close()
+
+    def test_segmented(self):
+        db = self.open_db_file(segment_size=64)
+        for i in range(10):
+            db['key'] = 'value%s' % i
+        stats = db.space_stats()
+        segments = db.segment_stats()
+        self.assertEqual(stats['size'],
+                         sum(segment['size'] for segment in segments))
+        # Only the last value is live.
+        self.assertEqual(stats['live_bytes'], 12 + 3 + 6)
+        self.assertEqual(stats['dead_bytes'] + stats['live_bytes'],
+                         stats['size'] - 8 * len(segments))
+        db.close()
+
+
+class TestAutoCompact(SemiDBMTest):
+    def open_db_file(self, **kwargs):
+        kwargs.setdefault('auto_compact_ratio', 0.5)
+        return semidbm.open(self.dbdir, 'c', **kwargs)
+
+    def data_size(self):
+        return os.path.getsize(os.path.join(self.dbdir, 'data'))
+
+    def overwrite(self, db, count=10):
+        for i in range(count):
+            db['key'] = 'value%s' % i
+
+    def test_sync_compacts_when_ratio_reached(self):
+        db = self.open_db_file()
+        db['other'] = 'x' * 100
+        db.sync()
+        size = self.data_size()
+        self.overwrite(db)
+        db.sync()
+        self.assertLess(self.data_size(), size + 12 + 3 + 6 + 1)
+        self.assertEqual(db.space_stats()['dead_bytes'], 0)
+        self.assertEqual(db['key'], b'value9')
+        self.assertEqual(db['other'], b'x' * 100)
+        db.close()
+
+    def test_write_mode(self):
+        self.open_db_file().close()
+        db = semidbm.open(self.dbdir, 'w', auto_compact_ratio=0.3)
+        self.overwrite(db)
+        db.sync()
+        self.assertEqual(db.space_stats()['dead_bytes'], 0)
+        self.overwrite(db)
+        db.close()
+        db = semidbm.open(self.dbdir, 'r')
+        self.assertEqual(db['key'], b'value9')
+        self.assertEqual(db.space_stats()['dead_bytes'], 0)
+        db.close()
+
+    def test_below_ratio_does_not_compact(self):
+        db = self.open_db_file()
+        db['other'] = 'x' * 1000
+        self.overwrite(db, 2)
+        db.sync()
+        self.assertEqual(db.space_stats()['dead_bytes'], 21)
+        db.close()
+
+    def test_min_size(self):
+        db = self.open_db_file(auto_compact_min_size=1024 * 1024)
+        self.overwrite(db)
+        db.sync()
+        self.assertEqual(db.space_stats()['dead_bytes'], 9 * 21)
+        db.close()
+
+    def test_interval_limits_compactions(self):
+        db = self.open_db_file(auto_compact_interval=3600)
+        self.overwrite(db)
+        db.sync()
+        self.assertEqual(db.space_stats()['dead_bytes'], 0)
+        self.overwrite(db)
+        db.sync()
+        # Too soon after the last compaction.
+        self.assertEqual(db.space_stats()['dead_bytes'], 10 * 21)
+        db.close()
+
+    def test_close_compacts(self):
+        db = self.open_db_file(auto_compact_interval=3600)
+        self.overwrite(db)
+        db.close()
+        self.assertEqual(self.data_size(), 8 + 12 + 3 + 6)
+        db = self.open_db_file()
+        self.assertEqual(db['key'], b'value9')
+        db.close()
+
+    def test_background(self):
+        db = self.open_db_file(auto_compact_background=True,
+                               thread_safe=True)
+        self.overwrite(db)
+        db.sync()
+        deadline = time.time() + 5
+        while (db.space_stats()['dead_bytes'] != 0 and
+               time.time() < deadline):
+            time.sleep(0.01)
+        self.assertEqual(db.space_stats()['dead_bytes'], 0)
+        self.assertEqual(db['key'], b'value9')
+        db.close()
+        db = self.open_db_file()
+        self.assertEqual(db['key'], b'value9')
+        self.assertEqual(db.space_stats()['dead_bytes'], 0)
+        db.close()
+
+    def test_with_write_buffer(self):
+        db = self.open_db_file(write_buffer_size=1024)
+        self.overwrite(db)
+        db.flush()
+        # The buffered writes to the same key were collapsed.
+        self.assertEqual(db.space_stats()['dead_bytes'], 0)
+        db['key'] = 'first'
+        db.flush()
+        db['key'] = 'second'
+        db.sync()
+        self.assertEqual(db.space_stats()['dead_bytes'], 0)
+        db.close()
+
+    def test_invalid_arguments(self):
+        with self.assertRaises(ValueError):
+            semidbm.open(self.dbdir, 'r', auto_compact_ratio=0.5)
+        with self.assertRaises(ValueError):
+            semidbm.open(self.dbdir, 'c', auto_compact_ratio=0.5,
+                         segment_size=1024)
+        with self.assertRaises(ValueError):
+            semidbm.open(self.dbdir, 'c', auto_compact_ratio=0.5,
+                         index='disk', auto_compact_background=True)
+        with self.assertRaises(ValueError):
+            semidbm.open(self.dbdir, 'c', auto_compact_ratio=0.5,
+                         auto_compact_background=True)
+
+
+class TestStreamingItems(SemiDBMTest):
+    def setUp(self):
+        super(TestStreamingItems, self).setUp()
+        self.original_settings = (semidbm.db._STREAM_READ_SIZE,
+                                  semidbm.db._STREAM_GAP)
+        semidbm.db._STREAM_READ_SIZE = 256
+        semidbm.db._STREAM_GAP = 64
+
+    def tearDown(self):
+        semidbm.db._STREAM_READ_SIZE, semidbm.db._STREAM_GAP = \
+            self.original_settings
+        super(TestStreamingItems, self).tearDown()
+
+    def populate(self, db):
+        for i in range(100):
+            db['key%03d' % i] = 'value%03d' % i
+
+    def count_reads(self, db):
+        reads = []
+        original = db._stream_snapshot
+
+        def _stream_snapshot():
+            locations, read_at, advise = original()
+
+            def counting_read_at(offset, size):
+                reads.append(size)
+                return read_at(offset, size)
+            return locations, counting_read_at, advise
+        db._stream_snapshot = _stream_snapshot
+        return reads
+
+    def test_values_are_read_in_chunks(self):
+        db = self.open_db_file()
+        self.populate(db)
+        reads = self.count_reads(db)
+        items = list(db.items())
+        self.assertEqual(items, [(b'key%03d' % i, b'value%03d' % i)
+                                 for i in range(100)])
+        # Each entry is 26 bytes, so a read covers 10 values.
+        self.assertEqual(len(reads), 10)
+        self.assertTrue(all(size <= 256 for size in reads))
+        db.close()
+
+    def test_superseded_entries_are_not_read(self):
+        db = self.open_db_file()
+        db['first'] = 'a'
+        db['big'] = 'x' * 100
+        db['big'] = 'y'
+        db['first'] = 'b'
+        reads = self.count_reads(db)
+        self.assertEqual(list(db.items()), [(b'big', b'y'), (b'first', b'b')])
+        self.assertEqual(reads, [1 + 12 + 5 + 1])
+        db.close()
+
+    def test_iteration_is_lazy(self):
+        db = self.open_db_file()
+        self.populate(db)
+        reads = self.count_reads(db)
+        items = db.items()
+        self.assertEqual(reads, [])
+        self.assertEqual(next(items), (b'key000', b'value000'))
+        self.assertEqual(len(reads), 1)
+        items.close()
+        db.close()
+
+    def test_writes_after_snapshot_are_not_seen(self):
+        db = self.open_db_file()
+        self.populate(db)
+        items = db.items()
+        db['key000'] = 'new'
+        del db['key001']
+        db['key100'] = 'value100'
+        self.assertEqual(len(list(items)), 100)
+        db.close()
+
+    def test_checksums_are_verified(self):
+        db = self.open_db_file(verify_checksums=True)
+        self.populate(db)
+        db.close()
+        with self.open_data_file(mode='r+b') as f:
+            contents = f.read()
+            f.seek(contents.index(b'value042'))
+            f.write(b'X')
+        db = self.open_db_file(verify_checksums=True)
+        with self.assertRaises(semidbm.DBMChecksumError):
+            list(db.items())
+        db.close()
+
+    def test_compressed_values(self):
+        db = self.open_db_file(compression='zlib', compression_threshold=0)
+        db['key'] = 'value' * 100
+        db['other'] = 'x'
+        self.assertEqual(dict(db.items()),
+                         {b'key': b'value' * 100, b'other': b'x'})
+        db.close()
+
+    def test_write_buffer_is_flushed(self):
+        db = self.open_db_file(write_buffer_size=1024 * 1024)
+        self.populate(db)
+        self.assertEqual(len(list(db.itervalues())), 100)
+        db.close()
+
+    def test_thread_safe_snapshot_survives_compaction(self):
+        db = self.open_db_file(thread_safe=True)
+        self.populate(db)
+        for i in range(100):
+            db['key%03d' % i] = 'new%03d' % i
+        items = db.items()
+        self.assertEqual(next(items), (b'key000', b'new000'))
+        db.compact()
+        rest = list(items)
+        if semidbm.compat.pread is None:
+            raise unittest.SkipTest("Old data files are closed without pread")
+        self.assertEqual(rest, [(b'key%03d' % i, b'new%03d' % i)
+                                for i in range(1, 100)])
+        db.close()
+
+    def test_sequential_hint(self):
+        db = self.open_db_file()
+        self.populate(db)
+        calls = []
+        original = db._stream_snapshot
+
+        def _stream_snapshot():
+            locations, read_at, advise = original()
+            return locations, read_at, calls.append
+        db._stream_snapshot = _stream_snapshot
+        items = db.items()
+        next(items)
+        self.assertEqual(calls, [True])
+        items.close()
+        self.assertEqual(calls, [True, False])
+        db.close()
+
+
+class TestWithSyncEachWrite(TestSemiDBM):
+    def open_db_file(self, **kwargs):
+        kwargs.setdefault('durability', 'write')
+        return semidbm.open(self.dbdir, 'c', **kwargs)
+
+
+class TestWithGroupCommit(TestSemiDBM):
+    def open_db_file(self, **kwargs):
+        kwargs.setdefault('durability', 'group')
+        return semidbm.open(self.dbdir, 'c', **kwargs)
+
+
+class TestDurability(SemiDBMTest):
+    def count_syncs(self, db):
+        # Records the data file offset at each sync.
+        syncs = []
+        fsync = db._fsync
+
+        def counting_fsync(fd):
+            syncs.append(db._current_offset)
+            fsync(fd)
+        db._fsync = counting_fsync
+        return syncs
+
+    def test_sync_each_write(self):
+        db = self.open_db_file(durability='write')
+        syncs = self.count_syncs(db)
+        db['a'] = 'b'
+        self.assertEqual(len(syncs), 1)
+        del db['a']
+        self.assertEqual(len(syncs), 2)
+        db.set_many({'a': '1', 'b': '2', 'c': '3'})
+        db.delete_many(['a', 'b'])
+        self.assertEqual(len(syncs), 4)
+        self.assertTrue(db.wait_durable())
+        self.assertEqual(len(syncs), 4)
+        db.close()
+
+    def test_compaction_is_not_synced_per_write(self):
+        db = self.open_db_file(durability='write')
+        for i in range(10):
+            db['key%s' % i] = 'value'
+        syncs = []
+        original = os.fsync
+
+        def fsync(fd):
+            syncs.append(fd)
+            original(fd)
+        os.fsync = fsync
+        try:
+            db.compact()
+        finally:
+            os.fsync = original
+        # The compacted data file is only synced once it's complete.
+        self.assertLess(len(syncs), 10)
+        self.assertEqual(db['key9'], b'value')
+        db.close()
+
+    def test_group_commit_syncs_in_background(self):
+        db = self.open_db_file(durability='group', sync_interval=0.01)
+        syncs = self.count_syncs(db)
+        for i in range(100):
+            db['key%s' % i] = 'value%s' % i
+        self.assertTrue(db.wait_durable(timeout=5))
+        self.assertLess(len(syncs), 100)
+        self.assertEqual(syncs[-1], db._current_offset)
+        db.close()
+
+    def test_group_commit_sync_bytes(self):
+        db = self.open_db_file(durability='group', sync_interval=3600,
+                               sync_bytes=100)
+        db['key'] = 'x' * 200
+        self.assertTrue(db.wait_durable(timeout=5))
+        db.close()
+
+    def test_wait_durable_timeout(self):
+        db = self.open_db_file(durability='group', sync_interval=3600)
+        db['key'] = 'value'
+        self.assertFalse(db.wait_durable(timeout=0.01))
+        db.sync()
+        self.assertTrue(db.wait_durable(timeout=0))
+        db.close()
+
+    def test_wait_durable_flushes_write_buffer(self):
+        db = self.open_db_file(durability='group', sync_interval=0.01,
+                               write_buffer_size=1024 * 1024)
+        db['key'] = 'value'
+        self.assertTrue(db.wait_durable(timeout=5))
+        self.assertEqual(db._synced_offset, db._current_offset)
+        self.assertGreater(db._current_offset, 8)
+        db.close()
+
+    def test_wait_durable_across_compaction(self):
+        db = self.open_db_file(durability='group', sync_interval=3600)
+        for i in range(10):
+            db['key'] = 'value%s' % i
+        db.compact()
+        self.assertTrue(db.wait_durable(timeout=0))
+        db.close()
+
+    def test_group_commit_with_background_compaction(self):
+        db = self.open_db_file(durability='group', sync_interval=0.001,
+                               thread_safe=True)
+        for i in range(100):
+            db['key%s' % i] = 'value%s' % i
+        db.compact_async().wait()
+        db['new'] = 'value'
+        self.assertTrue(db.wait_durable(timeout=5))
+        self.assertEqual(db['key99'], b'value99')
+        db.close()
+
+    def test_close_stops_thread(self):
+        db = self.open_db_file(durability='group')
+        thread = db._sync_thread
+        db['key'] = 'value'
+        db.close()
+        self.assertFalse(thread.is_alive())
+        db = self.open_db_file()
+        self.assertEqual(db['key'], b'value')
+        db.close()
+
+    def test_background_sync_error_is_raised(self):
+        db = self.open_db_file(durability='group', sync_interval=0.001)
+
+        def failing_fsync(fd):
+            raise OSError("disk on fire")
+        db._fsync = failing_fsync
+        db['key'] = 'value'
+        with self.assertRaises(semidbm.DBMError):
+            db.wait_durable(timeout=5)
+        db._fsync = os.fsync
+        self.assertRaises(semidbm.DBMError, db.sync)
+        db._sync_error = None
+        db.close()
+
+    def test_default_wait_durable_syncs(self):
+        db = self.open_db_file()
+        syncs = self.count_syncs(db)
+        db['key'] = 'value'
+        self.assertTrue(db.wait_durable())
+        self.assertEqual(len(syncs), 1)
+        db.close()
+
+    @unittest.skipUnless(hasattr(os, 'fdatasync'), "Requires fdatasync")
+    def test_fdatasync(self):
+        db = self.open_db_file(fdatasync=True)
+        self.assertIs(db._fsync, os.fdatasync)
+        db.close()
+        db = self.open_db_file()
+        self.assertIs(db._fsync, os.fsync)
+        db.close()
+
+    def test_invalid_arguments(self):
+        self.assertRaises(ValueError, self.open_db_file, durability='bad')
+        self.assertRaises(ValueError, semidbm.open, self.dbdir, 'r',
+                          durability='group')
+        self.assertRaises(ValueError, self.open_db_file, durability='write',
+                          segment_size=1024)
+        self.assertRaises(ValueError, self.open_db_file, durability='write',
+                          write_buffer_size=1024)
+
+
+class TestWithMetrics(TestSemiDBM):
+    def open_db_file(self, **kwargs):
+        kwargs.setdefault('metrics', True)
+        return semidbm.open(self.dbdir, 'c', **kwargs)
+
+
+class TestMetrics(SemiDBMTest):
+    def open_db_file(self, **kwargs):
+        kwargs.setdefault('metrics', True)
+        return semidbm.open(self.dbdir, 'c', **kwargs)
+
+    def test_disabled_by_default(self):
+        db = semidbm.open(self.dbdir, 'c')
+        self.assertFalse(hasattr(db, 'stats'))
+        db.close()
+
+    def test_counts_operations(self):
+        db = self.open_db_file()
+        db['foo'] = 'bar'
+        db[b'key'] = b'value'
+        self.assertEqual(db['foo'], b'bar')
+        self.assertRaises(KeyError, db.__getitem__, 'missing')
+        del db['foo']
+        db.sync()
+        stats = db.stats()
+        self.assertEqual(stats['get']['count'], 2)
+        self.assertEqual(stats['set']['count'], 2)
+        self.assertEqual(stats['delete']['count'], 1)
+        self.assertEqual(stats['sync']['count'], 1)
+        self.assertEqual(stats['fsync']['count'], 1)
+        self.assertEqual(stats['load']['count'], 1)
+        self.assertEqual(stats['compact']['count'], 0)
+        self.assertEqual(stats['get_misses'], 1)
+        self.assertEqual(stats['bytes_read'], 3)
+        self.assertEqual(stats['bytes_written'], 6 + 8)
+        self.assertEqual(stats['checksum_failures'], 0)
+        db.close()
+
+    def test_latency_histograms(self):
+        db = self.open_db_file()
+        for i in range(10):
+            db[str(i)] = str(i)
+        stats = db.stats()['set']
+        self.assertEqual(sum(stats['counts']), 10)
+        self.assertEqual(len(stats['counts']), len(stats['bounds']) + 1)
+        self.assertGreater(stats['total'], 0)
+        self.assertLessEqual(stats['max'], stats['total'])
+        db.close()
+
+    def test_compact_is_timed(self):
+        db = self.open_db_file()
+        db['foo'] = 'bar'
+        db['foo'] = 'baz'
+        db.compact()
+        stats = db.stats()
+        self.assertEqual(stats['compact']['count'], 1)
+        self.assertEqual(db['foo'], b'baz')
+        db.close()
+
+    def test_background_compaction_is_timed(self):
+        db = self.open_db_file()
+        db['foo'] = 'bar'
+        db['foo'] = 'baz'
+        self.assertTrue(db.compact_async().wait(timeout=5))
+        self.assertEqual(db.stats()['compact']['count'], 1)
+        self.assertEqual(db['foo'], b'baz')
+        db.close()
+
+    def test_bulk_operations_are_counted(self):
+        db = self.open_db_file()
+        db.set_many({'one': '1', b'two': b'22'})
+        with db.batch() as batch:
+            batch['three'] = '333'
+            del batch['one']
+        values = db.get_many(['two', 'three', 'missing'], 'skip')
+        self.assertEqual(values, {b'two': b'22', b'three': b'333'})
+        db.get_many(['two', 'missing'], 'default')
+        self.assertRaises(KeyError, db.get_many, ['missing'])
+        db.delete_many(['two'])
+        stats = db.stats()
+        self.assertEqual(stats['set_many']['count'], 1)
+        self.assertEqual(stats['batch']['count'], 1)
+        self.assertEqual(stats['get_many']['count'], 3)
+        self.assertEqual(stats['delete_many']['count'], 1)
+        self.assertEqual(stats['bytes_written'], 3 + 1 + 3 + 2 + 5 + 3)
+        self.assertEqual(stats['bytes_read'], 2 + 3 + 2)
+        self.assertEqual(stats['get_misses'], 3)
+        db.close()
+
+    def test_checksum_failures(self):
+        db = self.open_db_file()
+        db['foo'] = 'bar'
+        db.close()
+        with self.open_data_file(mode='rb+') as f:
+            contents = f.read()
+            f.seek(contents.index(b'bar'))
+            f.write(b'X')
+        db = self.open_db_file(verify_checksums=True)
+        self.assertRaises(semidbm.DBMChecksumError, db.__getitem__, 'foo')
+        self.assertEqual(len(db.verify()), 1)
+        self.assertEqual(db.stats()['checksum_failures'], 2)
+        db.close()
+
+    def test_group_commit_fsyncs_are_timed(self):
+        db = self.open_db_file(durability='group', sync_interval=0.001)
+        db['foo'] = 'bar'
+        self.assertTrue(db.wait_durable(timeout=5))
+        self.assertGreaterEqual(db.stats()['fsync']['count'], 1)
+        db.close()
+
+    def test_reset_stats(self):
+        db = self.open_db_file()
+        db['foo'] = 'bar'
+        db.reset_stats()
+        stats = db.stats()
+        self.assertEqual(stats['set']['count'], 0)
+        self.assertEqual(stats['bytes_written'], 0)
+        db.close()
+
+    def test_read_only(self):
+        db = self.open_db_file()
+        db['foo'] = 'bar'
+        db.close()
+        db = semidbm.open(self.dbdir, 'r', metrics=True)
+        self.assertEqual(db['foo'], b'bar')
+        self.assertEqual(db.stats()['get']['count'], 1)
+        db.close()
+
+    def test_histogram_buckets(self):
+        histogram = LatencyHistogram(bounds=(0.001, 0.01))
+        histogram.record(0.0005)
+        histogram.record(0.001)
+        histogram.record(0.005)
+        histogram.record(1)
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot['counts'], [2, 1, 1])
+        self.assertEqual(snapshot['count'], 4)
+        self.assertEqual(snapshot['max'], 1)
+
+
+class TestParallelLoad(SemiDBMTest):
+    def setUp(self):
+        super(TestParallelLoad, self).setUp()
+        self.original_settings = (parallel.BOUNDARY_INTERVAL,
+                                  parallel.MIN_PARALLEL_SIZE)
+        parallel.BOUNDARY_INTERVAL = 256
+        parallel.MIN_PARALLEL_SIZE = 0
+        self.boundaries_filename = os.path.join(self.dbdir, 'boundaries')
+
+    def tearDown(self):
+        parallel.BOUNDARY_INTERVAL, parallel.MIN_PARALLEL_SIZE = \
+            self.original_settings
+        super(TestParallelLoad, self).tearDown()
+
+    def open_db_file(self, **kwargs):
+        kwargs.setdefault('load_workers', 2)
+        return semidbm.open(self.dbdir, 'c', **kwargs)
+
+    def populate(self, **kwargs):
+        db = semidbm.open(self.dbdir, 'c', **kwargs)
+        for i in range(200):
+            db['key%s' % i] = 'value%s' % i
+        for i in range(0, 200, 3):
+            db['key%s' % i] = 'updated%s' % i
+        for i in range(0, 200, 5):
+            del db['key%s' % i]
+        # Deleted and then set again.
+        db['key0'] = 'new'
+        db.close()
+        db = semidbm.open(self.dbdir, 'r')
+        expected = dict((key, db[key]) for key in db.keys())
+        db.close()
+        return expected
+
+    def assert_contents(self, db, expected):
+        self.assertEqual(sorted(db.keys()), sorted(expected))
+        for key, value in expected.items():
+            self.assertEqual(db[key], value)
+
+    def test_load_in_parallel(self):
+        expected = self.populate()
+        db = self.open_db_file()
+        self.assert_contents(db, expected)
+        db.close()
+        self.assertTrue(os.path.isfile(self.boundaries_filename))
+        boundaries, covered = parallel.load_boundaries(
+            self.boundaries_filename, os.path.join(self.dbdir, 'data'))
+        self.assertGreater(len(boundaries), 10)
+        # The second load splits the data file at the boundaries.
+        db = self.open_db_file()
+        self.assert_contents(db, expected)
+        db.close()
+
+    def test_new_entries_after_boundaries_file(self):
+        self.populate()
+        self.open_db_file().close()
+        db = self.open_db_file()
+        for i in range(100):
+            db['new%s' % i] = 'value%s' % i
+        del db['key1']
+        db.close()
+        db = self.open_db_file()
+        self.assertEqual(db['new99'], b'value99')
+        self.assertNotIn(b'key1', db)
+        self.assertEqual(len(db.keys()), 161 + 100 - 1)
+        db.close()
+        db = semidbm.open(self.dbdir, 'r')
+        self.assertEqual(len(db.keys()), 161 + 100 - 1)
+        db.close()
+
+    def test_up_to_date_boundaries_file_is_not_rewritten(self):
+        self.populate()
+        self.open_db_file().close()
+        mtime = os.stat(self.boundaries_filename).st_mtime
+        os.utime(self.boundaries_filename, (mtime - 100, mtime - 100))
+        self.open_db_file().close()
+        self.assertEqual(os.stat(self.boundaries_filename).st_mtime,
+                         mtime - 100)
+
+    def test_stale_boundaries_file_is_ignored(self):
+        self.populate()
+        self.open_db_file().close()
+        db = semidbm.open(self.dbdir, 'c')
+        db.compact()
+        self.assertFalse(os.path.exists(self.boundaries_filename))
+        db.close()
+        self.open_db_file().close()
+        with open(self.boundaries_filename, 'rb+') as f:
+            f.seek(30)
+            f.write(b'\xff')
+        expected = self.populate()
+        db = self.open_db_file()
+        self.assert_contents(db, expected)
+        db.close()
+
+    def test_refresh_only_loads_tail(self):
+        expected = self.populate()
+        db = semidbm.open(self.dbdir, 'r', load_workers=2)
+        writer = semidbm.open(self.dbdir, 'c')
+        writer['new'] = 'value'
+        writer.close()
+
+        def reload():
+            raise AssertionError("The db was fully reloaded.")
+        db._reload = reload
+        db.refresh()
+        expected[b'new'] = b'value'
+        self.assert_contents(db, expected)
+        db.close()
+
+    def test_read_only_does_not_write_boundaries(self):
+        expected = self.populate()
+        db = semidbm.open(self.dbdir, 'r', load_workers=2)
+        self.assert_contents(db, expected)
+        db.close()
+        self.assertFalse(os.path.exists(self.boundaries_filename))
+
+    def test_with_hint_file(self):
+        self.populate(hint_file=True)
+        self.open_db_file().close()
+        db = self.open_db_file(hint_file=True)
+        for i in range(50):
+            db['new%s' % i] = 'value%s' % i
+        db.sync()
+        for i in range(50):
+            db['after%s' % i] = 'value%s' % i
+        db.close()
+        db = self.open_db_file()
+        self.assertEqual(db['new49'], b'value49')
+        self.assertEqual(db['after49'], b'value49')
+        self.assertEqual(len(db.keys()), 161 + 100)
+        db.close()
+
+    def test_with_compact_index_and_compression(self):
+        expected = self.populate(compression='zlib', compression_threshold=0)
+        self.open_db_file().close()
+        db = self.open_db_file(index='compact')
+        self.assert_contents(db, expected)
+        db.close()
+
+    def test_recover_from_last_failed_write(self):
+        self.populate()
+        db = self.open_db_file()
+        db['largevalue'] = 'foobarbaz' * 1024
+        db.close()
+        self.truncate_data_file(bytes_from_end=100)
+        db = self.open_db_file()
+        self.assertNotIn(b'largevalue', db)
+        self.assertEqual(db['key1'], b'value1')
+        db.close()
+
+    def test_torn_batch_is_truncated(self):
+        expected = self.populate()
+        with self.open_data_file(mode='ab') as f:
+            # The begin record of a batch that was never written.
+            f.write(struct.pack('!ii', -2, 100))
+        db = self.open_db_file()
+        self.assertEqual(db._loaded_offset,
+                         os.path.getsize(db._data_filename))
+        db['after'] = 'value'
+        db.close()
+        expected[b'after'] = b'value'
+        for i in range(2):
+            db = self.open_db_file()
+            self.assert_contents(db, expected)
+            db.close()
+
+    def test_negative_batch_size(self):
+        self.populate()
+        with self.open_data_file(mode='ab') as f:
+            f.write(struct.pack('!ii', -2, -20) + b'\x00' * 40)
+        self.assertRaises(semidbm.DBMLoadError, self.open_db_file)
+
+    def test_parse_region(self):
+        self.populate()
+        data_filename = os.path.join(self.dbdir, 'data')
+        live, deleted, boundaries, end = parallel.parse_region(
+            (data_filename, 8, None, 1024))
+        self.assertEqual(end, os.path.getsize(data_filename))
+        self.assertEqual(len(live), 161)
+        self.assertEqual(len(deleted), 39)
+        self.assertNotIn(b'key0', deleted)
+        for offset in boundaries:
+            # Parsing from a boundary gives the same final locations.
+            partial = parallel.parse_region(
+                (data_filename, offset, None, 1024))[0]
+            for key, location in partial.items():
+                self.assertEqual(live[key], location)
+
+    def test_batches(self):
+        expected = self.populate()
+        db = self.open_db_file()
+        for i in range(0, 50, 10):
+            with db.batch() as batch:
+                for j in range(i, i + 10):
+                    batch['key%s' % j] = 'batch%s' % j
+                    expected[('key%s' % j).encode('ascii')] = \
+                        ('batch%s' % j).encode('ascii')
+                key = 'key%s' % (199 - i)
+                del batch[key]
+                del expected[key.encode('ascii')]
+        db.close()
+        db = self.open_db_file()
+        self.assert_contents(db, expected)
+        db.close()
+        # The boundaries file written by the first load is used.
+        db = self.open_db_file()
+        self.assert_contents(db, expected)
+        db.close()
+
+    def test_cant_be_used_with_segments(self):
+        self.assertRaises(ValueError, self.open_db_file, segment_size=1024)
+
+
+class GatedLoader(SimpleFileLoader):
+    """A loader that doesn't load the index until it's released."""
+    def __init__(self, error=None):
+        self.released = threading.Event()
+        self.error = error
+
+    def load_index(self, filename, index, start_offset=None):
+        self.released.wait()
+        if self.error is not None:
+            raise self.error
+        return super(GatedLoader, self).load_index(
+            filename, index, start_offset)
+
+
+class TestWithLazyLoad(TestSemiDBM):
+    def open_db_file(self, **kwargs):
+        kwargs.setdefault('lazy', True)
+        db = semidbm.open(self.dbdir, 'c', **kwargs)
+        # Errors loading the index are raised once the load is done.
+        try:
+            db.wait_loaded()
+        except semidbm.DBMLoadError:
+            db.close()
+            raise
+        return db
+
+
+class TestLazyLoad(SemiDBMTest):
+    def populate(self):
+        db = semidbm.open(self.dbdir, 'c')
+        db['foo'] = 'bar'
+        db['bar'] = 'baz'
+        db.close()
+
+    def open_gated_db(self, loader, mixins=None, base=semidbm.db._SemiDBM):
+        if mixins is None:
+            mixins = [semidbm.db._LazyLoadMixin]
+        kwargs = semidbm.db._create_default_params()
+        kwargs['data_loader'] = loader
+        return semidbm.db._db_class(base, mixins)(self.dbdir, **kwargs)
+
+    def test_open_returns_before_index_is_loaded(self):
+        self.populate()
+        loader = GatedLoader()
+        db = self.open_gated_db(loader)
+        self.assertFalse(db.loaded)
+        self.assertFalse(db.wait_loaded(timeout=0.01))
+        loader.released.set()
+        self.assertTrue(db.wait_loaded())
+        self.assertTrue(db.loaded)
+        self.assertEqual(db['foo'], b'bar')
+        db.close()
+
+    def test_reads_wait_for_index(self):
+        self.populate()
+        loader = GatedLoader()
+        db = self.open_gated_db(loader)
+        threading.Timer(0.05, loader.released.set).start()
+        self.assertEqual(db['bar'], b'baz')
+        self.assertTrue(db.loaded)
+        db.close()
+
+    def test_writes_are_applied_after_replay(self):
+        self.populate()
+        loader = GatedLoader()
+        db = self.open_gated_db(loader)
+        threading.Timer(0.05, loader.released.set).start()
+        db['foo'] = 'new'
+        del db['bar']
+        self.assertEqual(db['foo'], b'new')
+        self.assertNotIn(b'bar', db)
+        db.close()
+        db = semidbm.open(self.dbdir, 'r')
+        self.assertEqual(list(db.keys()), [b'foo'])
+        self.assertEqual(db['foo'], b'new')
+        db.close()
+
+    def test_thread_safe_readers_see_loaded_index(self):
+        self.populate()
+        loader = GatedLoader()
+        db = self.open_gated_db(
+            loader, [semidbm.db._LazyLoadMixin, semidbm.db._ThreadSafeMixin])
+        loader.released.set()
+        self.assertEqual(db['foo'], b'bar')
+        db['foo'] = 'new'
+        self.assertEqual(db['foo'], b'new')
+        db.close()
+
+    def test_load_error_is_raised(self):
+        self.populate()
+        loader = GatedLoader(error=semidbm.DBMLoadError('bad data file'))
+        db = self.open_gated_db(loader)
+        loader.released.set()
+        self.assertRaises(semidbm.DBMLoadError, db.wait_loaded)
+        self.assertRaises(semidbm.DBMLoadError, db.__getitem__, b'foo')
+        self.assertFalse(db.loaded)
+        db.close()
+
+    def test_new_db_is_loaded_immediately(self):
+        db = self.open_gated_db(GatedLoader())
+        self.assertTrue(db.loaded)
+        db['foo'] = 'bar'
+        db.close()
+
+    def test_missing_db_raises_on_open(self):
+        self.assertRaises(semidbm.DBMError, semidbm.open, self.dbdir, 'w',
+                          lazy=True)
+
+    def test_compact_after_lazy_load(self):
+        self.populate()
+        db = semidbm.open(self.dbdir, 'c', lazy=True)
+        db['foo'] = 'new'
+        db.compact()
+        self.assertEqual(db['foo'], b'new')
+        self.assertEqual(db['bar'], b'baz')
+        db.close()
+
+    @unittest.skipIf(mmap is None, 'mmap required')
+    def test_read_only_mmap(self):
+        self.populate()
+        db = semidbm.open(self.dbdir, 'r', use_mmap=True, lazy=True)
+        self.assertEqual(view_bytes(db.get_view(b'foo')), b'bar')
+        db.close()
+
+    @unittest.skipIf(mmap is None, 'mmap required')
+    def test_read_only_mmap_entries_appended_during_load(self):
+        self.populate()
+        loader = GatedLoader()
+        db = self.open_gated_db(
+            loader, mixins=[semidbm.db._LazyLoadMMapMixin],
+            base=semidbm.db._SemiDBMReadOnlyMMap)
+        writer = semidbm.open(self.dbdir, 'c')
+        writer['new'] = 'value'
+        writer.close()
+        loader.released.set()
+        self.assertEqual(db['new'], b'value')
+        self.assertEqual(db['foo'], b'bar')
+        db.close()
+
+    def test_not_lazy_is_always_loaded(self):
+        db = semidbm.open(self.dbdir, 'c')
+        self.assertTrue(db.loaded)
+        self.assertTrue(db.wait_loaded())
+        db.close()
+
+    def test_cant_combine_with_segment_size(self):
+        self.assertRaises(ValueError, semidbm.open, self.dbdir, 'c',
+                          lazy=True, segment_size=1024)
+
+
+@unittest.skipIf(mmap is None, 'mmap required')
+class TestFrozen(SemiDBMTest):
+    def setUp(self):
+        super(TestFrozen, self).setUp()
+        self.frozen_filename = os.path.join(self.tempdir, 'frozen')
+
+    def export(self, **kwargs):
+        db = semidbm.open(self.dbdir, 'c', **kwargs)
+        db['one'] = 'one'
+        db['two'] = 'old'
+        db['two'] = 'two'
+        db['three'] = 'three'
+        del db['three']
+        db.export_frozen(self.frozen_filename)
+        db.close()
+        return frozen.open(self.frozen_filename)
+
+    def test_lookups(self):
+        db = self.export()
+        self.assertEqual(db['one'], b'one')
+        self.assertEqual(db[b'two'], b'two')
+        self.assertEqual(db.get('three'), None)
+        self.assertEqual(db.get('three', b'default'), b'default')
+        self.assertRaises(KeyError, db.__getitem__, 'three')
+        self.assertIn('one', db)
+        self.assertNotIn('three', db)
+        db.close()
+
+    def test_build_table(self):
+        # Two keys that collide in the first slot, one of them with the
+        # top bit of its hash set.
+        hashes = [2 ** 63 + 4, 12, 1]
+        num_slots, max_probes, table = frozen._build_table(
+            hashes, [10, 20, 30])
+        self.assertEqual(num_slots, 8)
+        self.assertEqual(max_probes, 2)
+        slots = [struct.unpack('!QQ', table[i * 16:i * 16 + 16])
+                 for i in range(num_slots)]
+        self.assertEqual(slots, [(0, 0), (1, 30), (0, 0), (0, 0),
+                                 (2 ** 63 + 4, 10), (12, 20), (0, 0), (0, 0)])
+
+    def test_only_live_entries_are_exported(self):
+        db = self.export()
+        self.assertEqual(len(db), 2)
+        self.assertEqual(sorted(db.keys()), [b'one', b'two'])
+        self.assertEqual(sorted(db.items()), [(b'one', b'one'),
+                                              (b'two', b'two')])
+        self.assertEqual(sorted(db.values()), [b'one', b'two'])
+        db.close()
+
+    def test_get_view(self):
+        db = self.export()
+        view = db.get_view('two')
+        self.assertEqual(view_bytes(view), b'two')
+        release_view(view)
+        self.assertRaises(KeyError, db.get_view, 'three')
+        db.close()
+
+    def test_get_view_without_mmap_buffer_support(self):
+        # Python 2's mmap can't be wrapped in a memoryview.
+        def memoryview(obj):
+            raise TypeError("cannot make memory view")
+        frozen.memoryview = memoryview
+        try:
+            db = self.export()
+        finally:
+            del frozen.memoryview
+        self.assertEqual(db.get_view('two'), b'two')
+        self.assertRaises(KeyError, db.get_view, 'three')
+        db.close()
+
+    def test_many_keys(self):
+        db = semidbm.open(self.dbdir, 'c')
+        for i in range(5000):
+            db[str(i)] = str(i * 2)
+        db.export_frozen(self.frozen_filename)
+        db.close()
+        db = frozen.open(self.frozen_filename)
+        self.assertEqual(len(db), 5000)
+        for i in range(5000):
+            self.assertEqual(db[str(i)], str(i * 2).encode('utf-8'))
+        self.assertNotIn('5000', db)
+        self.assertLessEqual(db._num_keys * 2, db._num_slots)
+        db.close()
+
+    def test_empty_db(self):
+        db = semidbm.open(self.dbdir, 'c')
+        db.export_frozen(self.frozen_filename)
+        db.close()
+        db = frozen.open(self.frozen_filename)
+        self.assertEqual(len(db), 0)
+        self.assertNotIn('one', db)
+        self.assertEqual(list(db.items()), [])
+        db.close()
+
+    def test_compressed_values_are_exported_uncompressed(self):
+        db = self.export(compression='zlib', compression_threshold=0)
+        self.assertEqual(db['one'], b'one')
+        db.close()
+
+    def test_export_flushes_write_buffer(self):
+        db = self.export(write_buffer_size=1024 * 1024)
+        self.assertEqual(db['two'], b'two')
+        db.close()
+
+    def test_export_from_segmented_db(self):
+        db = self.export(segment_size=4096)
+        self.assertEqual(sorted(db.keys()), [b'one', b'two'])
+        db.close()
+
+    def test_export_replaces_existing_file(self):
+        self.export().close()
+        db = semidbm.open(self.dbdir, 'c')
+        db['one'] = 'new'
+        db.export_frozen(self.frozen_filename)
+        db.close()
+        db = frozen.open(self.frozen_filename)
+        self.assertEqual(db['one'], b'new')
+        db.close()
+
+    def test_verify_checksums(self):
+        self.export().close()
+        with open(self.frozen_filename, 'r+b') as f:
+            contents = f.read()
+            f.seek(contents.index(b'one', frozen._HEADER.size + 11))
+            f.write(b'ONE')
+        db = frozen.open(self.frozen_filename)
+        self.assertEqual(db['one'], b'ONE')
+        db.close()
+        db = frozen.open(self.frozen_filename, verify_checksums=True)
+        self.assertRaises(semidbm.DBMChecksumError, db.__getitem__, 'one')
+        self.assertRaises(semidbm.DBMChecksumError, db.get_view, 'one')
+        self.assertEqual(db['two'], b'two')
+        db.close()
+
+    def test_bad_file_raises_load_error(self):
+        with open(self.frozen_filename, 'wb') as f:
+            f.write(b'\x00' * 100)
+        self.assertRaises(semidbm.DBMLoadError, frozen.open,
+                          self.frozen_filename)
+
+
+class TestCompactIndex(unittest.TestCase):
+    def test_set_and_get(self):
+        index = CompactIndex()
+        index[b'foo'] = (1 << 40, 10)
+        self.assertEqual(index[b'foo'], (1 << 40, 10))
+        self.assertIn(b'foo', index)
+        self.assertEqual(len(index), 1)
+
+    def test_update_reuses_slot(self):
+        index = CompactIndex()
+        index[b'foo'] = (1, 2)
+        index[b'foo'] = (3, 4)
+        self.assertEqual(index[b'foo'], (3, 4))
+        self.assertEqual(len(index._offsets), 1)
+
+    def test_deleted_slots_are_reused(self):
+        index = CompactIndex()
+        index[b'foo'] = (1, 2)
+        index[b'bar'] = (3, 4)
+        del index[b'foo']
+        self.assertNotIn(b'foo', index)
+        self.assertRaises(KeyError, index.__getitem__, b'foo')
+        index[b'baz'] = (5, 6)
+        self.assertEqual(len(index._offsets), 2)
+        self.assertEqual(index[b'baz'], (5, 6))
+        self.assertEqual(index[b'bar'], (3, 4))
+
+    def test_iteration(self):
+        index = CompactIndex()
+        index[b'foo'] = (1, 2)
+        index[b'bar'] = (3, 4)
+        self.assertEqual(set(index), set([b'foo', b'bar']))
+        self.assertEqual(set(index.keys()), set([b'foo', b'bar']))
+        self.assertEqual(dict(index.items()),
+                         {b'foo': (1, 2), b'bar': (3, 4)})
+
+    def test_get(self):
+        index = CompactIndex()
+        index[b'foo'] = (1, 2)
+        self.assertEqual(index.get(b'foo'), (1, 2))
+        self.assertIsNone(index.get(b'bar'))
+
+
+class TestSortedIndex(unittest.TestCase):
+    def test_set_get_and_delete(self):
+        index = SortedIndex()
+        index[b'foo'] = (1, 2)
+        index[b'bar'] = (3, 4)
+        self.assertEqual(index[b'foo'], (1, 2))
+        self.assertEqual(index.get(b'bar'), (3, 4))
+        self.assertIsNone(index.get(b'baz'))
+        del index[b'foo']
+        self.assertNotIn(b'foo', index)
+        self.assertEqual(len(index), 1)
+        self.assertEqual(dict(index.items()), {b'bar': (3, 4)})
+
+    def test_sorted_keys_are_built_on_first_use(self):
+        index = SortedIndex()
+        index.update({b'c': (1, 1), b'a': (2, 2)})
+        index[b'b'] = (3, 3)
+        self.assertIsNone(index._sorted)
+        self.assertEqual(list(index.iter_range()), [b'a', b'b', b'c'])
+        index[b'aa'] = (4, 4)
+        index[b'b'] = (5, 5)
+        del index[b'c']
+        index.update({b'd': (6, 6)})
+        self.assertEqual(index._sorted, [b'a', b'aa', b'b', b'd'])
+
+    def test_iter_range_bounds(self):
+        index = SortedIndex()
+        for key in (b'a', b'b', b'c', b'd'):
+            index[key] = (0, 0)
+        self.assertEqual(list(index.iter_range(b'b', b'd')), [b'b', b'c'])
+        self.assertEqual(list(index.iter_range(b'bb', b'cc')), [b'c'])
+        self.assertEqual(list(index.iter_range(b'b', reverse=True)),
+                         [b'd', b'c', b'b'])
+        self.assertEqual(list(index.iter_range(b'd', b'a')), [])
+
+    def test_prefix_end(self):
+        self.assertEqual(prefix_end(b'ab'), b'ac')
+        self.assertEqual(prefix_end(b'a\xff\xff'), b'b')
+        self.assertIsNone(prefix_end(b'\xff'))
+        self.assertIsNone(prefix_end(b''))
+
+
+class TestSimpleFileLoader(TestSemiDBM):
+    def open_db_file(self, **kwargs):
+        kwargs = semidbm.db._create_default_params()
+        kwargs['data_loader'] = SimpleFileLoader()
+        return semidbm.db._SemiDBM(self.dbdir, **kwargs)
+
+
+class TestSimpleFileLoaderSmallReads(TestSimpleFileLoader):
+    # Small reads make entries span multiple reads, and
+    # values larger than a read be skipped over.
+    def setUp(self):
+        super(TestSimpleFileLoaderSmallReads, self).setUp()
+        self.original_read_size = simpleload._READ_SIZE
+        simpleload._READ_SIZE = 13
+
+    def tearDown(self):
+        simpleload._READ_SIZE = self.original_read_size
+        super(TestSimpleFileLoaderSmallReads, self).tearDown()
+
+
+class TestLoadIndex(SemiDBMTest):
+    def populate(self):
+        db = semidbm.open(self.dbdir, 'c', compression='zlib',
+                          compression_threshold=0)
+        for i in range(100):
+            db['key%s' % i] = 'value%s' % i * (i % 7)
+        for i in range(0, 100, 3):
+            del db['key%s' % i]
+        db['large'] = os.urandom(1024 * 1024 * 2)
+        db['compressed'] = b'a' * 1024
+        db.close()
+        return os.path.join(self.dbdir, 'data')
+
+    def loaders(self):
+        loaders = [SimpleFileLoader()]
+        if mmap is not None:
+            from semidbm.loaders.mmapload import MMapLoader
+            loaders.append(MMapLoader())
+        return loaders
+
+    def test_matches_iter_keys(self):
+        data_filename = self.populate()
+        expected = {}
+        DBMLoader.load_index(SimpleFileLoader(), data_filename, expected)
+        self.assertEqual(len(expected), 68)
+        for loader in self.loaders():
+            index = {}
+            loader.load_index(data_filename, index)
+            self.assertEqual(index, expected)
+
+    def test_start_offset(self):
+        data_filename = self.populate()
+        db = semidbm.open(self.dbdir, 'r')
+        # The offset of the entry for 'large'.
+        large_offset = db._index[b'large'][0] - 8 - len('large')
+        db.close()
+        for loader in self.loaders():
+            index = {}
+            loader.load_index(data_filename, index, large_offset)
+            self.assertEqual(sorted(index), [b'compressed', b'large'])
+
+    def test_returns_end_of_last_entry(self):
+        data_filename = self.populate()
+        size = os.path.getsize(data_filename)
+        with open(data_filename, 'ab') as f:
+            # A partially written entry.
+            f.write(struct.pack('!ii', 3, 100) + b'foo')
+        generic = DBMLoader.load_index(SimpleFileLoader(), data_filename, {})
+        self.assertEqual(generic, size)
+        for loader in self.loaders():
+            self.assertEqual(loader.load_index(data_filename, {}), size)
+            self.assertEqual(loader.load_index(data_filename, {}, size),
+                             size)
+
+    def test_end_includes_commit_record_of_last_batch(self):
+        data_filename = self.populate()
+        db = semidbm.open(self.dbdir, 'w')
+        with db.batch() as batch:
+            batch['x'] = 'x'
+            batch['y'] = 'y'
+        db.close()
+        size = os.path.getsize(data_filename)
+        self.assertEqual(
+            DBMLoader.load_index(SimpleFileLoader(), data_filename, {}), size)
+        for loader in self.loaders():
+            self.assertEqual(loader.load_index(data_filename, {}), size)
+
+    def test_batch_kept_with_iter_keys_only_loader(self):
+        class IterKeysLoader(DBMLoader):
+            def iter_keys(self, filename, start_offset=None):
+                return SimpleFileLoader().iter_keys(filename, start_offset)
+
+        kwargs = semidbm.db._create_default_params()
+        kwargs['data_loader'] = IterKeysLoader()
+        db = semidbm.db._SemiDBM(self.dbdir, **kwargs)
+        db['a'] = 'a'
+        with db.batch() as batch:
+            batch['x'] = 'x'
+            batch['y'] = 'y'
+        db.close()
+        for i in range(2):
+            db = semidbm.db._SemiDBM(self.dbdir, **kwargs)
+            self.assertEqual(sorted(db.keys()), [b'a', b'x', b'y'])
+            db.close()
+
+    def test_load_tail(self):
+        data_filename = self.populate()
+        index = {}
+        loader = SimpleFileLoader()
+        end = loader.load_index(data_filename, index)
+        db = semidbm.open(self.dbdir, 'w')
+        db['new'] = 'new'
+        del db['key1']
+        db.close()
+        size = os.path.getsize(data_filename)
+        with open(data_filename, 'ab') as f:
+            f.write(struct.pack('!ii', 3, 100) + b'foo')
+        self.assertEqual(loader.load_tail(data_filename, index, end), size)
+        self.assertEqual(index[b'new'][1], 3)
+        self.assertNotIn(b'key1', index)
+        # Replaying the same entries again is harmless.
+        self.assertEqual(loader.load_tail(data_filename, index, end), size)
+        self.assertEqual(loader.load_tail(data_filename, index, end, end),
+                         end)
 
 
 if __name__ == '__main__':